@@ -1,12 +1,11 @@
 "use strict";
 
 import {ChildProcess} from "child_process";
-import * as getPort from "get-port";
 import {Socket} from "net";
 import * as path from "path";
-import {Disposable, ExtensionContext, OutputChannel, window} from "vscode";
+import {Disposable, ExtensionContext, OutputChannel, window, workspace} from "vscode";
 import * as lcp from "vscode-languageclient";
-import {install_server, start_server, server_installed} from "./server";
+import {install_server, start_server, start_stdio_server, server_installed} from "./server";
 
 
 let server_info: Object;
@@ -30,32 +29,51 @@ export async function activate(context: ExtensionContext) {
         }
     }
     let lhost: string = "127.0.0.1";
-    // grab a random open TCP port to listen to
-    let tcpPort: number = await getPort();
-    let langserver: ChildProcess = await start_server(serverRoot, lhost, tcpPort);
-    // when the client starts it should open a socket to the server
-    const serverOptions: lcp.ServerOptions = function() {
-        return new Promise((resolve, reject) => {
-            let connection: Socket = new Socket({readable: true, writable: true});
-            connection.connect(tcpPort, lhost, function() {
-                resolve({
-                    reader: connection,
-                    writer: connection
+    let tcpPort: number = null;
+    let langserver: ChildProcess;
+    let serverOptions: lcp.ServerOptions;
+    if (workspace.getConfiguration("yara").get("server_transport", "stdio") === "tcp") {
+        // the server picks its own port and tells us which one once it is listening
+        let address = await start_server(serverRoot, lhost);
+        langserver = address.process;
+        tcpPort = address.port;
+        // when the client starts it should open a socket to the server
+        serverOptions = function() {
+            return new Promise((resolve, reject) => {
+                let connection: Socket = new Socket({readable: true, writable: true});
+                connection.connect(tcpPort, lhost, function() {
+                    resolve({
+                        reader: connection,
+                        writer: connection
+                    });
+                });
+                connection.on("error", (error) => {
+                    // apparently net.Socket just rewraps errors as a generic Error object
+                    // kind of annoying, but workable
+                    if (error.message.includes("ECONNREFUSED")) {
+                        let msg: string = "Could not connect to YARA Language Server. Is it running?"
+                        window.showErrorMessage(msg);
+                        window.setStatusBarMessage(`Not connected to YARA Language Server`);
+                    }
+                    else {
+                        window.showErrorMessage(`YARA: ${error.message}`);
+                    }
                 });
             });
-            connection.on("error", (error) => {
-                // apparently net.Socket just rewraps errors as a generic Error object
-                // kind of annoying, but workable
-                if (error.message.includes("ECONNREFUSED")) {
-                    let msg: string = "Could not connect to YARA Language Server. Is it running?"
-                    window.showErrorMessage(msg);
-                    window.setStatusBarMessage(`Not connected to YARA Language Server`);
-                }
-                else {
-                    window.showErrorMessage(`YARA: ${error.message}`);
-                }
-            });
+        }
+    }
+    else {
+        // the server's stdout carries the protocol, so its logs go to stderr
+        langserver = start_stdio_server(serverRoot);
+        langserver.stderr.on("data", (data) => {
+            outputChannel.append(data.toString());
         });
+        serverOptions = function() {
+            return Promise.resolve({
+                reader: langserver.stdout,
+                writer: langserver.stdin
+            });
+        }
     }
     // register the client for all the YARA things
     const clientOptions: lcp.LanguageClientOptions = {
@@ -84,7 +102,7 @@ export async function activate(context: ExtensionContext) {
     // save these for later accessibility
     server_info = {
         "process": langserver,
-        "host": lhost,
+        "host": tcpPort === null ? null : lhost,
         "port": tcpPort
     }
     // give access to the language server's process and port info
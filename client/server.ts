@@ -5,7 +5,7 @@ import { ChildProcess, spawn, spawnSync } from "child_process";
 import { existsSync } from "fs";
 import * as path from "path";
 import { platform } from "process";
-import * as tcpPortUsed from "tcp-port-used";
+import { createInterface } from "readline";
 
 
 export function install_server(extensionRoot: string, targetDir: string): boolean {
@@ -32,10 +32,10 @@ export function install_server(extensionRoot: string, targetDir: string): boolea
     return venv_proc.status == 0;
 }
 
-export async function start_server(serverRoot: string, host: string, tcpPort: number): Promise<ChildProcess> {
+function get_server_command(serverRoot: string): string[] {
     /*
-        start up the language server with the pre-installed python runtime
-        returns the language server's ChildProcess instance
+        find the pre-installed python runtime and the language server script
+        returns the python interpreter's path followed by the script's path
     */
     let serverPath: string = path.join(serverRoot, "env", "bin", "vscode_yara.py");
     let pythonPath: string = path.join(serverRoot, "env", "bin", "python");
@@ -43,6 +43,22 @@ export async function start_server(serverRoot: string, host: string, tcpPort: nu
         serverPath = path.join(serverRoot, "env", "Scripts", "vscode_yara.py");
         pythonPath = path.join(serverRoot, "env", "Scripts", "python");
     }
+    return [pythonPath, serverPath];
+}
+
+export interface ServerAddress {
+    process: ChildProcess;
+    host: string;
+    port: number;
+}
+
+export function start_server(serverRoot: string, host: string): Promise<ServerAddress> {
+    /*
+        start up the language server with the pre-installed python runtime
+        the server binds to any free port and prints "<host>:<port>" once it is accepting connections
+        returns the language server's ChildProcess instance and the address it is listening on
+    */
+    let [pythonPath, serverPath] = get_server_command(serverRoot);
     // launch the language server
     const options = {
         cwd: serverRoot,
@@ -50,12 +66,42 @@ export async function start_server(serverRoot: string, host: string, tcpPort: nu
         shell: false,
         windowsHide: false
     }
-    // env/bin/python server.py <host> <lport>
-    let langserver: ChildProcess = spawn(pythonPath, [serverPath, host, tcpPort.toString()], options);
-    // wait for the language server to bind to the port
-    await tcpPortUsed.waitUntilUsed(tcpPort, host);
-    // console.log(`Running language server with the following cli: ${serverPath} ${host} ${tcpPort}`);
-    return langserver;
+    // env/bin/python server.py <host> 0
+    let langserver: ChildProcess = spawn(pythonPath, [serverPath, host, "0"], options);
+    return new Promise((resolve, reject) => {
+        const lines = createInterface({input: langserver.stdout});
+        lines.once("line", (line: string) => {
+            lines.close();
+            const separator: number = line.lastIndexOf(":");
+            resolve({
+                process: langserver,
+                // IPv6 addresses are wrapped in brackets
+                host: line.slice(0, separator).replace(/^\[(.*)\]$/, "$1"),
+                port: parseInt(line.slice(separator + 1), 10)
+            });
+        });
+        langserver.once("error", reject);
+        langserver.once("exit", (code: number) => {
+            reject(new Error(`Language server exited with code ${code} before it was ready`));
+        });
+    });
+}
+
+export function start_stdio_server(serverRoot: string): ChildProcess {
+    /*
+        start up the language server to talk over its stdin and stdout
+        there is no port to wait on, so the server is usable as soon as it is spawned
+        returns the language server's ChildProcess instance
+    */
+    let [pythonPath, serverPath] = get_server_command(serverRoot);
+    const options = {
+        cwd: serverRoot,
+        detached: false,
+        shell: false,
+        windowsHide: true
+    }
+    // env/bin/python server.py --stdio
+    return spawn(pythonPath, [serverPath, "--stdio"], options);
 }
 
 export function server_installed(installDir: string): boolean {
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+''' Measure the memory and time it takes to build a large list of protocol objects
+
+Usage: python benchmarks/bench_protocol.py [--locations N] [--validate]
+'''
+import argparse
+from pathlib import Path
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from yarals import protocol as lsp
+
+
+def build_locations(count: int) -> list:
+    ''' Build a references-sized result, the same way the providers do '''
+    return [
+        lsp.Location(lsp.Range(lsp.Position(line, 4), lsp.Position(line, 12)), "file:///bench/rules.yara")
+        for line in range(count)
+    ]
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark protocol object allocation")
+    parser.add_argument("--locations", type=int, default=50000, help="Number of locations to build")
+    parser.add_argument("--validate", action="store_true", help="Type-check each object, as the server does with --debug")
+    args = parser.parse_args()
+    lsp.VALIDATE = args.validate
+    # warm up any lazily-allocated interpreter state before measuring
+    build_locations(10)
+    tracemalloc.start()
+    locations = build_locations(args.locations)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del locations
+    elapsed = min(timeit.repeat(lambda: build_locations(args.locations), number=1, repeat=5)) * 1000
+    print("{:d} locations: {:.2f}MiB ({:.1f} bytes each), built in {:.1f}ms".format(
+        args.locations, size / 2**20, size / args.locations, elapsed
+    ))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+''' Measure the latency and memory of every provider against synthetic rule files
+
+Each provider is timed cold, with raw text that has to be parsed (or compiled)
+on every request, and warm, with an already-parsed document the way open files
+are held by the server. CompileAllRules is timed over a generated workspace,
+both from scratch and replaying an up-to-date build manifest.
+
+Results are printed as JSON, so runs can be saved and compared.
+
+Usage: python benchmarks/bench_providers.py [--rules N] [--size BYTES] [--files N] [--output PATH]
+'''
+import argparse
+import asyncio
+import gc
+import json
+import os
+from pathlib import Path
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from corpus import generate_file, generate_sized_file, generate_workspace
+from yarals import compiler, manifest
+from yarals.documents import TextDocument
+from yarals.workspace import Workspace
+from yarals.yarals import YaraLanguageServer
+
+
+def summarize(samples: list) -> dict:
+    ''' Reduce a list of latencies (in seconds) to milliseconds statistics '''
+    samples = sorted(samples)
+    p95 = samples[min(int(len(samples) * 0.95), len(samples) - 1)]
+    return {
+        "runs": len(samples),
+        "min_ms": round(samples[0] * 1000, 3),
+        "median_ms": round(statistics.median(samples) * 1000, 3),
+        "p95_ms": round(p95 * 1000, 3),
+        "max_ms": round(samples[-1] * 1000, 3)
+    }
+
+async def measure(func, repeat: int, setup=None) -> dict:
+    '''Time a coroutine function and record the peak memory of its first run
+
+    :func: Coroutine function to call with no arguments
+    :repeat: Number of timed runs
+    :setup: (Optional) Function to call before each run, outside of the timings
+    '''
+    if setup:
+        setup()
+    gc.collect()
+    tracemalloc.start()
+    await func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    samples = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        await func()
+        samples.append(time.perf_counter() - start)
+    results = summarize(samples)
+    results["peak_kib"] = round(peak / 1024, 1)
+    return results
+
+def _position(marker: tuple) -> dict:
+    return {"line": marker[0], "character": marker[1]}
+
+async def bench_document(server: YaraLanguageServer, name: str, rule_file, repeat: int) -> dict:
+    '''Run every single-file provider against a generated document
+
+    :server: Language server to benchmark
+    :name: Name of the document, used in its URI
+    :rule_file: corpus.RuleFile to request symbols from
+    :repeat: Number of timed runs per provider
+    '''
+    file_uri = "file:///bench/{}.yara".format(name)
+    text = rule_file.text
+    # completion triggers at the end of a line, the same way an editor sends it
+    completion_text = text + "\nrule Completion { condition: pe."
+    completion_params = {
+        "textDocument": {"uri": file_uri},
+        "position": {"line": completion_text.count("\n"), "character": len(completion_text.rsplit("\n", 1)[-1])},
+        "context": {"triggerKind": 2, "triggerCharacter": "."}
+    }
+    rule_params = {"textDocument": {"uri": file_uri}, "position": _position(rule_file.markers["rule"])}
+    string_params = {"textDocument": {"uri": file_uri}, "position": _position(rule_file.markers["string"])}
+    reference_params = dict(rule_params, context={"includeDeclaration": True})
+    rename_params = dict(rule_params, newName="Renamed")
+
+    requests = {
+        "completion": lambda document: server.provide_code_completion(completion_params, document),
+        "definition": lambda document: server.provide_definition(rule_params, document),
+        "hover": lambda document: server.provide_hover(string_params, document),
+        "references": lambda document: server.provide_reference(reference_params, document),
+        "rename": lambda document: server.provide_rename(rename_params, document, file_uri),
+        "diagnostic": lambda document: server.provide_diagnostic(document)
+    }
+    results = {
+        "bytes": len(text.encode("utf-8")),
+        "lines": text.count("\n") + 1,
+        "providers": {}
+    }
+    for provider, request in requests.items():
+        source = completion_text if provider == "completion" else text
+        if provider == "diagnostic" and not compiler.HAS_YARA:
+            continue
+        # drop any compilation results so cold diagnostics really compile
+        reset = lambda: setattr(server, "compile_cache", compiler.CompileCache())
+        cold = await measure(lambda: request(source), repeat, setup=reset)
+        document = TextDocument(file_uri, source)
+        await request(document)
+        warm = await measure(lambda: request(document), repeat)
+        results["providers"][provider] = {"cold": cold, "warm": warm}
+    return results
+
+async def bench_compile_all(server: YaraLanguageServer, root: Path, repeat: int) -> dict:
+    '''Run CompileAllRules over a generated workspace
+
+    :server: Language server to benchmark
+    :root: Workspace directory full of generated rule files
+    :repeat: Number of timed runs
+    '''
+    params = {"command": "yara.CompileAllRules", "arguments": []}
+
+    def _fresh_workspace():
+        # a new workspace and compile cache mean every file is read and compiled again
+        server.workspace = Workspace(root)
+        server.compile_cache = compiler.CompileCache()
+        for cached in manifest.get_cache_dir().glob("**/*"):
+            if cached.is_file():
+                cached.unlink()
+
+    cold = await measure(lambda: server.execute_command(params, {}, None), repeat, setup=_fresh_workspace)
+    # the last cold run left a complete manifest behind
+    warm = await measure(lambda: server.execute_command(params, {}, None), repeat)
+    return {"cold": cold, "warm": warm}
+
+async def run(args: argparse.Namespace) -> dict:
+    server = YaraLanguageServer(compile_workers=args.compile_workers)
+
+    async def _discard(method: str, params: dict, writer):
+        pass
+
+    # nobody is listening for diagnostics, so don't bother serializing them
+    server.send_notification = _discard
+    results = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "yara_python": compiler.get_yara_version() if compiler.HAS_YARA else None,
+        "compile_workers": server.compile_workers,
+        "documents": {},
+        "compile_all": None
+    }
+    documents = {
+        "rules": generate_file(args.rules, args.strings, args.depth, seed=args.seed),
+        "large": generate_sized_file(args.size, args.strings, args.depth, seed=args.seed)
+    }
+    for name, rule_file in documents.items():
+        results["documents"][name] = await bench_document(server, name, rule_file, args.repeat)
+    if compiler.HAS_YARA and args.files > 0:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            root = Path(tmpdir)
+            generate_workspace(root, args.files, args.rules_per_file, args.strings, args.depth, seed=args.seed)
+            results["compile_all"] = await bench_compile_all(server, root, args.repeat)
+            results["compile_all"]["files"] = args.files
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark every provider against synthetic rule files")
+    parser.add_argument("--rules", type=int, default=2000, help="Number of rules in the rules document")
+    parser.add_argument("--size", type=int, default=2**20, help="Minimum size in bytes of the large document")
+    parser.add_argument("--strings", type=int, default=20, help="Number of strings in each rule")
+    parser.add_argument("--depth", type=int, default=4, help="Nesting depth of each rule's condition")
+    parser.add_argument("--files", type=int, default=200, help="Number of files in the CompileAllRules workspace. 0 skips it")
+    parser.add_argument("--rules-per-file", type=int, default=20, help="Number of rules in each workspace file")
+    parser.add_argument("--compile-workers", type=int, default=None, help="Number of threads to compile rules with")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of timed runs per measurement")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the generated rules")
+    parser.add_argument("--output", type=Path, default=None, help="Write the results to a file instead of stdout")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as cache_dir:
+        # keep build manifests out of the user's real cache
+        os.environ[manifest.CACHE_DIR_ENV] = cache_dir
+        results = asyncio.get_event_loop().run_until_complete(run(args))
+    output = json.dumps(results, indent=2)
+    if args.output:
+        args.output.write_text(output + "\n")
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
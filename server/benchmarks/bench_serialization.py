@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+''' Compare the cost of serializing large responses before and after protocol objects learned to_dict()
+
+Usage: python benchmarks/bench_serialization.py [--references N] [--files N]
+'''
+import argparse
+import asyncio
+import json
+from pathlib import Path
+import sys
+import timeit
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from yarals import protocol as lsp
+from yarals.yarals import YaraLanguageServer
+
+
+class LegacyEncoder(json.JSONEncoder):
+    ''' The original encoder, which is called back once for every nested protocol object '''
+    def default(self, obj):
+        if isinstance(obj, lsp.CompletionItem):
+            return {"label": obj.label, "kind": obj.kind}
+        elif isinstance(obj, lsp.Diagnostic):
+            return {"message": obj.message, "range": obj.range, "relatedInformation": obj.relatedInformation, "severity": obj.severity}
+        elif isinstance(obj, lsp.Hover):
+            return {"range": obj.range, "contents": obj.contents} if hasattr(obj, "range") else {"contents": obj.contents}
+        elif isinstance(obj, lsp.Location):
+            return {"range": obj.range, "uri": obj.uri}
+        elif isinstance(obj, lsp.MarkupContent):
+            return {"kind": obj.kind, "value": obj.value}
+        elif isinstance(obj, lsp.MarkupKind):
+            return obj.value
+        elif isinstance(obj, lsp.Position):
+            return {"line": obj.line, "character": obj.char}
+        elif isinstance(obj, lsp.Range):
+            return {"start": obj.start, "end": obj.end}
+        return super().default(obj)
+
+def build_references(count: int) -> list:
+    ''' Run a real references request against a rule that uses one string many times '''
+    condition = " or ".join("$a" for _ in range(count))
+    document = "rule Many {{\n strings:\n  $a = \"many\"\n condition:\n  {}\n}}\n".format(condition)
+    params = {
+        "textDocument": {"uri": "file:///bench/many.yara"},
+        "position": {"line": 2, "character": 3}
+    }
+    server = YaraLanguageServer()
+    return asyncio.get_event_loop().run_until_complete(server.provide_reference(params, document))
+
+def build_diagnostics(count: int) -> list:
+    ''' Build the notifications CompileAllRules sends for a workspace full of broken files '''
+    notifications = []
+    for index in range(count):
+        locrange = lsp.Range(start=lsp.Position(index, 2), end=lsp.Position(index, 10000))
+        diagnostic = lsp.Diagnostic(locrange=locrange, severity=lsp.DiagnosticSeverity.ERROR, message="undefined string \"$a\"")
+        notifications.append({"uri": "file:///bench/rules{:d}.yara".format(index), "diagnostics": [diagnostic]})
+    return notifications
+
+def measure(func, number: int=5) -> float:
+    ''' Best average time (in milliseconds) to call func '''
+    return min(timeit.repeat(func, number=number, repeat=3)) / number * 1000
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark protocol serialization")
+    parser.add_argument("--references", type=int, default=10000, help="Number of locations in the references response")
+    parser.add_argument("--files", type=int, default=3000, help="Number of files CompileAllRules publishes diagnostics for")
+    args = parser.parse_args()
+    payloads = {
+        "references ({:d} locations)".format(args.references): [{"jsonrpc": "2.0", "id": 1, "result": build_references(args.references)}],
+        "CompileAllRules ({:d} files)".format(args.files): [
+            {"jsonrpc": "2.0", "method": "textDocument/publishDiagnostics", "params": params} for params in build_diagnostics(args.files)
+        ]
+    }
+    print("orjson installed: {}".format(lsp.HAS_ORJSON))
+    for name, messages in payloads.items():
+        legacy = measure(lambda: [json.dumps(message, cls=LegacyEncoder) for message in messages])
+        stdlib = measure(lambda: [json.dumps(message, cls=lsp.JSONEncoder) for message in messages])
+        fast = measure(lambda: [lsp.dumps(message) for message in messages])
+        print("{}: legacy {:.2f}ms, to_dict {:.2f}ms ({:.1f}x), dumps {:.2f}ms ({:.1f}x)".format(
+            name, legacy, stdlib, legacy / stdlib, fast, legacy / fast
+        ))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+''' Measure the time from starting the server process to receiving its 'initialize' response
+
+Usage: python benchmarks/bench_startup.py [--runs N]
+'''
+import argparse
+import json
+import os
+from pathlib import Path
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from yarals.manifest import CACHE_DIR_ENV
+
+SERVER = Path(__file__).resolve().parent.parent.joinpath("vscode_yara.py")
+
+
+def frame(message: dict) -> bytes:
+    ''' Encode a message the way a language client sends it '''
+    body = json.dumps(message).encode("utf-8")
+    return b"Content-Length: %d\r\n\r\n" % len(body) + body
+
+def read_message(stream) -> dict:
+    ''' Read a single message from the server's stdout '''
+    length = 0
+    while True:
+        line = stream.readline()
+        if line in (b"\r\n", b""):
+            break
+        name, _, value = line.partition(b":")
+        if name.strip().lower() == b"content-length":
+            length = int(value)
+    return json.loads(stream.read(length))
+
+def time_startup(workspace: str, env: dict) -> float:
+    ''' Start a server over stdio and time how long (in milliseconds) it takes to answer 'initialize' '''
+    initialize = {
+        "jsonrpc": "2.0",
+        "id": 1,
+        "method": "initialize",
+        "params": {"processId": os.getpid(), "rootUri": Path(workspace).as_uri(), "capabilities": {}}
+    }
+    start = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, str(SERVER), "--stdio"],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, env=env
+    )
+    try:
+        proc.stdin.write(frame(initialize))
+        proc.stdin.flush()
+        response = read_message(proc.stdout)
+        elapsed = (time.perf_counter() - start) * 1000
+        assert "capabilities" in response["result"]
+    finally:
+        proc.kill()
+        proc.wait()
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark language server startup")
+    parser.add_argument("--runs", type=int, default=10, help="Number of times to start the server")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as workspace:
+        # keep the build manifest out of the user's real cache
+        env = dict(os.environ, **{CACHE_DIR_ENV: workspace})
+        times = [time_startup(workspace, env) for _ in range(args.runs)]
+    print("process start to 'initialize' response over {:d} runs: min {:.1f}ms, median {:.1f}ms, max {:.1f}ms".format(
+        args.runs, min(times), statistics.median(times), max(times)
+    ))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+''' Generate synthetic YARA rule files to benchmark the language server against
+
+Every rule has its own strings section and a nested condition that refers
+to its strings and to rules declared earlier, so each provider has plenty
+of symbols to resolve. Conditions end with "any of them" so the rules still
+compile when some strings are never picked. Positions of a few interesting symbols are recorded
+so benchmarks know where to point their requests
+'''
+from collections import namedtuple
+from pathlib import Path
+import random
+
+# a generated file's text, and marker name => (line, character) of symbols in it
+RuleFile = namedtuple("RuleFile", ["text", "markers"])
+
+
+def _condition(rng: random.Random, strings: int, rules: list, depth: int) -> str:
+    ''' Build a condition nested to the given depth, mixing string and rule references '''
+    if depth <= 0:
+        choice = rng.random()
+        if rules and choice < 0.3:
+            return rng.choice(rules)
+        elif choice < 0.6:
+            return "#s{:d} > {:d}".format(rng.randrange(strings), rng.randrange(5))
+        return "$s{:d}".format(rng.randrange(strings))
+    operator = rng.choice(("and", "or"))
+    return "({} {} {})".format(_condition(rng, strings, rules, depth - 1), operator, _condition(rng, strings, rules, depth - 1))
+
+def generate_file(rule_count: int, strings_per_rule: int=20, depth: int=4, prefix: str="Rule", seed: int=0) -> RuleFile:
+    '''Generate a single rule file
+
+    The first rule is referenced by every rule after it, and its first string by
+    every condition in it, so those make good targets for definition, hover,
+    references and rename requests
+
+    :rule_count: Number of rules to declare
+    :strings_per_rule: (Optional) Number of strings in each rule's strings section
+    :depth: (Optional) How deeply each condition's boolean expression is nested
+    :prefix: (Optional) Prefix of every rule name, to keep names unique across files
+    :seed: (Optional) Seed for the random choices, so runs are comparable
+    '''
+    rng = random.Random(seed)
+    lines = ['import "pe"', ""]
+    markers = {}
+    names = []
+    for index in range(rule_count):
+        name = "{}{:d}".format(prefix, index)
+        lines.append("rule {} : bench generated".format(name))
+        lines.append("{")
+        lines.append("    meta:")
+        lines.append('        description = "Synthetic rule {:d}"'.format(index))
+        lines.append("    strings:")
+        for string in range(strings_per_rule):
+            value = "".join(rng.choice("abcdefghijklmnopqrstuvwxyz0123456789") for _ in range(rng.randrange(8, 48)))
+            lines.append('        $s{:d} = "{}" ascii wide nocase'.format(string, value))
+        lines.append("    condition:")
+        if index == 0:
+            markers["string"] = (len(lines), 9)
+            lines.append("        $s0 and {} or any of them".format(_condition(rng, strings_per_rule, [], depth)))
+        else:
+            # refer back to the first rule so it's used everywhere
+            markers.setdefault("rule", (len(lines), 8))
+            lines.append("        {} and {} or any of them".format(names[0], _condition(rng, strings_per_rule, names[-10:], depth)))
+        lines.append("}")
+        lines.append("")
+        names.append(name)
+    return RuleFile("\n".join(lines), markers)
+
+def generate_sized_file(size: int, strings_per_rule: int=20, depth: int=4, prefix: str="Large", seed: int=0) -> RuleFile:
+    '''Generate a single rule file of at least the given size
+
+    :size: Minimum size of the file in bytes
+    :strings_per_rule: (Optional) Number of strings in each rule's strings section
+    :depth: (Optional) How deeply each condition's boolean expression is nested
+    :prefix: (Optional) Prefix of every rule name
+    :seed: (Optional) Seed for the random choices, so runs are comparable
+    '''
+    # estimate from a small sample how many rules it takes
+    sample = generate_file(10, strings_per_rule, depth, prefix, seed)
+    rule_count = max(int(size / (len(sample.text.encode("utf-8")) / 10) * 1.05), 1)
+    rule_file = generate_file(rule_count, strings_per_rule, depth, prefix, seed)
+    while len(rule_file.text.encode("utf-8")) < size:
+        rule_count = int(rule_count * 1.1) + 1
+        rule_file = generate_file(rule_count, strings_per_rule, depth, prefix, seed)
+    return rule_file
+
+def generate_workspace(root: Path, files: int, rules_per_file: int, strings_per_rule: int=20, depth: int=4, seed: int=0) -> list:
+    '''Write a workspace full of rule files, returning their paths
+
+    :root: Directory to write the files to
+    :files: Number of files to write
+    :rules_per_file: Number of rules in each file
+    :strings_per_rule: (Optional) Number of strings in each rule's strings section
+    :depth: (Optional) How deeply each condition's boolean expression is nested
+    :seed: (Optional) Seed for the random choices, so runs are comparable
+    '''
+    root = Path(root)
+    root.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for index in range(files):
+        rule_file = generate_file(rules_per_file, strings_per_rule, depth, "File{:d}Rule".format(index), seed + index)
+        path = root.joinpath("rules{:d}.yara".format(index))
+        path.write_text(rule_file.text)
+        paths.append(path)
+    return paths
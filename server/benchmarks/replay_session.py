@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+''' Replay a session recorded with `vscode_yara.py --record` against a freshly started server
+
+Every client in the recording reconnects and sends the same messages, with the
+recorded gaps between them scaled by --speed. --concurrency replays each client
+that many times at once. Latencies are reported per method as JSON.
+
+Responses the recorded clients sent to the server's own requests are dropped,
+since request ids differ from run to run. Requests from the server are answered
+with an empty result instead. "exit" notifications are never sent, so a single
+client can't stop the server for the others.
+
+Usage: python benchmarks/replay_session.py RECORDING [--speed N] [--concurrency N] [--output PATH]
+'''
+import argparse
+import asyncio
+from collections import defaultdict
+import json
+import os
+from pathlib import Path
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from yarals.manifest import CACHE_DIR_ENV
+from yarals.metrics import LatencyHistogram
+from yarals.recorder import load_recording
+
+SERVER = Path(__file__).resolve().parent.parent.joinpath("vscode_yara.py")
+
+
+def frame(message: dict) -> bytes:
+    ''' Encode a message the way a language client sends it '''
+    body = json.dumps(message).encode("utf-8")
+    return b"Content-Length: %d\r\n\r\n" % len(body) + body
+
+async def read_message(reader: asyncio.StreamReader) -> dict:
+    ''' Read a single message from the server, or None once it disconnects '''
+    length = 0
+    while True:
+        line = await reader.readline()
+        if not line:
+            return None
+        if line == b"\r\n":
+            break
+        name, _, value = line.partition(b":")
+        if name.strip().lower() == b"content-length":
+            length = int(value)
+    return json.loads(await reader.readexactly(length))
+
+def split_sessions(entries: list) -> list:
+    '''Group the messages each recorded client sent, keeping the time each was sent
+
+    :entries: Recording, as returned by load_recording()
+    '''
+    sessions = defaultdict(list)
+    for entry in entries:
+        if entry.get("direction", None) != "recv":
+            continue
+        message = entry["message"]
+        if "method" not in message or message["method"] == "exit":
+            continue
+        sessions[entry["client"]].append((entry["time"], message))
+    if not sessions:
+        return []
+    # replay from the first message, however long the server ran before anyone connected
+    first = min(messages[0][0] for messages in sessions.values())
+    return [[(offset - first, message) for offset, message in sessions[client]] for client in sorted(sessions)]
+
+class Replay(object):
+    def __init__(self, host: str, port: int, speed: float, timeout: float):
+        '''Replays recorded sessions against a running server
+
+        :host: Address the server is listening on
+        :port: Port the server is listening on
+        :speed: How much faster than recorded to send messages. 0 sends them as fast as possible
+        :timeout: Seconds to wait for outstanding responses once a session has sent everything
+        '''
+        self.host = host
+        self.port = port
+        self.speed = speed
+        self.timeout = timeout
+        # method => LatencyHistogram of its responses
+        self.latencies = defaultdict(LatencyHistogram)
+        # method => number of error responses
+        self.errors = defaultdict(int)
+        # method => number of requests never answered
+        self.timeouts = defaultdict(int)
+
+    async def _read_responses(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, pending: dict):
+        while True:
+            message = await read_message(reader)
+            if message is None:
+                break
+            if "method" in message:
+                if "id" in message:
+                    # requests from the server, e.g. to register file watchers
+                    writer.write(frame({"jsonrpc": "2.0", "id": message["id"], "result": None}))
+                continue
+            future = pending.get(message.get("id", None), None)
+            if future is not None and not future.done():
+                future.set_result((time.perf_counter(), "error" in message))
+
+    async def run_session(self, messages: list, start: float):
+        '''Connect as a new client and send a recorded session's messages
+
+        :messages: (time, message) pairs sent by a single recorded client
+        :start: Event loop time the replay started at
+        '''
+        loop = asyncio.get_event_loop()
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        # request id => future resolved with the time its response arrived
+        pending = {}
+        # request id => (method, time it was sent)
+        sent = {}
+        responses = asyncio.ensure_future(self._read_responses(reader, writer, pending))
+        try:
+            for offset, message in messages:
+                if self.speed > 0:
+                    delay = start + offset / self.speed - loop.time()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                if "id" in message:
+                    pending[message["id"]] = loop.create_future()
+                    sent[message["id"]] = (message["method"], time.perf_counter())
+                writer.write(frame(message))
+                await writer.drain()
+            if pending:
+                await asyncio.wait(list(pending.values()), timeout=self.timeout)
+            for request_id, future in pending.items():
+                method, sent_at = sent[request_id]
+                if not future.done():
+                    self.timeouts[method] += 1
+                    continue
+                received_at, is_error = future.result()
+                self.latencies[method].add(received_at - sent_at)
+                if is_error:
+                    self.errors[method] += 1
+        finally:
+            responses.cancel()
+            writer.close()
+
+    def summary(self) -> dict:
+        ''' Per-method latency percentiles, in milliseconds '''
+        results = {}
+        for method in sorted(set(self.latencies) | set(self.timeouts)):
+            histogram = self.latencies[method]
+            results[method] = {
+                "count": histogram.count,
+                "errors": self.errors[method],
+                "timeouts": self.timeouts[method],
+                "p50_ms": round(histogram.percentile(50) * 1000, 3),
+                "p99_ms": round(histogram.percentile(99) * 1000, 3),
+                "max_ms": round(histogram.maximum * 1000, 3)
+            }
+        return results
+
+async def start_server(env: dict) -> tuple:
+    ''' Start a TCP server on any free port, returning the process and the address it announced '''
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable, str(SERVER), "127.0.0.1", "0",
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL, env=env
+    )
+    line = (await proc.stdout.readline()).decode("utf-8").strip()
+    if not line:
+        raise RuntimeError("Server exited before announcing its address")
+    host, _, port = line.rpartition(":")
+    return proc, host.strip("[]"), int(port)
+
+async def run(args: argparse.Namespace, env: dict) -> dict:
+    sessions = split_sessions(load_recording(args.recording))
+    proc, host, port = await start_server(env)
+    try:
+        replay = Replay(host, port, args.speed, args.timeout)
+        start = asyncio.get_event_loop().time()
+        elapsed = time.perf_counter()
+        await asyncio.gather(*[
+            replay.run_session(messages, start) for messages in sessions for _ in range(args.concurrency)
+        ])
+        elapsed = time.perf_counter() - elapsed
+    finally:
+        proc.terminate()
+        await proc.wait()
+    return {
+        "recording": str(args.recording),
+        "sessions": len(sessions) * args.concurrency,
+        "speed": args.speed,
+        "elapsed_s": round(elapsed, 3),
+        "methods": replay.summary()
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a recorded language server session")
+    parser.add_argument("recording", type=Path, help="File written by vscode_yara.py --record")
+    parser.add_argument("--speed", type=float, default=1.0, help="How much faster than recorded to replay. 0 sends messages as fast as possible")
+    parser.add_argument("--concurrency", type=int, default=1, help="Number of times to replay each recorded client at once")
+    parser.add_argument("--timeout", type=float, default=30.0, help="Seconds to wait for responses once a client has sent everything")
+    parser.add_argument("--output", type=Path, default=None, help="Write the results to a file instead of stdout")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as cache_dir:
+        # keep build manifests out of the user's real cache
+        env = dict(os.environ, **{CACHE_DIR_ENV: cache_dir})
+        results = asyncio.get_event_loop().run_until_complete(run(args, env))
+    output = json.dumps(results, indent=2)
+    if args.output:
+        args.output.write_text(output + "\n")
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
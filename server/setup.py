@@ -9,9 +9,10 @@ setup(
     url="https://infosec-intern.github.io/vscode-yara/",
     version="0.1",
     packages=["yarals"],
-    package_data={"yarals": ["data/*.json"]},
+    package_data={"yarals": ["data/*.json", "data/*.pickle"]},
     provides=["yarals"],
     install_requires=["yara-python"],
+    extras_require={"speedups": ["orjson"]},
     tests_require=["pytest", "pytest-asyncio"],
     scripts=["vscode_yara.py"]
 )
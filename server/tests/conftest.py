@@ -3,25 +3,44 @@ import asyncio
 import json
 import logging
 from pathlib import Path
+import sys
 
 import pytest
+from yarals import manifest
+from yarals import protocol
 from yarals import yarals
 
 
 def pytest_configure(config):
     ''' Registering custom markers '''
+    # catch malformed protocol objects early
+    protocol.VALIDATE = True
+    config.addinivalue_line("markers", "compiler: Run rule compilation and cache unittests")
+    config.addinivalue_line("markers", "completion: Run module completion unittests")
     config.addinivalue_line("markers", "config: Run config unittests")
+    config.addinivalue_line("markers", "documents: Run text document store unittests")
     config.addinivalue_line("markers", "helpers: Run helper function unittests")
+    config.addinivalue_line("markers", "index: Run workspace index unittests")
+    config.addinivalue_line("markers", "manifest: Run build manifest unittests")
+    config.addinivalue_line("markers", "metrics: Run request instrumentation unittests")
+    config.addinivalue_line("markers", "parser: Run YARA tokenizer and parser unittests")
     config.addinivalue_line("markers", "protocol: Run language server protocol unittests")
+    config.addinivalue_line("markers", "recorder: Run session recorder unittests")
     config.addinivalue_line("markers", "server: Run YARA-specific protocol unittests")
+    config.addinivalue_line("markers", "subprocess: Start the server in its own process")
     config.addinivalue_line("markers", "transport: Run network transport unittests")
+    config.addinivalue_line("markers", "workspace: Run shared workspace unittests")
 
 @pytest.fixture
-def event_loop():
+def event_loop(request):
     # force asyncio to use this event loop regardless of OS
     # to avoid RunTimeError "Event loop is closed" on Windows
     # also seen in: https://github.com/aio-libs/aiohttp/issues/4324
-    loop = asyncio.SelectorEventLoop()
+    if sys.platform == "win32" and request.node.get_closest_marker("subprocess"):
+        # ... except for tests that start a subprocess, which only the Proactor loop can do on Windows
+        loop = asyncio.ProactorEventLoop()
+    else:
+        loop = asyncio.SelectorEventLoop()
     yield loop
     loop.close()
 
@@ -60,6 +79,14 @@ async def init_server(initialize_msg, initialized_msg):
         await yara_server.read_request(reader)
     return _init_server
 
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path_factory, monkeypatch):
+    ''' Keep build manifests and other caches out of the user's real cache directory '''
+    path = tmp_path_factory.mktemp("cache")
+    # set through the environment, so servers started in a subprocess use it too
+    monkeypatch.setenv(manifest.CACHE_DIR_ENV, str(path))
+    return path
+
 @pytest.fixture(scope="function")
 def test_rules():
     ''' Resolve full path to the test YARA rules '''
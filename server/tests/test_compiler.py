@@ -0,0 +1,65 @@
+''' Tests for yarals.compiler module '''
+from pathlib import Path
+import subprocess
+import sys
+
+import pytest
+from yarals import compiler
+from yarals import protocol
+from yarals.documents import TextDocument
+
+
+@pytest.mark.compiler
+def test_compile_document():
+    ''' Ensure compilation errors are converted into diagnostics '''
+    document = TextDocument("", "rule OneDiagnostic {\n condition:\n  $true }\n")
+    result = compiler.compile_document(document)
+    assert result.rules is None
+    assert len(result.diagnostics) == 1
+    diagnostic = result.diagnostics[0]
+    assert isinstance(diagnostic, protocol.Diagnostic) is True
+    assert diagnostic.severity == protocol.DiagnosticSeverity.ERROR
+    assert diagnostic.message == "undefined string \"$true\""
+    assert diagnostic.range.start.line == 2
+    assert diagnostic.range.start.char == 2
+
+@pytest.mark.compiler
+def test_compile_document_keep_rules():
+    ''' Ensure compiled rules are only returned when asked for '''
+    document = TextDocument("", "rule External { condition: ext_int > 1 }")
+    result = compiler.compile_document(document, externals={"ext_int": 2}, keep_rules=True)
+    assert result.diagnostics == []
+    assert len(result.rules.match(data=b"")) == 1
+
+@pytest.mark.compiler
+def test_cache_key():
+    ''' Ensure cache keys depend on both the text and the externals '''
+    key = compiler.CompileCache.key("rule One { condition: true }")
+    assert key == compiler.CompileCache.key("rule One { condition: true }")
+    assert key != compiler.CompileCache.key("rule Two { condition: true }")
+    assert key != compiler.CompileCache.key("rule One { condition: true }", {"ext": 1})
+    assert compiler.CompileCache.key("", {"a": 1, "b": 2}) == compiler.CompileCache.key("", {"b": 2, "a": 1})
+
+@pytest.mark.compiler
+def test_cache_eviction():
+    ''' Ensure the least recently used results are evicted first, and hits and misses are counted '''
+    cache = compiler.CompileCache(maxsize=2)
+    result = compiler.CompileResult(diagnostics=[], rules=None)
+    cache.put("one", result)
+    cache.put("two", result)
+    assert cache.get("one") is result
+    cache.put("three", result)
+    assert cache.get("two") is None
+    assert cache.get("one") is result
+    assert cache.get("three") is result
+    assert cache.info() == compiler.CacheInfo(hits=3, misses=1, maxsize=2, currsize=2)
+    cache.clear()
+    assert cache.info() == compiler.CacheInfo(hits=0, misses=0, maxsize=2, currsize=0)
+
+@pytest.mark.compiler
+def test_lazy_import():
+    ''' Ensure yara-python is not imported until something is compiled '''
+    script = "import sys; from yarals import yarals; print('yara' in sys.modules)"
+    output = subprocess.run([sys.executable, "-c", script], stdout=subprocess.PIPE, cwd=str(Path(__file__).parent.parent), check=True)
+    assert output.stdout.strip() == b"False"
+    assert compiler.get_yara_version() == compiler.get_yara().__version__
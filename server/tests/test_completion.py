@@ -0,0 +1,44 @@
+''' Tests for yarals.completion module '''
+import pytest
+from yarals.completion import ModuleTrie
+from yarals import protocol
+
+
+SCHEMA = {
+    "pe": {"imphash": "method", "imports": "method", "Machine": "enum", "is_dll": "method", "number_of_sections": "property"},
+    "cuckoo": {"network": {"dns_lookup": "method"}}
+}
+
+@pytest.mark.completion
+def test_complete_level():
+    ''' Ensure every member of a level is offered in schema order, with nested levels completed as classes '''
+    trie = ModuleTrie(SCHEMA)
+    assert [item.label for item in trie.complete([]).items] == ["pe", "cuckoo"]
+    assert [item.label for item in trie.complete(["pe"]).items] == list(SCHEMA["pe"])
+    items = trie.complete(["cuckoo"]).items
+    assert items[0].kind == protocol.CompletionItemKind.CLASS
+    assert items[0].detail == "cuckoo.network"
+    assert trie.complete(["cuckoo", "network"]).items[0].detail == "cuckoo.network.dns_lookup()"
+    assert trie.complete(["pe", "imphash"]).items == []
+    assert trie.complete(["missing"]).items == []
+
+@pytest.mark.completion
+def test_complete_prefix():
+    ''' Ensure members are filtered by prefix, ignoring case '''
+    trie = ModuleTrie(SCHEMA)
+    assert [item.label for item in trie.complete(["pe"], "im").items] == ["imphash", "imports"]
+    assert [item.label for item in trie.complete(["pe"], "MA").items] == ["Machine"]
+    assert [item.label for item in trie.complete(["pe"], "i").items] == ["imphash", "imports", "is_dll"]
+    assert trie.complete(["pe"], "x").items == []
+
+@pytest.mark.completion
+def test_complete_limit():
+    ''' Ensure results longer than the limit are cut short and marked incomplete '''
+    trie = ModuleTrie(SCHEMA)
+    result = trie.complete(["pe"], limit=2)
+    assert len(result.items) == 2
+    assert result.isIncomplete is True
+    assert trie.complete(["pe"], "im", limit=2).isIncomplete is False
+    # callers can't change the items shared by every response
+    trie.complete(["pe"]).items.clear()
+    assert len(trie.complete(["pe"]).items) == 5
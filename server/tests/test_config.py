@@ -1,4 +1,5 @@
 ''' Tests for yarals configuration reactions '''
+import asyncio
 import json
 import logging
 
@@ -63,3 +64,41 @@ async def test_compile_on_save_true(caplog, init_server, open_streams, test_rule
         assert ("yara", logging.DEBUG, "Changed workspace config to {}".format(json.dumps(new_config))) in caplog.record_tuples
     writer.close()
     await writer.wait_closed()
+
+@pytest.mark.asyncio
+@pytest.mark.config
+async def test_compile_on_change(init_server, open_streams, test_rules, yara_server):
+    ''' Ensure only the latest version of a document is compiled when 'compile_on_change' is set '''
+    new_config = {"compile_on_change": True, "compile_on_change_delay": 50}
+    peek_rules = str(test_rules.joinpath("peek_rules.yara").resolve())
+    file_uri = helpers.create_file_uri(peek_rules)
+    change_config_msg = json.dumps({
+        "jsonrpc":"2.0", "method": "workspace/didChangeConfiguration",
+        "params": {"settings": {"yara": new_config}}
+    })
+    reader, writer = open_streams
+    await init_server(reader, writer, yara_server)
+    await yara_server.write_data(change_config_msg, writer)
+    await yara_server.write_data(json.dumps({
+        "jsonrpc":"2.0", "method": "textDocument/didOpen",
+        "params": {"textDocument": {"uri": file_uri, "languageId": "yara", "version": 0, "text": ""}}
+    }), writer)
+    for version in range(1, 4):
+        change_msg = json.dumps({
+            "jsonrpc":"2.0", "method": "textDocument/didChange",
+            "params": {
+                "textDocument": {"uri": file_uri, "version": version},
+                "contentChanges": [{"text": "rule Typing {{ condition: $v{:d} }}".format(version)}]
+            }
+        })
+        await yara_server.write_data(change_msg, writer)
+    response = await yara_server.read_request(reader)
+    assert response["method"] == "textDocument/publishDiagnostics"
+    assert response["params"]["uri"] == file_uri
+    assert response["params"]["version"] == 3
+    assert response["params"]["diagnostics"][0]["message"] == "undefined string \"$v3\""
+    # earlier versions were never compiled, so nothing else is published
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(yara_server.read_request(reader), timeout=0.2)
+    writer.close()
+    await writer.wait_closed()
@@ -0,0 +1,153 @@
+''' Tests for yarals.documents module '''
+import pytest
+from yarals import documents, protocol
+
+
+def _change(start_line: int, start_char: int, end_line: int, end_char: int, text: str) -> dict:
+    ''' Build an incremental TextDocumentContentChangeEvent '''
+    return {
+        "range": {
+            "start": {"line": start_line, "character": start_char},
+            "end": {"line": end_line, "character": end_char}
+        },
+        "text": text
+    }
+
+@pytest.mark.documents
+def test_split_lines():
+    ''' Ensure lines keep their terminators and the trailing remainder is kept '''
+    assert documents.split_lines("one\ntwo\r\nthree\rfour") == ["one\n", "two\r\n", "three\r", "four"]
+    assert documents.split_lines("one\n") == ["one\n", ""]
+    assert documents.split_lines("") == [""]
+
+@pytest.mark.documents
+def test_full_change():
+    ''' Ensure changes without a range replace the whole document '''
+    document = documents.TextDocument("file:///test.yar", "rule One { condition: true }\n", version=1)
+    document.apply_change({"text": "rule Two { condition: false }"}, version=2)
+    assert document.text == "rule Two { condition: false }"
+    assert document.line_count == 1
+    assert document.version == 2
+
+@pytest.mark.documents
+def test_incremental_insert():
+    ''' Ensure text is inserted within a single line '''
+    document = documents.TextDocument("file:///test.yar", "rule One {\n condition:\n  true\n}\n")
+    document.apply_change(_change(0, 8, 0, 8, "Two"), version=5)
+    assert document.text == "rule OneTwo {\n condition:\n  true\n}\n"
+    assert document.version == 5
+
+@pytest.mark.documents
+def test_incremental_multiline():
+    ''' Ensure edits spanning and introducing several lines are spliced in place '''
+    document = documents.TextDocument("file:///test.yar", "rule One {\r\n condition:\r\n  true\r\n}\r\n")
+    document.apply_change(_change(1, 1, 2, 6, "strings:\r\n  $a = \"a\"\r\n condition:\r\n  $a"))
+    assert document.text == "rule One {\r\n strings:\r\n  $a = \"a\"\r\n condition:\r\n  $a\r\n}\r\n"
+    assert document.line_count == 7
+    document.apply_change(_change(1, 0, 3, 0, ""))
+    assert document.text == "rule One {\r\n condition:\r\n  $a\r\n}\r\n"
+
+@pytest.mark.documents
+def test_incremental_lone_cr():
+    ''' Ensure a lone carriage return joined to a newline by an edit makes a single line ending '''
+    document = documents.TextDocument("file:///test.yar", "a\rb\nc")
+    document.apply_change(_change(1, 0, 1, 1, ""))
+    assert document.text == "a\r\nc"
+    assert document.line_count == 2
+    assert document.line(1) == "c"
+    document = documents.TextDocument("file:///test.yar", "a\rb")
+    document.apply_change(_change(1, 0, 1, 0, "\n"))
+    assert document.text == "a\r\nb"
+    assert document.line_count == 2
+    assert document.line(1) == "b"
+
+@pytest.mark.documents
+def test_incremental_end_of_document():
+    ''' Ensure edits at or beyond the end of the document append text '''
+    document = documents.TextDocument("file:///test.yar", "rule One {}")
+    document.apply_change(_change(0, 11, 0, 11, "\n"))
+    assert document.text == "rule One {}\n"
+    document.apply_change(_change(10, 0, 10, 0, "// end"))
+    assert document.text == "rule One {}\n// end"
+    assert document.line_count == 2
+
+@pytest.mark.documents
+def test_line_table():
+    ''' Ensure lines, offsets and positions are resolved from the line table '''
+    document = documents.TextDocument("file:///test.yar", "rule One {\r\n condition:\n  true\n}")
+    assert document.line(0) == "rule One {"
+    assert document.line(3) == "}"
+    pos = protocol.Position(line=2, char=2)
+    offset = document.offset_at(pos)
+    assert offset == 26
+    assert document.text[offset:offset+4] == "true"
+    result = document.position_at(offset)
+    assert result.line == pos.line
+    assert result.char == pos.char
+    document.apply_change(_change(0, 0, 0, 0, "// one\n"))
+    assert document.offset_at(protocol.Position(line=3, char=2)) == 33
+
+@pytest.mark.documents
+def test_get_document():
+    ''' Ensure text is wrapped and existing documents are passed through '''
+    document = documents.get_document("rule One {}", "file:///test.yar")
+    assert isinstance(document, documents.TextDocument) is True
+    assert document.uri == "file:///test.yar"
+    assert documents.get_document(document) is document
+
+@pytest.mark.documents
+def test_document_cache(tmp_path):
+    ''' Ensure files are only read again once they change on disk '''
+    path = tmp_path.joinpath("one.yar")
+    path.write_text("rule One { condition: true }")
+    cache = documents.DocumentCache()
+    first = cache.read(str(path), path.as_uri())
+    assert first.text == "rule One { condition: true }"
+    assert cache.read(str(path), path.as_uri()) is first
+    assert (cache.hits, cache.misses) == (1, 1)
+    path.write_text("rule Changed { condition: true }")
+    assert cache.read(str(path), path.as_uri()).text == "rule Changed { condition: true }"
+    assert cache.misses == 2
+    cache.invalidate(str(path))
+    assert str(path) not in cache
+    assert cache.currbytes == 0
+
+@pytest.mark.documents
+def test_snapshot():
+    ''' Ensure snapshots keep the text they were taken with, reusing the document only while it is unchanged '''
+    document = documents.TextDocument("file:///snapshot.yara", "rule A { condition: true }\n", version=1)
+    snapshot = document.snapshot()
+    assert documents.restore_snapshot(snapshot) is document
+    document.apply_change(_change(0, 0, 0, 0, "\n"), version=2)
+    restored = documents.restore_snapshot(snapshot)
+    assert restored is not document
+    assert restored.text == "rule A { condition: true }\n"
+    assert restored.version == 1
+    assert restored.uri == document.uri
+
+@pytest.mark.documents
+def test_document_cache_bounded(tmp_path):
+    ''' Ensure the least recently used files are dropped once the cache is full '''
+    cache = documents.DocumentCache(maxbytes=100)
+    paths = []
+    for index in range(4):
+        path = tmp_path.joinpath("{:d}.yar".format(index))
+        path.write_text("x" * 40)
+        paths.append(str(path))
+    for path in paths[:2]:
+        cache.read(path, "")
+    # touch the first file so the second one is the oldest
+    cache.read(paths[0], "")
+    cache.read(paths[2], "")
+    assert paths[1] not in cache
+    assert paths[0] in cache and paths[2] in cache
+    assert cache.currbytes == 80
+    # files larger than the whole cache are read but never kept
+    big_path = tmp_path.joinpath("big.yar")
+    big_path.write_text("x" * 101)
+    assert len(cache.read(str(big_path), "").text) == 101
+    assert str(big_path) not in cache
+    assert len(cache) == 2
+    cache.invalidate()
+    assert len(cache) == 0
+    assert cache.currbytes == 0
@@ -1,4 +1,5 @@
 ''' Tests for yarals.helpers module '''
+import json
 from urllib.parse import quote
 
 import pytest
@@ -30,7 +31,27 @@ def test_get_rule_range(test_rules):
     assert result.start.line == 33
     assert result.start.char == 0
     assert result.end.line == 43
-    assert result.end.char == 0
+    assert result.end.char == 1
+
+@pytest.mark.helpers
+def test_load_module_schema():
+    ''' Ensure the shipped, pickled module schema is up to date with its JSON source '''
+    assert helpers.MODULE_SCHEMA.with_suffix(".pickle").is_file()
+    with helpers.MODULE_SCHEMA.open("r", encoding="utf-8") as schema_file:
+        expected = json.load(schema_file)
+    assert helpers.load_module_schema() == expected
+
+@pytest.mark.helpers
+def test_load_module_schema_fallback(tmp_path):
+    ''' Ensure schemas are still loaded from JSON until they are compiled '''
+    schema_path = tmp_path.joinpath("modules.json")
+    schema_path.write_text(json.dumps({"test": {"member": "property"}}))
+    assert helpers.load_module_schema(schema_path) == {"test": {"member": "property"}}
+    compiled_path = helpers.compile_module_schema(schema_path)
+    assert compiled_path == tmp_path.joinpath("modules.pickle")
+    # the compiled copy takes priority once it exists
+    schema_path.write_text("{}")
+    assert helpers.load_module_schema(schema_path) == {"test": {"member": "property"}}
 
 @pytest.mark.helpers
 def test_parse_result():
@@ -74,3 +95,10 @@ def test_resolve_symbol():
     pos = protocol.Position(line=4, char=4)
     symbol = helpers.resolve_symbol(document, pos)
     assert symbol == "#a"
+
+@pytest.mark.helpers
+def test_normalize_uri(test_rules):
+    ''' Ensure different spellings of the same file URI normalize to the same key '''
+    peek_rules = test_rules.joinpath("peek_rules.yara")
+    assert helpers.normalize_uri(helpers.create_file_uri(str(peek_rules))) == helpers.normalize_uri(peek_rules.as_uri())
+    assert helpers.normalize_uri("untitled:Untitled-1") == "untitled:Untitled-1"
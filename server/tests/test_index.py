@@ -0,0 +1,161 @@
+''' Tests for yarals.index module '''
+import pytest
+from yarals import index
+from yarals.documents import TextDocument
+
+
+@pytest.mark.index
+def test_symbol_index_lookup():
+    ''' Ensure rules are indexed along with their modifiers and tags '''
+    text = "private rule One : tag1 tag2\n{\n condition:\n  true\n}\nglobal rule Two { condition: One }\n"
+    symbols = index.SymbolIndex()
+    symbols.update(TextDocument("file:///one.yar", text))
+    assert len(symbols) == 2
+    assert "One" in symbols
+    rules = symbols.lookup("One")
+    assert len(rules) == 1
+    assert rules[0].private is True
+    assert rules[0].is_global is False
+    assert rules[0].tags == ["tag1", "tag2"]
+    assert rules[0].location.uri == "file:///one.yar"
+    assert rules[0].location.range.start.line == 0
+    assert rules[0].location.range.start.char == 13
+    assert rules[0].location.range.end.char == 16
+    assert rules[0].declaration() == "private rule One : tag1 tag2"
+    rules = symbols.lookup("Two")
+    assert rules[0].is_global is True
+    assert rules[0].location.range.start.line == 5
+    assert symbols.lookup("Three") == []
+
+@pytest.mark.index
+def test_symbol_index_multiple_files():
+    ''' Ensure rules declared in several files are all found, and updates replace older symbols '''
+    symbols = index.SymbolIndex()
+    symbols.update(TextDocument("file:///one.yar", "rule One { condition: true }"))
+    symbols.update(TextDocument("file:///two.yar", "rule One { condition: true }\nrule Two { condition: true }"))
+    assert sorted(rule.location.uri for rule in symbols.lookup("One")) == ["file:///one.yar", "file:///two.yar"]
+    # different spellings of the same file URI are treated as the same file
+    symbols.update(TextDocument("file:////two.yar", "rule Three { condition: true }"))
+    assert [rule.location.uri for rule in symbols.lookup("One")] == ["file:///one.yar"]
+    assert "Two" not in symbols
+    assert symbols.lookup("Three")[0].location.uri == "file:////two.yar"
+    symbols.remove("file:///one.yar")
+    assert "One" not in symbols
+    assert len(symbols) == 1
+
+@pytest.mark.index
+def test_symbol_index_overlay():
+    ''' Ensure overlay documents replace their indexed copies for a single lookup, without changing the index '''
+    symbols = index.SymbolIndex()
+    symbols.update(TextDocument("file:///one.yar", "rule One { condition: true }"))
+    symbols.update(TextDocument("file:///two.yar", "rule Two { condition: true }"))
+    overlay = {"file:///one.yar": TextDocument("file:///one.yar", "rule Two { condition: true }")}
+    assert symbols.lookup("One", overlay) == []
+    assert sorted(rule.location.uri for rule in symbols.lookup("Two", overlay)) == ["file:///one.yar", "file:///two.yar"]
+    # new, unsaved files are found too
+    overlay = {"untitled:Untitled-1": TextDocument("untitled:Untitled-1", "rule Three { condition: true }")}
+    assert symbols.lookup("Three", overlay)[0].location.uri == "untitled:Untitled-1"
+    assert [rule.location.uri for rule in symbols.lookup("One")] == ["file:///one.yar"]
+    assert "Three" not in symbols
+
+@pytest.mark.index
+def test_symbol_index_complete():
+    ''' Ensure rule names are completed by prefix, ignoring case, and stay up to date as files change '''
+    symbols = index.SymbolIndex()
+    symbols.update(TextDocument("file:///one.yar", "rule Alpha { condition: true }\nrule alps { condition: true }"))
+    symbols.update(TextDocument("file:///two.yar", "private rule Beta { condition: true }\nrule Alpha { condition: true }"))
+    matches, incomplete = symbols.complete("al")
+    assert [symbol.name for symbol in matches] == ["Alpha", "alps"]
+    assert incomplete is False
+    assert symbols.complete("b")[0][0].declaration() == "private rule Beta"
+    assert [symbol.name for symbol in symbols.complete("")[0]] == ["Alpha", "alps", "Beta"]
+    matches, incomplete = symbols.complete("", limit=2)
+    assert [symbol.name for symbol in matches] == ["Alpha", "alps"]
+    assert incomplete is True
+    # names come and go as files are re-indexed
+    symbols.update(TextDocument("file:///one.yar", "rule Gamma { condition: true }"))
+    symbols.remove("file:///two.yar")
+    assert [symbol.name for symbol in symbols.complete("")[0]] == ["Gamma"]
+
+@pytest.mark.index
+def test_symbol_index_complete_overlay():
+    ''' Ensure unsaved documents add and remove rule names for a single completion '''
+    symbols = index.SymbolIndex()
+    symbols.update(TextDocument("file:///one.yar", "rule Alpha { condition: true }"))
+    symbols.update(TextDocument("file:///two.yar", "rule Alpine { condition: true }"))
+    overlay = {"file:///one.yar": TextDocument("file:///one.yar", "rule Alps { condition: true }")}
+    matches, _ = symbols.complete("Al", overlay)
+    assert [(symbol.name, symbol.location.uri) for symbol in matches] == [("Alpine", "file:///two.yar"), ("Alps", "file:///one.yar")]
+    assert [symbol.name for symbol in symbols.complete("Al")[0]] == ["Alpha", "Alpine"]
+    # unsaved rules filling a page don't hide indexed rules that sort before them
+    symbols.update(TextDocument("file:///three.yar", "rule Aa { condition: true }\nrule Ab { condition: true }"))
+    overlay = {"untitled:Untitled-1": TextDocument("untitled:Untitled-1", "rule Ax { condition: true }\nrule Ay { condition: true }\nrule Az { condition: true }")}
+    matches, incomplete = symbols.complete("a", overlay, limit=2)
+    assert [symbol.name for symbol in matches] == ["Aa", "Ab"]
+    assert incomplete is True
+
+@pytest.mark.index
+def test_symbol_index_references():
+    ''' Ensure rule declarations and uses are found across files, and stay up to date as files change '''
+    symbols = index.SymbolIndex()
+    symbols.update(TextDocument("file:///one.yar", "rule One { condition: true }\nrule Two { condition: One and $a }"))
+    symbols.update(TextDocument("file:///two.yar", "rule Three { condition: One or\n  Two }"))
+    locations = symbols.references("One")
+    assert sorted((location.uri, location.range.start.line, location.range.start.char, location.range.end.char) for location in locations) == [
+        ("file:///one.yar", 0, 5, 8),
+        ("file:///one.yar", 1, 22, 25),
+        ("file:///two.yar", 0, 24, 27)
+    ]
+    # string identifiers are never indexed
+    assert symbols.references("$a") == []
+    symbols.update(TextDocument("file:///two.yar", "rule Three { condition: Two }"))
+    assert [location.uri for location in symbols.references("One")] == ["file:///one.yar", "file:///one.yar"]
+    symbols.remove("file:///one.yar")
+    assert symbols.references("One") == []
+    assert [location.uri for location in symbols.references("Two")] == ["file:///two.yar"]
+
+@pytest.mark.index
+def test_symbol_index_references_overlay():
+    ''' Ensure overlay documents replace their indexed copies for a single lookup, without changing the index '''
+    symbols = index.SymbolIndex()
+    symbols.update(TextDocument("file:///one.yar", "rule One { condition: true }"))
+    symbols.update(TextDocument("file:///two.yar", "rule Two { condition: One }"))
+    overlay = {"file:///two.yar": TextDocument("file:///two.yar", "rule Two { condition: true }\nrule Three { condition: One and One }")}
+    assert sorted((location.uri, location.range.start.line) for location in symbols.references("One", overlay)) == [
+        ("file:///one.yar", 0), ("file:///two.yar", 1), ("file:///two.yar", 1)
+    ]
+    # locations use the overlay's spelling of the URI
+    overlay = {"file:////two.yar": TextDocument("file:////two.yar", "rule Two { condition: One }")}
+    assert sorted(location.uri for location in symbols.references("One", overlay)) == ["file:////two.yar", "file:///one.yar"]
+    assert len(symbols.references("One")) == 2
+
+@pytest.mark.index
+def test_symbol_index_references_overlay_first_lookup():
+    ''' Ensure the first lookup in a newly scanned overlay finds the name asked for, not the last one scanned '''
+    text = "rule A { condition: true }\nrule B { condition: A }\nrule C { condition: B }"
+    for name, expected in (("A", [(0, 5), (1, 20)]), ("B", [(1, 5), (2, 20)]), ("C", [(2, 5)])):
+        symbols = index.SymbolIndex()
+        overlay = {"file:///one.yar": TextDocument("file:///one.yar", text)}
+        assert sorted((location.range.start.line, location.range.start.char) for location in symbols.references(name, overlay)) == expected
+
+@pytest.mark.index
+def test_symbol_index_overlay_cache():
+    ''' Ensure overlaid documents are only scanned again once they change '''
+    symbols = index.SymbolIndex()
+    document = TextDocument("file:///one.yar", "rule One { condition: true }\nrule Two { condition: One }", version=1)
+    overlay = {document.uri: document}
+    scanned = symbols.scan_document(document)
+    assert symbols.scan_document(document) is scanned
+    assert [rule.name for rule in symbols.lookup("One", overlay)] == ["One"]
+    assert len(symbols.references("One", overlay)) == 2
+    assert symbols.scan_document(document) is scanned
+    document.apply_change({"text": "rule Three { condition: true }"}, version=2)
+    assert symbols.lookup("One", overlay) == []
+    assert [symbol.name for symbol in symbols.complete("t", overlay)[0]] == ["Three"]
+    assert symbols.scan_document(document) is not scanned
+    # changes without a version are picked up once the document is discarded
+    scanned = symbols.scan_document(document)
+    document.apply_change({"text": "rule Four { condition: true }"})
+    symbols.discard_document(document)
+    assert symbols.scan_document(document) is not scanned
+    assert [rule.name for rule in symbols.lookup("Four", overlay)] == ["Four"]
@@ -0,0 +1,76 @@
+''' Tests for yarals.manifest module '''
+import os
+
+import pytest
+from yarals import manifest
+from yarals import protocol
+
+
+@pytest.mark.manifest
+def test_manifest_path(cache_dir, tmp_path):
+    ''' Ensure each workspace gets its own manifest in the cache directory '''
+    path = manifest.get_manifest_path(tmp_path)
+    assert path.parent == cache_dir.joinpath("manifests")
+    assert path == manifest.get_manifest_path(tmp_path.joinpath("subdir", ".."))
+    assert path != manifest.get_manifest_path(tmp_path.joinpath("subdir"))
+
+@pytest.mark.manifest
+def test_cache_dir_override(tmp_path, monkeypatch):
+    ''' Ensure the cache directory can be moved on any platform '''
+    # undo the cache_dir fixture, so the real lookup runs
+    monkeypatch.undo()
+    monkeypatch.setenv(manifest.CACHE_DIR_ENV, str(tmp_path))
+    for platform in ("linux", "darwin", "win32"):
+        monkeypatch.setattr(manifest.sys, "platform", platform)
+        assert manifest.get_cache_dir() == tmp_path
+    monkeypatch.delenv(manifest.CACHE_DIR_ENV)
+    assert manifest.get_cache_dir() != tmp_path
+
+@pytest.mark.manifest
+def test_manifest_lookup(tmp_path):
+    ''' Ensure recorded diagnostics are only returned while the file is unchanged '''
+    rule_file = tmp_path.joinpath("one.yara")
+    rule_file.write_text("rule One { condition: $true }")
+    file_uri = rule_file.as_uri()
+    stat = rule_file.stat()
+    digest = manifest.BuildManifest.hash_text(rule_file.read_text())
+    diagnostic = protocol.Diagnostic(
+        locrange=protocol.Range(start=protocol.Position(0, 0), end=protocol.Position(0, 10000)),
+        severity=protocol.DiagnosticSeverity.ERROR,
+        message="undefined string \"$true\""
+    )
+    build = manifest.BuildManifest(tmp_path.joinpath("manifest.json"))
+    assert build.lookup(file_uri, stat=stat) is None
+    build.record(file_uri, stat, digest, [diagnostic])
+    diagnostics = build.lookup(file_uri, stat=stat)
+    assert diagnostics[0]["message"] == "undefined string \"$true\""
+    assert diagnostics[0]["range"]["end"]["character"] == 10000
+    # touching a file without changing its contents is detected by hash
+    os.utime(rule_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    touched = rule_file.stat()
+    assert build.lookup(file_uri, stat=touched) is None
+    assert build.lookup(file_uri, stat=touched, digest=digest) == diagnostics
+    assert build.lookup(file_uri, stat=touched) == diagnostics
+    assert build.lookup(file_uri, stat=touched, digest=manifest.BuildManifest.hash_text("")) is None
+
+@pytest.mark.manifest
+def test_manifest_persist(tmp_path):
+    ''' Ensure manifests survive a round trip to disk, and files that disappeared are forgotten '''
+    rule_file = tmp_path.joinpath("one.yara")
+    rule_file.write_text("rule One { condition: true }")
+    stat = rule_file.stat()
+    path = tmp_path.joinpath("manifests", "manifest.json")
+    build = manifest.BuildManifest(path)
+    build.record(rule_file.as_uri(), stat, "digest", [])
+    build.record("file:///deleted.yara", stat, "digest", [])
+    build.prune({rule_file.as_uri()})
+    build.save()
+    loaded = manifest.BuildManifest(path)
+    loaded.load()
+    assert len(loaded) == 1
+    assert rule_file.as_uri() in loaded
+    assert loaded.lookup(rule_file.as_uri(), stat=stat) == []
+    # corrupt manifests are ignored
+    path.write_text("{")
+    loaded.load()
+    assert len(loaded) == 0
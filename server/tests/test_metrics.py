@@ -0,0 +1,38 @@
+''' Tests for yarals.metrics module '''
+import pytest
+from yarals import metrics
+
+
+@pytest.mark.metrics
+def test_histogram_percentiles():
+    ''' Ensure percentiles are estimated to within a bucket's width '''
+    histogram = metrics.LatencyHistogram()
+    for millisecond in range(1, 101):
+        histogram.add(millisecond / 1000)
+    assert histogram.count == 100
+    assert 0.050 <= histogram.percentile(50) <= 0.050 * 1.25
+    assert 0.095 <= histogram.percentile(95) <= 0.100
+    assert histogram.percentile(99) == pytest.approx(0.1)
+    assert histogram.percentile(100) == pytest.approx(0.1)
+    # slower than the largest bucket
+    histogram.add(120)
+    assert histogram.percentile(100) == 120
+    assert metrics.LatencyHistogram().percentile(99) == 0.0
+
+@pytest.mark.metrics
+def test_measure():
+    ''' Ensure calls and errors are counted per method '''
+    stats = metrics.Metrics()
+    with stats.measure("textDocument/hover"):
+        pass
+    with pytest.raises(ValueError):
+        with stats.measure("textDocument/hover"):
+            raise ValueError("failed")
+    stats.record("textDocument/references", 2.0)
+    assert "textDocument/hover" in stats
+    assert "textDocument/definition" not in stats
+    summary = stats.summary()
+    assert list(summary) == ["textDocument/references", "textDocument/hover"]
+    assert summary["textDocument/hover"]["count"] == 2
+    assert summary["textDocument/hover"]["errors"] == 1
+    assert summary["textDocument/references"]["p99"] == 2000.0
@@ -0,0 +1,109 @@
+''' Tests for yarals.parser module '''
+import pytest
+from yarals import parser, protocol
+from yarals.documents import TextDocument
+
+
+def _summarize(tree: parser.SyntaxTree) -> list:
+    ''' Flatten a syntax tree into comparable values '''
+    summary = []
+    for rule in tree.rules:
+        summary.append((
+            rule.name, repr(rule.range), repr(rule.name_range), rule.terminated,
+            [(string.identifier, string.value, repr(string.range)) for string in rule.strings],
+            [(ref.name, repr(ref.range)) for ref in rule.references],
+            sorted((name, repr(section.range)) for name, section in rule.sections.items())
+        ))
+    return summary
+
+def _change(start_line: int, start_char: int, end_line: int, end_char: int, text: str) -> dict:
+    ''' Build an incremental TextDocumentContentChangeEvent '''
+    return {
+        "range": {
+            "start": {"line": start_line, "character": start_char},
+            "end": {"line": end_line, "character": end_char}
+        },
+        "text": text
+    }
+
+@pytest.mark.parser
+def test_tokenize():
+    ''' Ensure comments are skipped and patterns are only recognized after "=" or "matches" '''
+    text = "$a = { AB } // comment\n/* block { */ $b = /a}b/ filesize / 2 matches /x/i"
+    tokens, unterminated = parser.tokenize(text)
+    assert unterminated is False
+    assert [(token.kind, token.value) for token in tokens] == [
+        (parser.TokenKind.STRING_ID, "$a"), (parser.TokenKind.PUNCTUATION, "="), (parser.TokenKind.HEX, "{ AB }"),
+        (parser.TokenKind.STRING_ID, "$b"), (parser.TokenKind.PUNCTUATION, "="), (parser.TokenKind.REGEX, "/a}b/"),
+        (parser.TokenKind.KEYWORD, "filesize"), (parser.TokenKind.PUNCTUATION, "/"), (parser.TokenKind.NUMBER, "2"),
+        (parser.TokenKind.KEYWORD, "matches"), (parser.TokenKind.REGEX, "/x/i")
+    ]
+    assert text[tokens[2].start:tokens[2].end] == "{ AB }"
+
+@pytest.mark.parser
+def test_tokenize_unterminated():
+    ''' Ensure open block comments and hex strings are reported '''
+    assert parser.tokenize("rule a { /* condition: true }")[1] is True
+    assert parser.tokenize("$a = { AB CD")[1] is True
+
+@pytest.mark.parser
+def test_parse_rules(test_rules):
+    ''' Ensure rules, sections, strings and references are parsed with exact ranges '''
+    document = TextDocument("file:///peek_rules.yara", test_rules.joinpath("peek_rules.yara").read_text())
+    rules = document.tree.rules
+    assert [rule.name for rule in rules] == ["SyntaxExample", "RuleReferenceExample"]
+    rule = rules[0]
+    assert rule.terminated is True
+    assert (rule.range.start.line, rule.range.start.char, rule.range.end.line, rule.range.end.char) == (5, 0, 31, 1)
+    assert sorted(rule.sections) == ["condition", "meta", "strings"]
+    assert rule.sections["strings"].range.start.line == 16
+    assert rule.sections["condition"].range.start.line == 23
+    assert rule.meta[0].key == "description"
+    assert rule.meta[0].value == "\"Test\""
+    assert [string.identifier for string in rule.strings] == ["$true", "$false", "$hex_string", "$hex_string2", "$dstring", "$reg_ex"]
+    dstring = rule.find_strings("#dstring")[0]
+    assert dstring.value == "\"double string\" wide nocase fullword"
+    assert (dstring.range.start.line, dstring.range.start.char, dstring.range.end.char) == (21, 8, 16)
+    assert [string.identifier for string in rule.find_strings("$hex_*")] == ["$hex_string", "$hex_string2"]
+    assert [ref.name for ref in rules[1].references] == ["SyntaxExample", "!hex_string"]
+    assert document.tree.rule_at(protocol.Position(line=42, char=12)) is rules[1]
+    assert document.tree.rule_at(protocol.Position(line=32, char=0)) is None
+
+@pytest.mark.parser
+def test_parse_one_line_rules():
+    ''' Ensure rules sharing a line and braces inside strings are handled '''
+    text = "private rule One : tag { strings: $a = \"}{\" private condition: $a } global rule Two { condition: One }"
+    tree = TextDocument("file:///test.yar", text).tree
+    one, two = tree.rules
+    assert (one.name, one.private, one.tags) == ("One", True, ["tag"])
+    assert one.strings[0].value == "\"}{\" private"
+    assert (one.range.end.line, one.range.end.char) == (0, 67)
+    assert (two.name, two.is_global, two.range.start.char) == ("Two", True, 68)
+    assert tree.rule_at(protocol.Position(line=0, char=70)) is two
+    assert tree.rule_at(protocol.Position(line=0, char=10)) is one
+
+@pytest.mark.parser
+def test_parse_incremental(test_rules):
+    ''' Ensure re-parsing only edited rules gives the same tree as a full parse '''
+    document = TextDocument("file:///peek_rules.yara", test_rules.joinpath("peek_rules.yara").read_text())
+    original = document.tree
+    untouched = original.rules[1]
+    edits = [
+        # rename a string in the first rule
+        _change(21, 9, 21, 16, "renamed"),
+        # add lines before the second rule
+        _change(32, 0, 32, 0, "\nrule Inserted { condition: true }\n"),
+        # delete the closing brace of the inserted rule
+        _change(33, 32, 33, 33, ""),
+        # open a comment that swallows everything after it
+        _change(0, 0, 0, 0, "/* "),
+        # and close it again
+        _change(0, 0, 0, 3, ""),
+    ]
+    for index, edit in enumerate(edits):
+        document.apply_change(edit, version=index + 1)
+        assert _summarize(document.tree) == _summarize(parser.parse(document))
+        if index == 0:
+            # the tree is updated in place, and rules after the edit are not rebuilt
+            assert document.tree is original
+            assert document.tree.rules[1] is untouched
@@ -32,6 +32,14 @@ def test_completionitem():
     comp = protocol.CompletionItem(label=comp_dict["label"], kind=comp_dict["kind"])
     assert json.dumps(comp, cls=protocol.JSONEncoder) == json.dumps(comp_dict)
 
+@pytest.mark.protocol
+def test_completionlist():
+    ''' Ensure CompletionList is properly encoded to JSON dictionaries, including optional item fields '''
+    item_dict = {"label": "imphash", "kind": protocol.CompletionItemKind.METHOD, "detail": "pe.imphash()", "insertText": "imphash"}
+    item = protocol.CompletionItem(item_dict["label"], item_dict["kind"], detail=item_dict["detail"], insertText=item_dict["insertText"])
+    comp_list = protocol.CompletionList([item], isIncomplete=True)
+    assert json.dumps(comp_list, cls=protocol.JSONEncoder) == json.dumps({"isIncomplete": True, "items": [item_dict]})
+
 @pytest.mark.protocol
 def test_location():
     ''' Ensure Location is properly encoded to JSON dictionaries '''
@@ -64,3 +72,49 @@ def test_range():
         end=pos
     )
     assert json.dumps(rg_obj, cls=protocol.JSONEncoder) == json.dumps(rg_dict)
+
+@pytest.mark.protocol
+def test_workspace_edit():
+    ''' Ensure WorkspaceEdit is properly converted, along with its nested TextEdits '''
+    pos = protocol.Position(line=1, char=2)
+    edit = protocol.WorkspaceEdit("file:///one.yara", [])
+    edit.append(protocol.TextEdit(protocol.Range(start=pos, end=pos), "renamed"))
+    assert edit.to_dict() == {
+        "changes": {
+            "file:///one.yara": [{"range": {"start": {"line": 1, "character": 2}, "end": {"line": 1, "character": 2}}, "newText": "renamed"}]
+        }
+    }
+
+@pytest.mark.protocol
+@pytest.mark.parametrize("has_orjson", [True, False])
+def test_dumps(has_orjson, monkeypatch):
+    ''' Ensure messages serialize the same way with or without orjson '''
+    if has_orjson and not protocol.HAS_ORJSON:
+        pytest.skip("orjson is not installed")
+    monkeypatch.setattr(protocol, "HAS_ORJSON", has_orjson)
+    pos = protocol.Position(line=10, char=15)
+    hover = protocol.Hover(protocol.MarkupContent(protocol.MarkupKind.Plaintext, "value"), protocol.Range(start=pos, end=pos))
+    message = {"jsonrpc": "2.0", "id": 1, "result": [hover, protocol.MarkupKind.Markdown, None]}
+    assert json.loads(protocol.dumps(message)) == json.loads(json.dumps(message, cls=protocol.JSONEncoder))
+    assert json.loads(protocol.dumps(message))["result"][0]["contents"] == {"kind": "plaintext", "value": "value"}
+    # lone surrogates can't be encoded by orjson, but they're still valid for the standard library
+    assert json.loads(protocol.dumps({"message": "\ud800"})) == {"message": "\ud800"}
+    with pytest.raises(TypeError):
+        protocol.dumps({"result": object()})
+
+@pytest.mark.protocol
+def test_validate(monkeypatch):
+    ''' Ensure protocol objects are only type-checked when validation is enabled '''
+    pos = protocol.Position(line=1, char=2)
+    with pytest.raises(TypeError):
+        protocol.Range(start=pos, end=None)
+    with pytest.raises(TypeError):
+        protocol.Location(locrange=pos, uri="file:///one.yara")
+    monkeypatch.setattr(protocol, "VALIDATE", False)
+    assert protocol.Location(locrange=pos, uri="file:///one.yara").range is pos
+    # values sent by clients are still converted, even without validation
+    converted = protocol.Position(line=3.0, char="4")
+    assert (converted.line, converted.char) == (3, 4)
+    assert isinstance(converted.line, int) and isinstance(converted.char, int)
+    # protocol objects are slotted to keep large results small
+    assert not hasattr(pos, "__dict__")
@@ -0,0 +1,56 @@
+''' Tests for yarals.recorder module '''
+import asyncio
+import json
+
+import pytest
+from yarals.recorder import SessionRecorder, load_recording
+
+
+class _BufferWriter(object):
+    ''' Collect everything written to a stream '''
+    def __init__(self):
+        self.data = b""
+
+    def write(self, data: bytes):
+        self.data += data
+
+    async def drain(self):
+        pass
+
+@pytest.mark.asyncio
+@pytest.mark.recorder
+async def test_record_session(tmp_path, yara_server):
+    ''' Ensure messages read from and written to each client are recorded in order '''
+    path = tmp_path.joinpath("session.jsonl")
+    yara_server.recorder = SessionRecorder(path)
+    body = json.dumps({"jsonrpc": "2.0", "id": 1, "method": "shutdown", "params": None}, indent=4).encode("utf-8")
+    reader = asyncio.StreamReader()
+    reader.feed_data(b"Content-Length: %d\r\n\r\n" % len(body) + body)
+    reader.feed_eof()
+    writer = _BufferWriter()
+    yara_server.recorder.connect(reader, writer)
+    request = await yara_server.read_request(reader)
+    await yara_server.send_response(request["id"], {}, writer)
+    # streams from another client are recorded separately
+    await yara_server.send_notification("test", {"text": "règle ☃"}, _BufferWriter())
+    yara_server.recorder.disconnect(reader)
+    yara_server.recorder.close()
+    entries = load_recording(path)
+    assert [entry.get("event", entry.get("direction")) for entry in entries] == ["connect", "recv", "send", "send", "disconnect"]
+    assert [entry["client"] for entry in entries] == [1, 1, 1, 2, 1]
+    # pretty-printed messages still take up a single line
+    assert len(path.read_text(encoding="utf-8").splitlines()) == len(entries)
+    assert entries[1]["message"]["method"] == "shutdown"
+    assert entries[2]["message"] == {"jsonrpc": "2.0", "id": 1, "result": {}}
+    assert entries[3]["message"]["params"]["text"] == "règle ☃"
+    assert all(earlier["time"] <= later["time"] for earlier, later in zip(entries, entries[1:]))
+
+@pytest.mark.recorder
+def test_record_closed(tmp_path):
+    ''' Ensure messages sent after recording stops are ignored '''
+    path = tmp_path.joinpath("session.jsonl")
+    recorder = SessionRecorder(path)
+    recorder.record(_BufferWriter(), "recv", b'{"jsonrpc": "2.0", "method": "initialized", "params": {}}')
+    recorder.close()
+    recorder.record(_BufferWriter(), "send", '{"jsonrpc": "2.0", "method": "test"}')
+    assert [entry["direction"] for entry in load_recording(path)] == ["recv"]
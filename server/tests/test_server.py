@@ -1,10 +1,16 @@
 ''' Tests for yarals.yarals module '''
+import asyncio
 import json
 import logging
+from pathlib import Path
 
 import pytest
 from yarals import helpers
 from yarals import protocol
+from yarals import yarals
+from yarals.documents import TextDocument
+from yarals.manifest import BuildManifest
+from yarals.workspace import Workspace
 
 try:
     # asyncio exceptions changed from 3.6 > 3.7 > 3.8
@@ -29,35 +35,70 @@ def test_cmd_compile_rule():
     }
     assert request is False
 
-@pytest.mark.skip(reason="not implemented")
+@pytest.mark.asyncio
 @pytest.mark.server
-def test_cmd_compile_all_rules():
+async def test_cmd_compile_all_rules(tmp_path, yara_server):
     ''' Ensure CompileAllRules compiles all YARA rule files in the given workspace '''
-    request = {
-        "jsonrpc": "2.0",
-        "id": 1,
-        "method": "workspace/executeCommand",
-        "params": {
-            "command": "yara.CompileAllRules",
-            "arguments": []
-        }
-    }
-    assert request is False
+    for index in range(10):
+        tmp_path.joinpath("valid{:d}.yara".format(index)).write_text("rule Valid{:d} {{ condition: true }}".format(index))
+        tmp_path.joinpath("invalid{:d}.yar".format(index)).write_text("rule Invalid{:d} {{ condition: $true }}".format(index))
+    dirty_uri = tmp_path.joinpath("valid0.yara").as_uri()
+    dirty_files = {dirty_uri: "rule Dirty { condition: $dirty }"}
+    notifications = []
+    async def _send_notification(method, params, writer):
+        notifications.append((method, params))
+    yara_server.send_notification = _send_notification
+    yara_server.workspace = Workspace(tmp_path)
+    params = {"command": "yara.CompileAllRules", "arguments": []}
+    config = {"compile_all_concurrency": 3, "compile_all_batch_size": 4}
+    await yara_server.execute_command(params, dirty_files, None, config)
+    assert all(method == "textDocument/publishDiagnostics" for method, _ in notifications)
+    published = sorted(params["uri"] for _, params in notifications)
+    expected = sorted([dirty_uri] + [tmp_path.joinpath("invalid{:d}.yar".format(index)).as_uri() for index in range(10)])
+    assert published == expected
+    assert dirty_files[dirty_uri] == "rule Dirty { condition: $dirty }"
 
-@pytest.mark.skip(reason="not implemented")
+@pytest.mark.asyncio
 @pytest.mark.server
-def test_cmd_compile_all_rules_no_workspace():
+async def test_cmd_compile_all_rules_incremental(tmp_path, yara_server):
+    ''' Ensure CompileAllRules only recompiles files that changed since the last run '''
+    for index in range(5):
+        tmp_path.joinpath("invalid{:d}.yara".format(index)).write_text("rule Invalid{:d} {{ condition: $true }}".format(index))
+    notifications = []
+    async def _send_notification(method, params, writer):
+        notifications.append(params)
+    yara_server.send_notification = _send_notification
+    yara_server.workspace = Workspace(tmp_path)
+    params = {"command": "yara.CompileAllRules", "arguments": []}
+    await yara_server.execute_command(params, {}, None)
+    assert len(notifications) == 5
+    assert yara_server.workspace.manifest.path.exists() is True
+    # a fresh server picks up the manifest from disk and doesn't compile anything
+    notifications.clear()
+    yara_server.workspace.manifest = None
+    yara_server.compile_cache.clear()
+    tmp_path.joinpath("invalid0.yara").write_text("rule Valid { condition: true }")
+    await yara_server.execute_command(params, {}, None)
+    assert yara_server.compile_cache.info().misses == 1
+    assert sorted(params["uri"] for params in notifications) == [tmp_path.joinpath("invalid{:d}.yara".format(index)).as_uri() for index in range(1, 5)]
+    assert notifications[0]["diagnostics"][0]["message"] == "undefined string \"$true\""
+
+@pytest.mark.asyncio
+@pytest.mark.server
+async def test_cmd_compile_all_rules_no_workspace(yara_server):
     ''' Ensure CompileAllRules only compiles opened files when no workspace is specified '''
-    request = {
-        "jsonrpc": "2.0",
-        "id": 1,
-        "method": "workspace/executeCommand",
-        "params": {
-            "command": "yara.CompileAllRules",
-            "arguments": []
-        }
+    dirty_files = {
+        "file:///one.yara": "rule One { condition: $one }",
+        "file:///two.yara": "rule Two { condition: true }"
     }
-    assert request is False
+    notifications = []
+    async def _send_notification(method, params, writer):
+        notifications.append((method, params))
+    yara_server.send_notification = _send_notification
+    params = {"command": "yara.CompileAllRules", "arguments": []}
+    await yara_server.execute_command(params, dirty_files, None)
+    assert [params["uri"] for _, params in notifications] == ["file:///one.yara"]
+    assert notifications[0][1]["diagnostics"][0].message == "undefined string \"$one\""
 
 @pytest.mark.asyncio
 @pytest.mark.server
@@ -73,12 +114,73 @@ async def test_code_completion_regular(test_rules, yara_server):
     }
     document = yara_server._get_document(file_uri, dirty_files={})
     result = await yara_server.provide_code_completion(params, document)
-    assert len(result) == 4
-    for completion in result:
+    assert isinstance(result, protocol.CompletionList) is True
+    assert result.isIncomplete is False
+    assert len(result.items) == 4
+    for completion in result.items:
         assert isinstance(completion, protocol.CompletionItem) is True
         actual.append(completion.label)
     assert actual == expected
 
+@pytest.mark.asyncio
+@pytest.mark.server
+async def test_code_completion_prefix(yara_server):
+    ''' Ensure only the members starting with the partially-typed name are offered, and large levels are paged '''
+    document = "import \"pe\"\nrule Prefix {\n condition:\n  pe.imp\n}\n"
+    params = {
+        "textDocument": {"uri": "file:///prefix.yara"},
+        "position": {"line": 3, "character": 8}
+    }
+    result = await yara_server.provide_code_completion(params, document)
+    assert [item.label for item in result.items] == ["imphash", "imports"]
+    assert result.items[0].detail == "pe.imphash()"
+    assert result.items[0].insertText == "imphash"
+    params["position"]["character"] = 5
+    result = await yara_server.provide_code_completion(params, document, max_items=10)
+    assert len(result.items) == 10
+    assert result.isIncomplete is True
+
+@pytest.mark.asyncio
+@pytest.mark.server
+async def test_code_completion_strings(yara_server):
+    ''' Ensure the named strings of the current rule are completed after any variable character '''
+    document = "rule Strings {\n strings:\n  $abc = \"abc\"\n  $abd = { 00 }\n  $xyz = \"xyz\"\n  $ = \"anonymous\"\n condition:\n  # and $ab\n}\n"
+    params = {
+        "textDocument": {"uri": "file:///strings.yara"},
+        "position": {"line": 7, "character": 3}
+    }
+    result = await yara_server.provide_code_completion(params, document)
+    assert [item.label for item in result.items] == ["#abc", "#abd", "#xyz"]
+    assert result.items[0].kind == protocol.CompletionItemKind.VARIABLE
+    assert result.items[0].detail == "\"abc\""
+    # the variable character is not part of the word the editor replaces
+    assert result.items[0].insertText == "abc"
+    params["position"]["character"] = 11
+    result = await yara_server.provide_code_completion(params, document)
+    assert [item.label for item in result.items] == ["$abc", "$abd"]
+    # strings aren't offered outside of the condition
+    params["position"] = {"line": 4, "character": 3}
+    assert (await yara_server.provide_code_completion(params, document)).items == []
+
+@pytest.mark.asyncio
+@pytest.mark.server
+async def test_code_completion_rules(yara_server):
+    ''' Ensure rule names from the workspace and the document being edited are completed in conditions '''
+    yara_server.workspace.index.update(TextDocument("file:///other.yara", "rule Persistence { condition: true }"))
+    document = "rule Packed { condition: true }\nrule Current {\n condition:\n  Pe\n}\n"
+    params = {
+        "textDocument": {"uri": "file:///current.yara"},
+        "position": {"line": 3, "character": 4}
+    }
+    result = await yara_server.provide_code_completion(params, document)
+    assert [item.label for item in result.items] == ["pe", "Persistence"]
+    assert result.items[1].kind == protocol.CompletionItemKind.REFERENCE
+    assert result.items[1].detail == "rule Persistence"
+    params["position"]["character"] = 3
+    result = await yara_server.provide_code_completion(params, document, max_items=2)
+    assert [item.label for item in result.items] == ["pe", "Packed"]
+    assert result.isIncomplete is True
+
 @pytest.mark.asyncio
 @pytest.mark.server
 async def test_code_completion_overflow(test_rules, yara_server):
@@ -91,7 +193,7 @@ async def test_code_completion_overflow(test_rules, yara_server):
     }
     document = yara_server._get_document(file_uri, dirty_files={})
     result = await yara_server.provide_code_completion(params, document)
-    assert result == []
+    assert result.items == []
 
 @pytest.mark.asyncio
 @pytest.mark.server
@@ -105,7 +207,7 @@ async def test_code_completion_unexpected(test_rules, yara_server):
     }
     document = yara_server._get_document(file_uri, dirty_files={})
     result = await yara_server.provide_code_completion(params, document)
-    assert result == []
+    assert result.items == []
 
 @pytest.mark.asyncio
 @pytest.mark.server
@@ -147,6 +249,26 @@ async def test_definitions_private_rules(test_rules, yara_server):
     assert result[0].range.end.line == 0
     assert result[0].range.end.char == 28
 
+@pytest.mark.asyncio
+@pytest.mark.server
+async def test_definitions_rules_workspace(test_rules, yara_server):
+    ''' Ensure definitions are provided for rules declared in other workspace files '''
+    yara_server.workspace = Workspace(test_rules)
+    await yara_server.index_workspace()
+    document = "rule CrossFileReference { condition: SyntaxExample }"
+    params = {
+        "textDocument": {"uri": "file:///cross_file.yara"},
+        "position": {"line": 0, "character": 40}
+    }
+    result = await yara_server.provide_definition(params, document)
+    assert len(result) == 1
+    assert isinstance(result[0], protocol.Location) is True
+    assert helpers.normalize_uri(result[0].uri) == helpers.normalize_uri(test_rules.joinpath("peek_rules.yara").as_uri())
+    assert result[0].range.start.line == 5
+    assert result[0].range.start.char == 5
+    assert result[0].range.end.line == 5
+    assert result[0].range.end.char == 18
+
 @pytest.mark.asyncio
 @pytest.mark.server
 async def test_definitions_variables_count(test_rules, yara_server):
@@ -277,6 +399,166 @@ async def test_dirty_files(test_rules, yara_server):
     document = yara_server._get_document(file_uri, dirty_files)
     assert document == unsaved_changes
 
+@pytest.mark.asyncio
+@pytest.mark.server
+async def test_shared_workspace(tmp_path, yara_server):
+    ''' Ensure clients opening the same folder share its index, while unsaved edits stay with the client that made them '''
+    rules_path = tmp_path.joinpath("shared.yara")
+    rules_path.write_text("rule Shared { condition: true }\n")
+    file_uri = rules_path.as_uri()
+    initialize = {"params": {"rootUri": tmp_path.as_uri(), "capabilities": {}}}
+    first, second = yarals.ClientSession(None), yarals.ClientSession(None)
+    await yara_server._on_initialize(initialize, first)
+    await yara_server._on_initialize(initialize, second)
+    assert first.workspace is second.workspace
+    assert first.workspace.clients == 2
+    await first.workspace.indexer
+    # the first client renames the rule without saving
+    await yara_server._on_open({"params": {"textDocument": {"uri": file_uri, "version": 0, "text": rules_path.read_text()}}}, first)
+    await yara_server._on_change({"params": {
+        "textDocument": {"uri": file_uri, "version": 1},
+        "contentChanges": [{"text": "rule Renamed { condition: true }\n"}]
+    }}, first)
+    document = "rule Other { condition: Shared or Renamed }"
+    params = {"textDocument": {"uri": "file:///other.yara"}, "position": {"line": 0, "character": 26}}
+    assert await yara_server.provide_definition(params, document, first.workspace, first.dirty_files) == []
+    assert len(await yara_server.provide_definition(params, document, second.workspace, second.dirty_files)) == 1
+    params["position"]["character"] = 36
+    assert len(await yara_server.provide_definition(params, document, first.workspace, first.dirty_files)) == 1
+    assert await yara_server.provide_definition(params, document, second.workspace, second.dirty_files) == []
+    # the workspace is only dropped once both clients are gone
+    yara_server.workspaces.release(first.workspace)
+    assert tmp_path in yara_server.workspaces
+    yara_server.workspaces.release(second.workspace)
+    assert tmp_path not in yara_server.workspaces
+
+@pytest.mark.asyncio
+@pytest.mark.server
+async def test_document_cache(tmp_path, yara_server):
+    ''' Ensure saved files are only read from disk again after they are saved, and edits never touch the cached copy '''
+    rules_path = tmp_path.joinpath("cached.yara")
+    rules_path.write_text("rule Cached { condition: true }\n")
+    file_uri = rules_path.as_uri()
+    session = yarals.ClientSession(None)
+    await yara_server._on_initialize({"params": {"rootUri": tmp_path.as_uri(), "capabilities": {}}}, session)
+    saved = yara_server._get_text_document(file_uri, session.dirty_files)
+    assert yara_server._get_text_document(file_uri, session.dirty_files) is saved
+    await yara_server._on_open({"params": {"textDocument": {"uri": file_uri, "version": 0, "text": saved.text}}}, session)
+    await yara_server._on_change({"params": {
+        "textDocument": {"uri": file_uri, "version": 1},
+        "contentChanges": [{"text": "rule Edited { condition: true }\n"}]
+    }}, session)
+    assert saved.text == "rule Cached { condition: true }\n"
+    rules_path.write_text("rule Edited { condition: true }\n")
+    async def _send_notification(method, params, writer):
+        pass
+    yara_server.send_notification = _send_notification
+    await yara_server._on_save({"params": {"textDocument": {"uri": file_uri}}}, session)
+    assert yara_server._get_document(file_uri, session.dirty_files) == "rule Edited { condition: true }\n"
+
+@pytest.mark.asyncio
+@pytest.mark.server
+async def test_watched_files(tmp_path, yara_server):
+    ''' Ensure files changed outside the editor are dropped from every cache and re-indexed '''
+    rules_path = tmp_path.joinpath("watched.yara")
+    rules_path.write_text("rule Before { condition: true }\n")
+    file_uri = rules_path.as_uri()
+    session = yarals.ClientSession(None)
+    await yara_server._on_initialize({"params": {"rootUri": tmp_path.as_uri(), "capabilities": {}}}, session)
+    workspace = session.workspace
+    await workspace.indexer
+    yara_server._get_text_document(file_uri, {})
+    workspace.manifest = BuildManifest(tmp_path.joinpath("manifest.json"))
+    workspace.manifest.record(file_uri, rules_path.stat(), "", [])
+    rules_path.write_text("rule After { condition: true }\n")
+    created_path = tmp_path.joinpath("created.yar")
+    created_path.write_text("rule Created { condition: true }\n")
+    await yara_server._on_change_watched_files({"params": {"changes": [
+        {"uri": file_uri, "type": protocol.FileChangeType.CHANGED},
+        {"uri": created_path.as_uri(), "type": protocol.FileChangeType.CREATED}
+    ]}}, session)
+    assert str(rules_path) not in yara_server.document_cache
+    assert file_uri not in workspace.manifest
+    assert "Before" not in workspace.index
+    assert "After" in workspace.index
+    assert "Created" in workspace.index
+    assert created_path in workspace.known_files
+    created_path.unlink()
+    await yara_server._on_change_watched_files({"params": {"changes": [
+        {"uri": created_path.as_uri(), "type": protocol.FileChangeType.DELETED}
+    ]}}, session)
+    assert "Created" not in workspace.index
+    assert created_path not in workspace.known_files
+
+@pytest.mark.asyncio
+@pytest.mark.server
+async def test_watched_files_poll(tmp_path):
+    ''' Ensure workspaces are polled for changes when the client can't watch files itself '''
+    yara_server = yarals.YaraLanguageServer(poll_interval=0.01, rescan_interval=0.2)
+    rules_path = tmp_path.joinpath("polled.yara")
+    rules_path.write_text("rule Before { condition: true }\n")
+    session = yarals.ClientSession(None)
+    await yara_server._on_initialize({"params": {"rootUri": tmp_path.as_uri(), "capabilities": {}}}, session)
+    workspace = session.workspace
+    await workspace.indexer
+    await yara_server._watch_workspace(session)
+    assert workspace.poller is not None
+    while not workspace.watched:
+        await asyncio.sleep(0.01)
+    rules_path.write_text("rule AfterPolling { condition: true }\n")
+    tmp_path.joinpath("created.yar").write_text("rule Created { condition: true }\n")
+    # known files are checked on every poll ...
+    for _ in range(10):
+        if "AfterPolling" in workspace.index:
+            break
+        await asyncio.sleep(0.01)
+    assert "Before" not in workspace.index
+    assert "AfterPolling" in workspace.index
+    assert "Created" not in workspace.index
+    # ... but new ones are only found once the whole workspace is searched again
+    for _ in range(100):
+        if "Created" in workspace.index:
+            break
+        await asyncio.sleep(0.01)
+    assert "Created" in workspace.index
+    # the poller stops once the last client leaves
+    yara_server.workspaces.release(workspace)
+    await asyncio.sleep(0)
+    assert workspace.poller.cancelled() is True
+
+@pytest.mark.asyncio
+@pytest.mark.server
+async def test_watched_files_registration(initialized_msg, open_streams, tmp_path, yara_server):
+    ''' Ensure clients that support it are asked to watch rule files for the server '''
+    initialize_msg = json.dumps({
+        "jsonrpc": "2.0", "id": 0, "method": "initialize",
+        "params": {
+            "rootUri": tmp_path.as_uri(),
+            "capabilities": {"workspace": {"didChangeWatchedFiles": {"dynamicRegistration": True}}}
+        }
+    })
+    reader, writer = open_streams
+    await yara_server.write_data(initialize_msg, writer)
+    await yara_server.read_request(reader)
+    await yara_server.write_data(initialized_msg, writer)
+    await yara_server.read_request(reader)
+    request = await yara_server.read_request(reader)
+    assert request["method"] == "client/registerCapability"
+    registration = request["params"]["registrations"][0]
+    assert registration["method"] == "workspace/didChangeWatchedFiles"
+    assert {"globPattern": "**/*.yara"} in registration["registerOptions"]["watchers"]
+    await yara_server.write_data(json.dumps({"jsonrpc": "2.0", "id": request["id"], "result": None}), writer)
+    workspace = yara_server.workspaces.acquire(tmp_path)
+    for _ in range(100):
+        if workspace.watched:
+            break
+        await asyncio.sleep(0.01)
+    assert workspace.watched is True
+    assert workspace.poller is None
+    yara_server.workspaces.release(workspace)
+    writer.close()
+    await writer.wait_closed()
+
 @pytest.mark.asyncio
 @pytest.mark.server
 async def test_exceptions_handled(initialize_msg, initialized_msg, open_streams, test_rules, yara_server):
@@ -349,6 +631,22 @@ async def test_hover(test_rules, yara_server):
     assert result.contents.kind == protocol.MarkupKind.Plaintext
     assert result.contents.value == "\"double string\" wide nocase fullword"
 
+@pytest.mark.asyncio
+@pytest.mark.server
+async def test_hover_rule(test_rules, yara_server):
+    ''' Ensure a rule's declaration is provided on hover '''
+    private_goto_rules = str(test_rules.joinpath("private_rule_goto.yara").resolve())
+    file_uri = helpers.create_file_uri(private_goto_rules)
+    params = {
+        "textDocument": {"uri": file_uri},
+        "position": {"line": 9, "character": 14}
+    }
+    document = yara_server._get_document(file_uri, dirty_files={})
+    result = await yara_server.provide_hover(params, document)
+    assert isinstance(result, protocol.Hover) is True
+    assert result.contents.kind == protocol.MarkupKind.Plaintext
+    assert result.contents.value == "private rule my_private_rule"
+
 @pytest.mark.asyncio
 @pytest.mark.server
 async def test_hover_dirty_file(initialize_msg, initialized_msg, open_streams, test_rules, yara_server):
@@ -356,6 +654,12 @@ async def test_hover_dirty_file(initialize_msg, initialized_msg, open_streams, t
     peek_rules = str(test_rules.joinpath("peek_rules.yara").resolve())
     file_uri = helpers.create_file_uri(peek_rules)
     unsaved_changes = "rule ResolveSymbol {\n strings:\n  $a = \"test\"\n condition:\n  #a > 3\n}\n"
+    did_open_msg = json.dumps({
+        "jsonrpc": "2.0", "method": "textDocument/didOpen",
+        "params": {
+            "textDocument": {"uri": file_uri, "languageId": "yara", "version": 0, "text": Path(peek_rules).read_text()}
+        }
+    })
     did_change_msg = json.dumps({
         "jsonrpc": "2.0", "method": "textDocument/didChange",
         "params": {
@@ -375,6 +679,7 @@ async def test_hover_dirty_file(initialize_msg, initialized_msg, open_streams, t
     await yara_server.read_request(reader)
     await yara_server.write_data(initialized_msg, writer)
     await yara_server.read_request(reader)
+    await yara_server.write_data(did_open_msg, writer)
     await yara_server.write_data(did_change_msg, writer)
     await yara_server.write_data(hover_msg, writer)
     response = await yara_server.read_request(reader)
@@ -384,6 +689,120 @@ async def test_hover_dirty_file(initialize_msg, initialized_msg, open_streams, t
     writer.close()
     await writer.wait_closed()
 
+@pytest.mark.asyncio
+@pytest.mark.server
+async def test_hover_incremental_change(initialize_msg, initialized_msg, open_streams, test_rules, yara_server):
+    ''' Ensure hovers reflect ranged edits applied on top of the opened document '''
+    peek_rules = str(test_rules.joinpath("peek_rules.yara").resolve())
+    file_uri = helpers.create_file_uri(peek_rules)
+    did_open_msg = json.dumps({
+        "jsonrpc": "2.0", "method": "textDocument/didOpen",
+        "params": {
+            "textDocument": {"uri": file_uri, "languageId": "yara", "version": 1, "text": Path(peek_rules).read_text()}
+        }
+    })
+    did_change_msg = json.dumps({
+        "jsonrpc": "2.0", "method": "textDocument/didChange",
+        "params": {
+            "textDocument": {"uri": file_uri, "version": 2},
+            "contentChanges": [{
+                "range": {"start": {"line": 21, "character": 20}, "end": {"line": 21, "character": 33}},
+                "text": "changed"
+            }]
+        }
+    })
+    hover_msg = json.dumps({
+        "jsonrpc": "2.0", "method": "textDocument/hover", "id": 2,
+        "params": {
+            "textDocument": {"uri": file_uri},
+            "position": {"line": 29, "character": 12}
+        }
+    })
+    reader, writer = open_streams
+    await yara_server.write_data(initialize_msg, writer)
+    await yara_server.read_request(reader)
+    await yara_server.write_data(initialized_msg, writer)
+    await yara_server.read_request(reader)
+    await yara_server.write_data(did_open_msg, writer)
+    await yara_server.write_data(did_change_msg, writer)
+    await yara_server.write_data(hover_msg, writer)
+    response = await yara_server.read_request(reader)
+    assert response["result"]["contents"]["value"] == "\"changed\" wide nocase fullword"
+    writer.close()
+    await writer.wait_closed()
+
+@pytest.mark.asyncio
+@pytest.mark.server
+async def test_hover_before_change(init_server, open_streams, yara_server):
+    ''' Ensure requests are answered against the text they were sent with, even if it changes before they run '''
+    file_uri = "file:///tmp/snapshot.yara"
+    text = "rule Snapshot { strings: $a = \"hello\" condition: $a }"
+    messages = [
+        {"jsonrpc": "2.0", "method": "textDocument/didOpen", "params": {
+            "textDocument": {"uri": file_uri, "languageId": "yara", "version": 0, "text": ""}
+        }},
+        {"jsonrpc": "2.0", "method": "textDocument/didChange", "params": {
+            "textDocument": {"uri": file_uri, "version": 1},
+            "contentChanges": [{"text": text}]
+        }},
+        {"jsonrpc": "2.0", "method": "textDocument/hover", "id": 1, "params": {
+            "textDocument": {"uri": file_uri},
+            "position": {"line": 0, "character": text.rindex("$a") + 1}
+        }},
+        {"jsonrpc": "2.0", "method": "textDocument/didChange", "params": {
+            "textDocument": {"uri": file_uri, "version": 2},
+            "contentChanges": [{"range": {"start": {"line": 0, "character": 0}, "end": {"line": 0, "character": 0}}, "text": "\n"}]
+        }}
+    ]
+    reader, writer = open_streams
+    await init_server(reader, writer, yara_server)
+    # send everything at once, so the last change is read before the hover is answered
+    writer.write(b"".join(b"Content-Length: %d\r\n\r\n%s" % (len(body), body) for body in (json.dumps(message).encode("utf-8") for message in messages)))
+    await writer.drain()
+    response = await yara_server.read_request(reader)
+    assert response["id"] == 1
+    assert response["result"]["contents"]["value"] == "\"hello\""
+    writer.close()
+    await writer.wait_closed()
+
+@pytest.mark.asyncio
+@pytest.mark.server
+async def test_hover_unsaved_file(init_server, open_streams, yara_server):
+    ''' Ensure edits to a buffer that was never saved apply to the opened text, and bad messages don't end the session '''
+    file_uri = "untitled:Untitled-1"
+    messages = [
+        {"jsonrpc": "2.0", "method": "textDocument/didOpen", "params": {
+            "textDocument": {"uri": file_uri, "languageId": "yara", "version": 1, "text": "rule Unsaved {\n strings:\n  $a = \"old\"\n condition:\n  $a\n}\n"}
+        }},
+        # changes to documents that were never opened are ignored
+        {"jsonrpc": "2.0", "method": "textDocument/didChange", "params": {
+            "textDocument": {"uri": "file:///tmp/never_opened.yara", "version": 1},
+            "contentChanges": [{"range": {"start": {"line": 0, "character": 0}, "end": {"line": 0, "character": 0}}, "text": "x"}]
+        }},
+        # ... and so are malformed ones
+        {"jsonrpc": "2.0", "method": "textDocument/didChange", "params": {
+            "textDocument": {"uri": file_uri, "version": 2},
+            "contentChanges": [{"range": {"start": {}}, "text": "x"}]
+        }},
+        {"jsonrpc": "2.0", "method": "textDocument/didChange", "params": {
+            "textDocument": {"uri": file_uri, "version": 3},
+            "contentChanges": [{"range": {"start": {"line": 2, "character": 8}, "end": {"line": 2, "character": 11}}, "text": "new"}]
+        }},
+        {"jsonrpc": "2.0", "method": "textDocument/hover", "id": 2, "params": {
+            "textDocument": {"uri": file_uri},
+            "position": {"line": 4, "character": 3}
+        }}
+    ]
+    reader, writer = open_streams
+    await init_server(reader, writer, yara_server)
+    for message in messages:
+        await yara_server.write_data(json.dumps(message), writer)
+    response = await yara_server.read_request(reader)
+    assert response["id"] == 2
+    assert response["result"]["contents"]["value"] == "\"new\""
+    writer.close()
+    await writer.wait_closed()
+
 @pytest.mark.asyncio
 @pytest.mark.server
 async def test_no_hover(test_rules, yara_server):
@@ -405,9 +824,9 @@ async def test_initialize(initialize_msg, initialized_msg, open_streams, yara_se
     expected_initialize = {
         "jsonrpc": "2.0", "id": 0, "result":{
             "capabilities": {
-                "completionProvider":{"resolveProvider": False, "triggerCharacters": ["."]},
+                "completionProvider":{"resolveProvider": False, "triggerCharacters": [".", "$", "#", "@", "!"]},
                 "definitionProvider": True, "hoverProvider": True, "renameProvider": True,
-                "referencesProvider": True, "textDocumentSync": 1,
+                "referencesProvider": True, "textDocumentSync": 2,
                 "executeCommandProvider": {"commands": ["yara.CompileRule", "yara.CompileAllRules"]}
             }
         }
@@ -471,6 +890,83 @@ async def test_references_rules(test_rules, yara_server):
             assert location.range.end.line == 42
             assert location.range.end.char == 21
 
+@pytest.mark.asyncio
+@pytest.mark.server
+async def test_references_workspace(yara_server):
+    ''' Ensure references to a rule are found in every file of the workspace, with unsaved edits taking precedence '''
+    yara_server.workspace.index.update(TextDocument("file:///base.yara", "rule Base { condition: true }"))
+    yara_server.workspace.index.update(TextDocument("file:///other.yara", "rule Other { condition: Base and\n  not Base }"))
+    yara_server.workspace.index.update(TextDocument("file:///stale.yara", "rule Stale { condition: Base }"))
+    document = "rule Current { condition: Base }"
+    params = {
+        "textDocument": {"uri": "file:///current.yara"},
+        "position": {"line": 0, "character": 28},
+        "context": {"includeDeclaration": True}
+    }
+    dirty_files = {"file:///stale.yara": TextDocument("file:///stale.yara", "rule Stale { condition: true }")}
+    result = await yara_server.provide_reference(params, document, dirty_files=dirty_files)
+    # the document being edited comes first
+    assert [(location.uri, location.range.start.line, location.range.start.char) for location in result] == [
+        ("file:///current.yara", 0, 26),
+        ("file:///base.yara", 0, 5),
+        ("file:///other.yara", 0, 24),
+        ("file:///other.yara", 1, 6)
+    ]
+    # renames only edit the document they were requested in
+    params["newName"] = "Renamed"
+    edits = await yara_server.provide_rename(params, document, "file:///current.yara")
+    assert len(edits.changes) == 1
+
+@pytest.mark.asyncio
+@pytest.mark.server
+async def test_references_open_document(init_server, open_streams, yara_server):
+    ''' Ensure references and renames in an edited document find every use of the rule asked for, and nothing else '''
+    file_uri = "file:///tmp/open.yara"
+    messages = [
+        {"jsonrpc": "2.0", "method": "textDocument/didOpen", "params": {
+            "textDocument": {"uri": file_uri, "languageId": "yara", "version": 1, "text": "rule A { condition: true }\nrule B { condition: A }\n"}
+        }},
+        {"jsonrpc": "2.0", "method": "textDocument/didChange", "params": {
+            "textDocument": {"uri": file_uri, "version": 2},
+            "contentChanges": [{"range": {"start": {"line": 2, "character": 0}, "end": {"line": 2, "character": 0}}, "text": "rule C { condition: B and A }"}]
+        }},
+        {"jsonrpc": "2.0", "method": "textDocument/references", "id": 2, "params": {
+            "textDocument": {"uri": file_uri},
+            "position": {"line": 0, "character": 5},
+            "context": {"includeDeclaration": True}
+        }},
+        {"jsonrpc": "2.0", "method": "textDocument/rename", "id": 3, "params": {
+            "textDocument": {"uri": file_uri},
+            "position": {"line": 1, "character": 5},
+            "newName": "Renamed"
+        }}
+    ]
+    reader, writer = open_streams
+    await init_server(reader, writer, yara_server)
+    for message in messages:
+        await yara_server.write_data(json.dumps(message), writer)
+    responses = {}
+    while len(responses) < 2:
+        response = await yara_server.read_request(reader)
+        # skip notifications, such as diagnostics
+        if "method" not in response:
+            responses[response["id"]] = response["result"]
+
+    def _span(line: int, start: int, end: int) -> dict:
+        return {"start": {"line": line, "character": start}, "end": {"line": line, "character": end}}
+
+    assert responses[2] == [
+        {"uri": file_uri, "range": _span(0, 5, 6)},
+        {"uri": file_uri, "range": _span(1, 20, 21)},
+        {"uri": file_uri, "range": _span(2, 26, 27)}
+    ]
+    assert responses[3] == {"changes": {file_uri: [
+        {"range": _span(1, 5, 6), "newText": "Renamed"},
+        {"range": _span(2, 20, 21), "newText": "Renamed"}
+    ]}}
+    writer.close()
+    await writer.wait_closed()
+
 @pytest.mark.asyncio
 @pytest.mark.server
 async def test_references_variable(test_rules, yara_server):
@@ -570,3 +1066,98 @@ async def test_shutdown(caplog, initialize_msg, initialized_msg, open_streams, s
         assert ("yara", logging.INFO, "Client requested shutdown") in caplog.record_tuples
     writer.close()
     await writer.wait_closed()
+
+@pytest.mark.asyncio
+@pytest.mark.server
+async def test_diagnostics_cached(yara_server):
+    ''' Ensure unchanged documents are only compiled once '''
+    document = "rule OneDiagnostic { condition: $true }"
+    first = await yara_server.provide_diagnostic(document)
+    second = await yara_server.provide_diagnostic(document)
+    assert first == second
+    assert first is not second
+    info = yara_server.compile_cache.info()
+    assert info.misses == 1
+    assert info.hits == 1
+    await yara_server.provide_diagnostic(document, externals={"ext": 1})
+    assert yara_server.compile_cache.info().misses == 2
+
+@pytest.mark.asyncio
+@pytest.mark.server
+async def test_diagnostics_nonblocking(test_rules, yara_server):
+    ''' Ensure other providers keep responding while a large ruleset compiles '''
+    ruleset = "\n".join("rule Rule{0:d} {{ strings: $a = /ab[c-f]{{2,8}}x{0:d}/ condition: $a }}".format(i) for i in range(20000))
+    peek_rules = str(test_rules.joinpath("peek_rules.yara").resolve())
+    file_uri = helpers.create_file_uri(peek_rules)
+    params = {
+        "textDocument": {"uri": file_uri},
+        "position": {"line": 29, "character": 12}
+    }
+    document = yara_server._get_document(file_uri, dirty_files={})
+    compiling = asyncio.ensure_future(yara_server.provide_diagnostic(ruleset))
+    hover = asyncio.ensure_future(yara_server.provide_hover(params, document))
+    done, _ = await asyncio.wait([compiling, hover], return_when=asyncio.FIRST_COMPLETED)
+    assert done == {hover}
+    assert compiling.done() is False
+    assert await compiling == []
+
+@pytest.mark.asyncio
+@pytest.mark.server
+async def test_cancel_request(init_server, open_streams, yara_server):
+    ''' Ensure cancelled requests are answered with a REQUEST_CANCELLED error '''
+    started = asyncio.Event()
+    async def _slow_request(message, session, snapshot=None):
+        started.set()
+        await asyncio.sleep(10)
+    yara_server.handlers["textDocument/hover"] = yara_server.handlers["textDocument/hover"]._replace(callback=_slow_request)
+    reader, writer = open_streams
+    await init_server(reader, writer, yara_server)
+    request = json.dumps({"jsonrpc": "2.0", "id": 5, "method": "textDocument/hover", "params": {}})
+    cancel = json.dumps({"jsonrpc": "2.0", "method": "$/cancelRequest", "params": {"id": 5}})
+    await yara_server.write_data(request, writer)
+    await started.wait()
+    await yara_server.write_data(cancel, writer)
+    response = await asyncio.wait_for(yara_server.read_request(reader), timeout=2)
+    assert response["id"] == 5
+    assert response["error"]["code"] == protocol.JsonRPCError.REQUEST_CANCELLED
+    writer.close()
+    await writer.wait_closed()
+
+@pytest.mark.asyncio
+@pytest.mark.server
+async def test_concurrent_requests(init_server, open_streams, yara_server):
+    ''' Ensure a slow request doesn't hold up the requests after it '''
+    async def _request(message, session, snapshot=None):
+        if message["id"] == 1:
+            await asyncio.sleep(0.5)
+        return message["id"]
+    yara_server.handlers["textDocument/hover"] = yara_server.handlers["textDocument/hover"]._replace(callback=_request)
+    reader, writer = open_streams
+    await init_server(reader, writer, yara_server)
+    for request_id in (1, 2):
+        request = json.dumps({"jsonrpc": "2.0", "id": request_id, "method": "textDocument/hover", "params": {}})
+        await yara_server.write_data(request, writer)
+    first = await yara_server.read_request(reader)
+    second = await yara_server.read_request(reader)
+    assert (first["id"], first["result"]) == (2, 2)
+    assert (second["id"], second["result"]) == (1, 1)
+    writer.close()
+    await writer.wait_closed()
+
+@pytest.mark.asyncio
+@pytest.mark.server
+async def test_unsupported_method(init_server, open_streams, yara_server):
+    ''' Ensure requests for unknown methods are rejected, and every handled method is measured '''
+    reader, writer = open_streams
+    await init_server(reader, writer, yara_server)
+    request = json.dumps({"jsonrpc": "2.0", "id": 7, "method": "textDocument/codeLens", "params": {}})
+    await yara_server.write_data(request, writer)
+    response = await yara_server.read_request(reader)
+    assert response["id"] == 7
+    assert response["error"]["code"] == protocol.JsonRPCError.METHOD_NOT_FOUND
+    assert "textDocument/codeLens" not in yara_server.metrics
+    summary = yara_server.metrics.summary()
+    assert summary["initialize"]["count"] == 1
+    assert summary["initialized"]["count"] == 1
+    writer.close()
+    await writer.wait_closed()
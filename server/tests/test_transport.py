@@ -1,7 +1,11 @@
 ''' Test the various transport mechanisms used between client and server
-    Currently only TCP is supported, though ideally anything supported by
+    TCP and stdio are supported, though ideally anything supported by
     the asyncio library will be fully integrated and tested in the future
 '''
+import asyncio
+from pathlib import Path
+import sys
+
 import pytest
 
 
@@ -22,3 +26,99 @@ async def test_tcp_opened(open_streams):
     assert reader.at_eof() is False
     writer.close()
     await writer.wait_closed()
+
+class _BufferWriter(object):
+    ''' Collect everything written to a stream '''
+    def __init__(self):
+        self.data = b""
+
+    def write(self, data: bytes):
+        self.data += data
+
+    async def drain(self):
+        pass
+
+@pytest.mark.asyncio
+@pytest.mark.transport
+async def test_read_request_headers(yara_server):
+    ''' Ensure headers are parsed in any order, and the body is read by its length in bytes '''
+    body = '{"jsonrpc": "2.0", "method": "test", "params": {"text": "règle ☃"}}'.encode("utf-8")
+    reader = asyncio.StreamReader()
+    reader.feed_data(b"Content-Type: application/vscode-jsonrpc; charset=utf-8\r\n")
+    reader.feed_data(b"content-length: %d\r\n\r\n" % len(body) + body)
+    reader.feed_data(b"Content-Length: 2\r\n\r\n{}")
+    reader.feed_eof()
+    request = await yara_server.read_request(reader)
+    assert request["params"]["text"] == "règle ☃"
+    assert await yara_server.read_request(reader) == {}
+    # nothing left to read once the client disconnects
+    assert await yara_server.read_request(reader) == {}
+
+@pytest.mark.asyncio
+@pytest.mark.transport
+async def test_write_data_length(yara_server):
+    ''' Ensure Content-Length counts bytes rather than characters, so non-ASCII text can't corrupt the stream '''
+    writer = _BufferWriter()
+    await yara_server.send_notification("test", {"text": "règle ☃"}, writer)
+    await yara_server.write_data('{"text": "☃"}', writer)
+    reader = asyncio.StreamReader()
+    reader.feed_data(writer.data)
+    reader.feed_eof()
+    notification = await yara_server.read_request(reader)
+    assert notification["params"]["text"] == "règle ☃"
+    assert await yara_server.read_request(reader) == {"text": "☃"}
+
+@pytest.mark.asyncio
+@pytest.mark.subprocess
+@pytest.mark.transport
+async def test_stdio(yara_server, cache_dir, initialize_msg, initialized_msg, shutdown_msg):
+    ''' Ensure the server can be driven entirely over its stdin and stdout, and exits when asked '''
+    script = Path(__file__).parent.parent.joinpath("vscode_yara.py")
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable, str(script), "--stdio",
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.DEVNULL
+    )
+    try:
+        await yara_server.write_data(initialize_msg, proc.stdin)
+        response = await asyncio.wait_for(yara_server.read_request(proc.stdout), 10)
+        assert "capabilities" in response["result"]
+        await yara_server.write_data(initialized_msg, proc.stdin)
+        notification = await asyncio.wait_for(yara_server.read_request(proc.stdout), 10)
+        assert notification["method"] == "window/showMessageRequest"
+        await yara_server.write_data(shutdown_msg, proc.stdin)
+        response = await asyncio.wait_for(yara_server.read_request(proc.stdout), 10)
+        assert response == {"jsonrpc": "2.0", "id": 1, "result": {}}
+        await yara_server.write_data('{"jsonrpc": "2.0", "method": "exit"}', proc.stdin)
+        assert await asyncio.wait_for(proc.wait(), 10) == 0
+    finally:
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+
+@pytest.mark.asyncio
+@pytest.mark.subprocess
+@pytest.mark.transport
+async def test_tcp_announce(yara_server, cache_dir, initialize_msg):
+    ''' Ensure a server bound to port 0 prints the address it is listening on, ready to be connected to '''
+    script = Path(__file__).parent.parent.joinpath("vscode_yara.py")
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable, str(script), "127.0.0.1", "0",
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.DEVNULL
+    )
+    try:
+        line = await asyncio.wait_for(proc.stdout.readline(), 10)
+        host, port = line.decode("utf-8").strip().rsplit(":", 1)
+        assert host == "127.0.0.1"
+        assert int(port) > 0
+        reader, writer = await asyncio.open_connection(host, int(port))
+        await yara_server.write_data(initialize_msg, writer)
+        response = await asyncio.wait_for(yara_server.read_request(reader), 10)
+        assert "capabilities" in response["result"]
+        writer.close()
+        await writer.wait_closed()
+    finally:
+        proc.kill()
+        await proc.wait()
@@ -0,0 +1,63 @@
+''' Tests for yarals.workspace module '''
+import pytest
+from yarals import workspace
+
+
+@pytest.mark.workspace
+def test_workspace_files(tmp_path):
+    ''' Ensure every YARA rule file under the root is found '''
+    tmp_path.joinpath("nested").mkdir()
+    tmp_path.joinpath("one.yara").write_text("rule One { condition: true }")
+    tmp_path.joinpath("nested", "two.yar").write_text("rule Two { condition: true }")
+    tmp_path.joinpath("notes.txt").write_text("rule Three { condition: true }")
+    folder = workspace.Workspace(tmp_path)
+    assert sorted(file.name for file in folder.files()) == ["one.yara", "two.yar"]
+    assert sorted(file_uri for file_uri, _ in folder.stat_files()) == [
+        tmp_path.joinpath("nested", "two.yar").as_uri(), tmp_path.joinpath("one.yara").as_uri()
+    ]
+    assert list(workspace.Workspace().files()) == []
+
+@pytest.mark.workspace
+def test_workspace_pool_shared(tmp_path):
+    ''' Ensure clients opening the same folder share a workspace until the last one leaves '''
+    pool = workspace.WorkspacePool()
+    first = pool.acquire(str(tmp_path))
+    # different spellings of the same folder are the same workspace
+    second = pool.acquire(tmp_path.joinpath("..", tmp_path.name))
+    assert first is second
+    assert first.clients == 2
+    assert len(pool) == 1
+    pool.release(first)
+    assert tmp_path in pool
+    pool.release(second)
+    assert tmp_path not in pool
+    assert len(pool) == 0
+    # a new client starts from scratch
+    assert pool.acquire(tmp_path) is not first
+
+@pytest.mark.workspace
+def test_workspace_pool_rootless():
+    ''' Ensure clients without a workspace folder each get their own, untracked workspace '''
+    pool = workspace.WorkspacePool()
+    first = pool.acquire(None)
+    second = pool.acquire("")
+    assert first is not second
+    assert first.root is None
+    assert len(pool) == 0
+    pool.release(first)
+    assert first.clients == 0
+
+@pytest.mark.workspace
+def test_workspace_watched(tmp_path):
+    ''' Ensure watched workspaces list the files they already know about instead of searching again '''
+    tmp_path.joinpath("one.yara").write_text("rule One { condition: true }")
+    folder = workspace.Workspace(tmp_path)
+    assert list(folder.snapshot()) == [tmp_path.joinpath("one.yara").as_uri()]
+    folder.known_files = {tmp_path.joinpath("one.yara")}
+    folder.watched = True
+    tmp_path.joinpath("two.yara").write_text("rule Two { condition: true }")
+    assert [file_uri for file_uri, _ in folder.stat_files()] == [tmp_path.joinpath("one.yara").as_uri()]
+    # new files are still found by the poller
+    assert len(folder.snapshot()) == 2
+    # ... which can also check just the files it already knows about
+    assert list(folder.snapshot([tmp_path.joinpath("two.yara"), tmp_path.joinpath("deleted.yara")])) == [tmp_path.joinpath("two.yara").as_uri()]
@@ -4,15 +4,27 @@ import asyncio
 import json
 import logging
 import logging.handlers
+import os
 from pathlib import Path
+import sys
+import threading
 
+from yarals import custom_err as ce
+from yarals import protocol
+from yarals.recorder import SessionRecorder
 from yarals.yarals import YaraLanguageServer
 
 
 def _build_cli():
     parser = argparse.ArgumentParser(description="Start the vscode-yara language server")
-    parser.add_argument("host", help="Interface to bind server to")
-    parser.add_argument("port", type=int, help="Port to bind server to")
+    parser.add_argument("host", nargs="?", default="127.0.0.1", help="Interface to bind server to")
+    parser.add_argument("port", nargs="?", type=int, default=0, help="Port to bind server to. 0 picks any free port")
+    parser.add_argument("--stdio", action="store_true", help="Talk to a single client over stdin and stdout instead of TCP")
+    parser.add_argument("--compile-workers", type=int, default=None, help="Number of threads to compile rules with")
+    parser.add_argument("--poll-interval", type=float, default=2.0, help="Seconds between checking for changed files when the client can't watch them. 0 disables polling")
+    parser.add_argument("--rescan-interval", type=float, default=60.0, help="Seconds between searching the whole workspace for new files while polling")
+    parser.add_argument("--record", type=Path, default=None, help="Append every message to and from clients to this file, to replay later")
+    parser.add_argument("--debug", action="store_true", help="Type-check every protocol object the server creates")
     return parser.parse_args()
 
 def _build_logger():
@@ -34,25 +46,120 @@ def _build_logger():
     logger.setLevel(logging.DEBUG)
     return logger
 
-async def main():
-    ''' Program entrypoint '''
-    args = _build_cli()
-    yarals = YaraLanguageServer()
-    logger.info("Starting YARA IO language server")
+class _StdoutTransport(asyncio.WriteTransport):
+    def __init__(self, protocol: asyncio.Protocol, loop: asyncio.AbstractEventLoop):
+        ''' Write straight through to stdout, for when the event loop can't wrap it in a pipe transport '''
+        super().__init__()
+        self._closing = False
+        self._loop = loop
+        self._protocol = protocol
+        self._protocol.connection_made(self)
+
+    def write(self, data: bytes):
+        sys.stdout.buffer.write(data)
+        sys.stdout.buffer.flush()
+
+    def can_write_eof(self) -> bool:
+        return False
+
+    def is_closing(self) -> bool:
+        return self._closing
+
+    def close(self):
+        if not self._closing:
+            self._closing = True
+            self._loop.call_soon(self._protocol.connection_lost, None)
+
+def _read_stdin(loop: asyncio.AbstractEventLoop, reader: asyncio.StreamReader):
+    ''' Feed stdin to a stream reader until the client closes it '''
+    try:
+        while True:
+            data = os.read(sys.stdin.fileno(), 65536)
+            if not data:
+                loop.call_soon_threadsafe(reader.feed_eof)
+                return
+            loop.call_soon_threadsafe(reader.feed_data, data)
+    except (OSError, RuntimeError):
+        # stdin went away, or the server already stopped
+        return
+
+async def _open_stdio_streams():
+    ''' Wrap stdin and stdout in the same stream objects a TCP client gets '''
+    loop = asyncio.get_running_loop()
+    if sys.platform == "win32":
+        # the pipes a spawned process is given on Windows can't be reliably wrapped by either event loop,
+        # so stdin is read on its own thread, and stdout is written to directly
+        reader = asyncio.StreamReader()
+        threading.Thread(target=_read_stdin, args=(loop, reader), name="stdin", daemon=True).start()
+        write_protocol = asyncio.StreamReaderProtocol(asyncio.StreamReader())
+        writer = asyncio.StreamWriter(_StdoutTransport(write_protocol, loop), write_protocol, reader, loop)
+        return reader, writer
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    # StreamReaderProtocol is also what lets the writer drain and wait to be closed
+    transport, write_protocol = await loop.connect_write_pipe(lambda: asyncio.StreamReaderProtocol(asyncio.StreamReader()), sys.stdout)
+    writer = asyncio.StreamWriter(transport, write_protocol, reader, loop)
+    return reader, writer
+
+async def serve_stdio(yarals: YaraLanguageServer):
+    ''' Answer the client that launched this process until it disconnects or asks the server to exit '''
+    reader, writer = await _open_stdio_streams()
+    logger.info("Serving on stdio")
+    try:
+        await yarals.handle_client(reader, writer)
+    except ce.ServerExit:
+        pass
+    logger.info("Server has successfully shutdown")
+
+def _announce_address(host: str, port: int):
+    '''Tell whoever launched the server where it is listening
+
+    Printed as a single "host:port" line on stdout, with IPv6 addresses in brackets
+
+    :host: Address the server is bound to
+    :port: Port the server is bound to
+    '''
+    if ":" in host:
+        host = "[{}]".format(host)
+    print("{}:{:d}".format(host, port), flush=True)
+
+async def serve_tcp(yarals: YaraLanguageServer, host: str, port: int):
+    ''' Answer any number of clients connecting to the given interface and port '''
     socket_server = await asyncio.start_server(
         client_connected_cb=yarals.handle_client,
-        host=args.host,
-        port=args.port,
+        host=host,
+        port=port,
         start_serving=False
     )
-    servhost, servport = socket_server.sockets[0].getsockname()
-    logger.info("Serving on tcp://%s:%d", servhost, servport)
     try:
         async with socket_server:
+            # start listening before announcing the port, so the launcher can connect as soon as it reads it
+            await socket_server.start_serving()
+            servhost, servport = socket_server.sockets[0].getsockname()[:2]
+            logger.info("Serving on tcp://%s:%d", servhost, servport)
+            _announce_address(servhost, servport)
             await socket_server.serve_forever()
     except asyncio.CancelledError:
         logger.info("Server has successfully shutdown")
 
+async def main():
+    ''' Program entrypoint '''
+    args = _build_cli()
+    protocol.VALIDATE = args.debug
+    yarals = YaraLanguageServer(compile_workers=args.compile_workers, poll_interval=args.poll_interval, rescan_interval=args.rescan_interval)
+    if args.record:
+        yarals.recorder = SessionRecorder(args.record)
+        logger.info("Recording client sessions to %s", args.record)
+    logger.info("Starting YARA IO language server")
+    try:
+        if args.stdio:
+            await serve_stdio(yarals)
+        else:
+            await serve_tcp(yarals, args.host, args.port)
+    finally:
+        if yarals.recorder is not None:
+            yarals.recorder.close()
+
 try:
     logger = _build_logger()
     asyncio.run(main(), debug=True)
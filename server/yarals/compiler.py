@@ -0,0 +1,132 @@
+''' Compile YARA rules into diagnostics, caching results by content '''
+from collections import namedtuple, OrderedDict
+import hashlib
+import importlib.util
+import json
+import threading
+from typing import Union
+
+from yarals import helpers
+from yarals import protocol as lsp
+from yarals.documents import TextDocument, get_document
+
+# yara-python is only imported the first time something is compiled,
+# so sessions that never compile don't pay to load it
+HAS_YARA = importlib.util.find_spec("yara") is not None
+_yara = None
+
+
+# result of a single compilation. "rules" is only populated when the cache keeps compiled rules around
+CompileResult = namedtuple("CompileResult", ["diagnostics", "rules"])
+# mirrors functools.lru_cache().cache_info()
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize"])
+
+
+def get_yara():
+    ''' Import yara-python on first use '''
+    global _yara
+    if _yara is None:
+        import yara
+        _yara = yara
+    return _yara
+
+def get_yara_version() -> str:
+    ''' Get the installed yara-python version, or None if it is not installed '''
+    return get_yara().__version__ if HAS_YARA else None
+
+def compile_document(document: Union[str, TextDocument], externals: dict=None, keep_rules: bool=False) -> CompileResult:
+    '''Compile a document, converting any errors or warnings into diagnostics
+
+    Safe to call from worker threads as long as the document is not edited
+    concurrently, so callers on the event loop should pass a snapshot of the text
+
+    :document: Text or TextDocument to compile
+    :externals: (Optional) External variables to define for the rules
+    :keep_rules: (Optional) Return the compiled yara.Rules object along with the diagnostics
+    '''
+    document = get_document(document)
+    diagnostics = []
+    rules = None
+    yara = get_yara()
+    try:
+        rules = yara.compile(source=document.text, externals=externals or {})
+    except yara.SyntaxError as error:
+        diagnostics.append(_make_diagnostic(document, str(error), lsp.DiagnosticSeverity.ERROR))
+    except yara.WarningError as warning:
+        diagnostics.append(_make_diagnostic(document, str(warning), lsp.DiagnosticSeverity.WARNING))
+    return CompileResult(diagnostics=diagnostics, rules=rules if keep_rules else None)
+
+def _make_diagnostic(document: TextDocument, result: str, severity: int) -> lsp.Diagnostic:
+    ''' Build a diagnostic covering the line a compilation error or warning points to '''
+    line_no, msg = helpers.parse_result(result)
+    # VSCode is zero-indexed
+    line_no -= 1
+    first_char = helpers.get_first_non_whitespace_index(document.line(line_no))
+    symbol_range = lsp.Range(
+        start=lsp.Position(line_no, first_char),
+        end=lsp.Position(line_no, 10000)
+    )
+    return lsp.Diagnostic(locrange=symbol_range, severity=severity, message=msg)
+
+class CompileCache(object):
+    def __init__(self, maxsize: int=256):
+        '''Bounded LRU cache of compilation results
+
+        Entries are keyed by a hash of the rule text, the yara-python version
+        and any externals, so unchanged files are never compiled twice
+
+        :maxsize: (Optional) Maximum number of results to hold on to
+        '''
+        self.maxsize = max(int(maxsize), 0)
+        self.hits = 0
+        self.misses = 0
+        self._results = OrderedDict()
+        # compilations run in worker threads, which may all report results at once
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._results)
+
+    @staticmethod
+    def key(text: str, externals: dict=None) -> str:
+        '''Build the cache key for a given rule text
+
+        :text: Rule text to be compiled
+        :externals: (Optional) External variables the text will be compiled with
+        '''
+        digest = hashlib.sha256(text.encode("utf-8", errors="surrogatepass"))
+        digest.update(str(get_yara_version()).encode("utf-8"))
+        if externals:
+            digest.update(json.dumps(externals, sort_keys=True, default=str).encode("utf-8"))
+        return digest.hexdigest()
+
+    def get(self, key: str) -> CompileResult:
+        ''' Get a cached result, or None if this key has not been compiled '''
+        with self._lock:
+            result = self._results.get(key, None)
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._results.move_to_end(key)
+            return result
+
+    def put(self, key: str, result: CompileResult):
+        ''' Cache a result, evicting the least recently used entries if necessary '''
+        with self._lock:
+            self._results[key] = result
+            self._results.move_to_end(key)
+            while len(self._results) > self.maxsize:
+                self._results.popitem(last=False)
+
+    def clear(self):
+        ''' Drop all cached results and reset the counters '''
+        with self._lock:
+            self._results.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self) -> CacheInfo:
+        ''' Report the cache's hit and miss counts '''
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.maxsize, len(self._results))
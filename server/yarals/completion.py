@@ -0,0 +1,78 @@
+''' Complete module members from a trie built once over the module schema '''
+from bisect import bisect_left
+
+from yarals import protocol as lsp
+
+# schema member types => kind of completion item
+_KINDS = {
+    "enum": lsp.CompletionItemKind.ENUM,
+    "property": lsp.CompletionItemKind.PROPERTY,
+    "method": lsp.CompletionItemKind.METHOD
+}
+
+
+class ModuleNode(object):
+    __slots__ = ("children", "items", "keys", "sorted_items")
+
+    def __init__(self, members: dict, path: str=""):
+        '''A single level of the module schema, such as the members of "pe" or "cuckoo.network"
+
+        Completion items are built once up front, in schema order, along with
+        a case-insensitively sorted copy so prefixes can be found with a binary search
+
+        :members: Member name => member type, or a nested dictionary of members
+        :path: (Optional) Dotted path of this level, used to describe each item
+        '''
+        # member name => ModuleNode for members with members of their own
+        self.children = {}
+        self.items = []
+        for label, member in members.items():
+            detail = "{}.{}".format(path, label) if path else label
+            if isinstance(member, dict):
+                self.children[label] = ModuleNode(member, detail)
+                kind = lsp.CompletionItemKind.CLASS
+            else:
+                kind = _KINDS.get(str(member).lower(), lsp.CompletionItemKind.CLASS)
+                if kind == lsp.CompletionItemKind.METHOD:
+                    detail += "()"
+            self.items.append(lsp.CompletionItem(label, kind, detail=detail, insertText=label))
+        self.sorted_items = sorted(self.items, key=lambda item: item.label.lower())
+        self.keys = [item.label.lower() for item in self.sorted_items]
+
+    def find(self, prefix: str) -> list:
+        '''Get the items starting with a prefix, ignoring case
+
+        :prefix: Partial member name. An empty prefix matches every item, in schema order
+        '''
+        if not prefix:
+            return self.items
+        prefix = prefix.lower()
+        start = end = bisect_left(self.keys, prefix)
+        while end < len(self.keys) and self.keys[end].startswith(prefix):
+            end += 1
+        return self.sorted_items[start:end]
+
+class ModuleTrie(object):
+    def __init__(self, schema: dict):
+        '''Every module's members, indexed by their dotted path
+
+        :schema: Module name => members, as loaded by helpers.load_module_schema()
+        '''
+        self.root = ModuleNode(schema)
+
+    def complete(self, path: list, prefix: str="", limit: int=0) -> lsp.CompletionList:
+        '''Complete the member being typed after a dotted path
+
+        :path: Names before the member being typed, e.g. ["cuckoo", "network"]. Empty to complete module names
+        :prefix: (Optional) Part of the member name typed so far
+        :limit: (Optional) Maximum number of items to return. Longer results are marked incomplete. 0 returns everything
+        '''
+        node = self.root
+        for name in path:
+            node = node.children.get(name, None)
+            if node is None:
+                return lsp.CompletionList([])
+        items = node.find(prefix)
+        if limit > 0 and len(items) > limit:
+            return lsp.CompletionList(items[:limit], isIncomplete=True)
+        return lsp.CompletionList(list(items))
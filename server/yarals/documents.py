@@ -0,0 +1,242 @@
+''' In-memory text documents synchronized with the client '''
+from bisect import bisect_right
+from collections import OrderedDict, namedtuple
+from itertools import accumulate
+import os
+import re
+import threading
+from typing import List, Union
+
+from yarals import parser
+from yarals import protocol as lsp
+
+# every line terminator recognized by the language server protocol
+EOL_PATTERN = re.compile("\r\n|\r|\n")
+# the text and version of an open document at a single point in time
+#   document: TextDocument the snapshot was taken from, which may have been edited since
+DocumentSnapshot = namedtuple("DocumentSnapshot", ["document", "text", "version"])
+
+
+def split_lines(text: str) -> List[str]:
+    '''Split text into lines, keeping each line's terminator
+
+    The last element holds whatever follows the final terminator,
+    so it is an empty string when the text ends with a newline
+
+    :text: Text to split
+    '''
+    lines = []
+    start = 0
+    for match in EOL_PATTERN.finditer(text):
+        lines.append(text[start:match.end()])
+        start = match.end()
+    lines.append(text[start:])
+    return lines
+
+class TextDocument(object):
+    def __init__(self, uri: str, text: str, version: int=0):
+        ''' A text document indexed by line
+
+        Lines are stored with their terminators, so edits only need to
+        rebuild the lines they touch and the full text is only re-joined
+        when something asks for it
+        '''
+        self.uri = uri
+        self.version = version
+        self._lines = split_lines(text)
+        self._text = text
+        # starting offset of each line. Built on demand once per version
+        self._offsets = None
+        self._tree = None
+
+    def __repr__(self):
+        return "<TextDocument(uri={}, version={:d}, lines={:d})>".format(self.uri, self.version, len(self._lines))
+
+    @property
+    def line_count(self) -> int:
+        ''' Number of lines in the document '''
+        return len(self._lines)
+
+    @property
+    def text(self) -> str:
+        ''' Full document text. Joined once per version '''
+        if self._text is None:
+            self._text = "".join(self._lines)
+        return self._text
+
+    @property
+    def tree(self) -> parser.SyntaxTree:
+        ''' Syntax tree for the current version. Only rules touched by edits are re-parsed '''
+        if self._tree is None:
+            self._tree = parser.parse(self)
+        elif self._tree.damaged:
+            self._tree.repair(self)
+        return self._tree
+
+    def snapshot(self) -> DocumentSnapshot:
+        ''' Capture the current text and version, so they can still be used after later edits '''
+        return DocumentSnapshot(self, self.text, self.version)
+
+    def line(self, index: int) -> str:
+        ''' Content of a single line, without its terminator '''
+        return self._lines[index].rstrip("\r\n")
+
+    def offset_at(self, pos: lsp.Position) -> int:
+        ''' Convert a position into an offset in the document text '''
+        offsets = self._line_offsets()
+        line = min(max(pos.line, 0), len(self._lines) - 1)
+        return offsets[line] + min(max(pos.char, 0), len(self.line(line)))
+
+    def position_at(self, offset: int) -> lsp.Position:
+        ''' Convert an offset in the document text into a position '''
+        offsets = self._line_offsets()
+        line = max(bisect_right(offsets, offset) - 1, 0)
+        return lsp.Position(line=line, char=offset - offsets[line])
+
+    def _line_offsets(self) -> List[int]:
+        ''' Lazily build the line-offset table for the current version '''
+        if self._offsets is None:
+            self._offsets = [0]
+            self._offsets.extend(accumulate(len(line) for line in self._lines[:-1]))
+        return self._offsets
+
+    def apply_change(self, change: dict, version: int=None):
+        '''Apply a single TextDocumentContentChangeEvent to this document
+
+        Changes without a range replace the entire document
+
+        :change: Content change sent by the client
+        :version: (Optional) Document version after this change is applied
+        '''
+        new_text = change.get("text", "")
+        locrange = change.get("range", None)
+        if locrange is None:
+            self._lines = split_lines(new_text)
+            self._text = new_text
+            self._tree = None
+        else:
+            start_line, start_char = self._clamp_position(locrange["start"])
+            end_line, end_char = self._clamp_position(locrange["end"])
+            prefix = self._lines[start_line][:start_char]
+            suffix = self._lines[end_line][end_char:]
+            # a "\n" that ends up right after a line ending in a lone "\r" joins its terminator,
+            # so that line has to be split again along with the edited ones. The edited lines
+            # always keep their own terminator, so nothing can join the line after them
+            if start_line > 0 and self._lines[start_line-1].endswith("\r") and (prefix + new_text + suffix).startswith("\n"):
+                start_line -= 1
+                prefix = self._lines[start_line] + prefix
+            replacement = split_lines(prefix + new_text + suffix)
+            if end_line != len(self._lines) - 1:
+                # the suffix keeps the terminator of the edited line, so the
+                # trailing remainder is always empty and belongs to the next line
+                replacement.pop()
+            self._lines[start_line:end_line+1] = replacement
+            self._text = None
+            if self._tree is not None:
+                self._tree.edit(start_line, end_line, len(replacement))
+        self._offsets = None
+        if version is not None:
+            self.version = int(version)
+
+    def _clamp_position(self, position: dict) -> tuple:
+        ''' Limit a client position to the lines and characters that exist in this document '''
+        last = len(self._lines) - 1
+        line = int(position["line"])
+        if line < 0:
+            return 0, 0
+        elif line > last:
+            # anything past the last line is treated as the end of the document
+            return last, len(self._lines[last])
+        length = len(self._lines[line].rstrip("\r\n"))
+        return line, min(max(int(position["character"]), 0), length)
+
+def get_document(document: Union[str, TextDocument], uri: str="") -> TextDocument:
+    '''Wrap raw text in a TextDocument, passing existing documents through as-is
+
+    :document: Document text or an existing TextDocument
+    :uri: (Optional) URI to give newly-wrapped documents
+    '''
+    if isinstance(document, TextDocument):
+        return document
+    return TextDocument(uri, document)
+
+def restore_snapshot(snapshot: DocumentSnapshot) -> TextDocument:
+    '''Get a TextDocument holding the text of a snapshot
+
+    The document the snapshot was taken from is reused, along with its syntax tree,
+    as long as its text is unchanged. Since it may still be edited, it must not be
+    held on to across anything that waits on the event loop
+
+    :snapshot: Snapshot returned by TextDocument.snapshot()
+    '''
+    if snapshot.document.text == snapshot.text:
+        return snapshot.document
+    return TextDocument(snapshot.document.uri, snapshot.text, snapshot.version)
+
+class DocumentCache(object):
+    def __init__(self, maxbytes: int=32 * 2**20):
+        '''Bounded LRU cache of documents read from disk
+
+        Entries are checked against the file's modification time and size on
+        every read, so files changed outside the editor are read again. The
+        cached TextDocuments are shared, so callers must copy them before editing
+
+        :maxbytes: (Optional) Maximum combined size (on disk) of the files to hold on to
+        '''
+        self.maxbytes = max(int(maxbytes), 0)
+        self.currbytes = 0
+        self.hits = 0
+        self.misses = 0
+        # path => (mtime, size, TextDocument)
+        self._documents = OrderedDict()
+        # files are also read from worker threads
+        self._lock = threading.Lock()
+
+    def __contains__(self, path: str) -> bool:
+        return path in self._documents
+
+    def __len__(self) -> int:
+        return len(self._documents)
+
+    def read(self, path: str, uri: str) -> TextDocument:
+        '''Get the document stored at a path, reading it only if it changed since it was cached
+
+        :path: Location of the file on disk
+        :uri: URI to give the document
+        '''
+        stat = os.stat(path)
+        with self._lock:
+            entry = self._documents.get(path, None)
+            if entry is not None and entry[:2] == (stat.st_mtime_ns, stat.st_size) and entry[2].uri == uri:
+                self.hits += 1
+                self._documents.move_to_end(path)
+                return entry[2]
+            self.misses += 1
+        # the file is stat()ed first, so a write in between only makes the entry look older than it is
+        with open(path, "r") as rule_file:
+            document = TextDocument(uri, rule_file.read())
+        with self._lock:
+            self._discard(path)
+            if stat.st_size <= self.maxbytes:
+                self._documents[path] = (stat.st_mtime_ns, stat.st_size, document)
+                self.currbytes += stat.st_size
+                while self.currbytes > self.maxbytes:
+                    self._discard(next(iter(self._documents)))
+        return document
+
+    def invalidate(self, path: str=None):
+        '''Forget a cached file, or every file if no path is given
+
+        :path: (Optional) Location of the file on disk
+        '''
+        with self._lock:
+            if path is None:
+                self._documents.clear()
+                self.currbytes = 0
+            else:
+                self._discard(path)
+
+    def _discard(self, path: str):
+        entry = self._documents.pop(path, None)
+        if entry is not None:
+            self.currbytes -= entry[1]
@@ -1,12 +1,40 @@
 ''' Helper functions that don't quite fit elsewhere '''
+from functools import lru_cache
+import json
+import os
+from pathlib import Path
+import pickle
 import platform
-import re
-from typing import Tuple
+from typing import Tuple, Union
 from urllib.parse import quote, unquote, urlsplit
-from urllib.request import url2pathname
 
 from yarals import protocol as lsp
+from yarals.documents import TextDocument, get_document
 
+# this is what urllib.request picks, without paying for importing urllib.request (and ssl, http, email...)
+if os.name == "nt":
+    from nturl2path import url2pathname
+else:
+    url2pathname = unquote
+
+MODULE_SCHEMA = Path(__file__).parent.joinpath("data", "modules.json")
+
+
+def compile_module_schema(path: Path=MODULE_SCHEMA) -> Path:
+    '''Pickle a module schema next to its JSON source, so it can be loaded without parsing JSON
+
+    Run this whenever the schema changes:
+        python3 -c "from yarals import helpers; helpers.compile_module_schema()"
+
+    :path: (Optional) JSON schema to compile
+    '''
+    path = Path(path)
+    with path.open("r", encoding="utf-8") as schema_file:
+        schema = json.load(schema_file)
+    compiled_path = path.with_suffix(".pickle")
+    # protocol 4 can be read by every Python version the server supports
+    compiled_path.write_bytes(pickle.dumps(schema, protocol=4))
+    return compiled_path
 
 def create_file_uri(path: str):
     '''Create a URI given a file path
@@ -26,34 +54,45 @@ def get_first_non_whitespace_index(line: str) -> int:
             # self._logger.debug("first char is {} at position {:d}".format(char, index))
             return index
 
-def get_rule_range(document: str, pos: lsp.Position) -> lsp.Range:
+def get_rule_range(document: Union[str, TextDocument], pos: lsp.Position) -> lsp.Range:
     '''Get the range of the YARA rule that a given symbol is in
 
-    :document: Text to search in
-               To determine line numbers, text is split at newlines, and carriage returns are ignored
+    :document: Text or TextDocument to search in
     :pos: Symbol position to base range off of
     '''
-    start_pattern = re.compile(r"^((private|global) )?rule\b")
-    end_pattern = re.compile("^}$")
-    lines = document.replace("\r", "").split("\n")
-    # default to assuming the entire document is within range
-    start_pos = lsp.Position(line=0, char=0)
-    end_pos = lsp.Position(line=len(lines), char=0)
-    # work backwards from the given position and find the start of rule
-    for index in range(pos.line, 0, -1):
-        line = lines[index]
-        match = start_pattern.match(line)
-        if match:
-            start_pos = lsp.Position(line=index, char=0)
-            break
-    # start from the given position and find the first end of rule
-    for index in range(pos.line, len(lines)):
-        line = lines[index]
-        match = end_pattern.match(line)
-        if match:
-            end_pos = lsp.Position(line=index, char=0)
-            break
-    return lsp.Range(start=start_pos, end=end_pos)
+    document = get_document(document)
+    rule = document.tree.rule_at(pos)
+    if rule is None:
+        # default to assuming the entire document is within range
+        return lsp.Range(start=lsp.Position(line=0, char=0), end=lsp.Position(line=document.line_count, char=0))
+    return rule.range
+
+def load_module_schema(path: Path=MODULE_SCHEMA) -> dict:
+    '''Load a module schema, preferring the pickled copy built by compile_module_schema()
+
+    :path: (Optional) JSON schema to load
+    '''
+    path = Path(path)
+    try:
+        return pickle.loads(path.with_suffix(".pickle").read_bytes())
+    except (OSError, pickle.UnpicklingError, EOFError):
+        with path.open("r", encoding="utf-8") as schema_file:
+            return json.load(schema_file)
+
+@lru_cache(maxsize=4096)
+def normalize_uri(uri: str) -> str:
+    '''Normalize a file URI into a path that can be used as a lookup key
+
+    Different spellings of the same file URI (e.g. extra slashes or
+    percent-encoding) all normalize to the same path
+
+    :uri: URI string to be normalized
+    '''
+    if urlsplit(uri).scheme != "file":
+        # unsaved and virtual documents have no path to normalize
+        return uri
+    path = parse_uri(uri)
+    return os.path.normcase(os.path.realpath(path))
 
 def parse_result(result: str) -> Tuple[int,str]:
     '''Parse the results from a YARA compilation attempt
@@ -75,15 +114,14 @@ def parse_uri(uri: str, encoding="utf-8"):
         url = urlsplit(unquote(uri, encoding=encoding))
         return url2pathname(url.path)
 
-def resolve_symbol(document: str, pos: lsp.Position) -> str:
+def resolve_symbol(document: Union[str, TextDocument], pos: lsp.Position) -> str:
     '''Resolve a symbol located at the given position
 
-    :document: Text to search in
-               To determine line numbers, text is split at newlines, and carriage returns are ignored
+    :document: Text or TextDocument to search in
     :pos: Symbol position to base range off of
     '''
     try:
-        symbol_line = document.split("\n")[pos.line]
+        symbol_line = get_document(document).line(pos.line)
         line_end = len(symbol_line)
         # find the left-bound of the symbol by looking backwards until a whitespace
         index = pos.char - 1
@@ -0,0 +1,326 @@
+''' Workspace-wide indexes of YARA symbols '''
+from bisect import bisect_left, insort
+from collections import namedtuple
+from typing import List, Tuple
+from weakref import WeakKeyDictionary
+
+from yarals import helpers
+from yarals import protocol as lsp
+from yarals.documents import TextDocument
+from yarals.parser import RuleNode
+
+
+class RuleSymbol(object):
+    def __init__(self, name: str, location: lsp.Location, private: bool=False, is_global: bool=False, tags: list=None):
+        ''' A rule declared somewhere in the workspace '''
+        self.name = str(name)
+        self.location = location
+        self.private = bool(private)
+        self.is_global = bool(is_global)
+        self.tags = tags if tags is not None else []
+
+    def __repr__(self):
+        return "<RuleSymbol(name={}, uri={})>".format(self.name, self.location.uri)
+
+    def declaration(self) -> str:
+        ''' Human-readable declaration line for this rule '''
+        words = []
+        if self.private:
+            words.append("private")
+        if self.is_global:
+            words.append("global")
+        words.extend(["rule", self.name])
+        if self.tags:
+            words.append(":")
+            words.extend(self.tags)
+        return " ".join(words)
+
+# what the index remembers about a single file
+#   digest: hash of the text the file was indexed from
+#   uri: file URI, as given by the document that was indexed
+#   symbols: every rule declared in the file
+#   references: (name, line, start character, end character) of every identifier used in the file's conditions
+IndexedFile = namedtuple("IndexedFile", ["digest", "uri", "symbols", "references"])
+
+class DocumentSymbols(object):
+    def __init__(self, document: TextDocument):
+        '''Rules declared and identifiers used in a single overlaid document, grouped by name
+
+        Built once per version of the document, so requests on unsaved buffers look
+        names up instead of scanning every rule in them. Symbols and references are
+        only built for the names that are actually asked for
+
+        :document: Document to scan
+        '''
+        self.uri = document.uri
+        self.key = helpers.normalize_uri(document.uri)
+        self.version = document.version
+        self._nodes = list(document.tree.rules)
+        # rule name => [RuleNode] declaring it
+        self.rules = {}
+        for rule in self._nodes:
+            if rule.name:
+                self.rules.setdefault(rule.name, []).append(rule)
+        # (lowercase name, name) of every rule, sorted for prefix searches. Built on first use
+        self._names = None
+        # identifier => [(line, start character, end character)]. Built on first use
+        self._references = None
+
+    def __repr__(self):
+        return "<DocumentSymbols(uri={}, version={})>".format(self.uri, self.version)
+
+    def symbols(self, name: str) -> List[RuleSymbol]:
+        ''' Get every declaration of a rule name in this document '''
+        return [SymbolIndex._symbol(rule, self.uri) for rule in self.rules.get(name, [])]
+
+    def references(self, name: str) -> list:
+        ''' Get the (line, start character, end character) of every use of an identifier in this document '''
+        if self._references is None:
+            self._references = {}
+            for rule in self._nodes:
+                for ref_name, line, start, end in SymbolIndex._rule_references(rule):
+                    self._references.setdefault(ref_name, []).append((line, start, end))
+        return self._references.get(name, [])
+
+    def complete(self, prefix: str) -> list:
+        ''' Get the names of every rule starting with a lowercase prefix '''
+        if self._names is None:
+            self._names = sorted((name.lower(), name) for name in self.rules)
+        names = []
+        for index in range(bisect_left(self._names, (prefix,)), len(self._names)):
+            lowered, name = self._names[index]
+            if not lowered.startswith(prefix):
+                break
+            names.append(name)
+        return names
+
+class SymbolIndex(object):
+    def __init__(self):
+        '''Map rule names to every location they are declared in, and identifiers to everywhere they are used
+
+        Files are keyed by their normalized path, so different URI spellings
+        of the same file share a single entry. Documents are only scanned when
+        a lookup needs them, so edits do not pay for re-indexing on every keystroke
+        '''
+        # rule name => file key => [RuleSymbol]
+        self._rules = {}
+        # identifier => file key => [(line, start character, end character)]
+        self._references = {}
+        # file key => IndexedFile
+        self._files = {}
+        # file key => TextDocument waiting to be scanned
+        self._pending = {}
+        # (lowercase name, name) of every indexed rule, sorted for prefix searches. Rebuilt on demand after bulk updates
+        self._names = None
+        # TextDocument => DocumentSymbols of overlaid documents, rebuilt whenever the document's version changes
+        self._overlays = WeakKeyDictionary()
+
+    def __contains__(self, name: str) -> bool:
+        self.refresh()
+        return name in self._rules
+
+    def __len__(self) -> int:
+        self.refresh()
+        return sum(len(indexed.symbols) for indexed in self._files.values())
+
+    def lookup(self, name: str, overlay: dict=None) -> List[RuleSymbol]:
+        '''Get every declaration of the given rule name
+
+        :name: Rule name to look up
+        :overlay: (Optional) Documents that take the place of the indexed copies of the same files,
+            such as a client's unsaved buffers, keyed by file URI. The index itself is left untouched
+        '''
+        self.refresh()
+        files = self._rules.get(name, {})
+        if not overlay:
+            return [symbol for symbols in files.values() for symbol in symbols]
+        overlay = self._scan_overlay(overlay)
+        results = []
+        for symbols in overlay.values():
+            results.extend(symbols.symbols(name))
+        for key, symbols in files.items():
+            if key not in overlay:
+                results.extend(symbols)
+        return results
+
+    def references(self, name: str, overlay: dict=None) -> List[lsp.Location]:
+        '''Get every declaration and use of a rule name across the workspace
+
+        Indexed files are answered from the index alone, without reading them again
+
+        :name: Rule name to look up
+        :overlay: (Optional) Documents that take the place of the indexed copies of the same files, keyed by file URI
+        '''
+        self.refresh()
+        overlay = self._scan_overlay(overlay or {})
+        results = []
+        for symbols in overlay.values():
+            results.extend(symbol.location for symbol in symbols.symbols(name))
+            results.extend(self._locations(symbols.references(name), symbols.uri))
+        for key, symbols in self._rules.get(name, {}).items():
+            if key not in overlay:
+                results.extend(symbol.location for symbol in symbols)
+        for key, spans in self._references.get(name, {}).items():
+            if key not in overlay:
+                results.extend(self._locations(spans, self._files[key].uri))
+        return results
+
+    @staticmethod
+    def _locations(spans: list, file_uri: str) -> List[lsp.Location]:
+        ''' Build locations from indexed (line, start character, end character) spans '''
+        return [lsp.Location(lsp.Range(lsp.Position(line, start), lsp.Position(line, end)), file_uri) for line, start, end in spans]
+
+    def complete(self, prefix: str, overlay: dict=None, limit: int=0) -> Tuple[List[RuleSymbol], bool]:
+        '''Get the first declaration of every rule whose name starts with a prefix, ignoring case
+
+        Returns the declarations sorted by name, and whether there were more than the limit
+
+        :prefix: Partial rule name
+        :overlay: (Optional) Documents that take the place of the indexed copies of the same files, keyed by file URI
+        :limit: (Optional) Maximum number of declarations to return. 0 returns every match
+        '''
+        self.refresh()
+        if self._names is None:
+            self._names = sorted((name.lower(), name) for name in self._rules)
+        overlay = self._scan_overlay(overlay or {})
+        prefix = prefix.lower()
+        # rule name => first declaration, or the (rule, file URI) it will be built from
+        results = {}
+        for symbols in overlay.values():
+            # unsaved documents change with every keystroke, so only matching rules are turned into symbols
+            for name in symbols.complete(prefix):
+                if name not in results:
+                    results[name] = (symbols.rules[name][0], symbols.uri)
+        # indexed names are sorted, so once more than a page of them matched, the rest can't make the cut.
+        # Overlay matches don't count towards that, since they may all sort after the indexed ones
+        found = 0
+        for index in range(bisect_left(self._names, (prefix,)), len(self._names)):
+            lowered, name = self._names[index]
+            if not lowered.startswith(prefix) or (limit > 0 and found > limit):
+                break
+            if name not in results:
+                # rules only declared in overlaid files may have been deleted from them
+                symbol = next((symbol for key, symbols in self._rules[name].items() if key not in overlay for symbol in symbols), None)
+                if symbol is not None:
+                    results[name] = symbol
+            if name in results:
+                found += 1
+        names = sorted(results, key=str.lower)
+        incomplete = limit > 0 and len(names) > limit
+        if incomplete:
+            names = names[:limit]
+        matches = []
+        for name in names:
+            symbol = results[name]
+            matches.append(self._symbol(*symbol) if isinstance(symbol, tuple) else symbol)
+        return matches, incomplete
+
+    def remove(self, file_uri: str):
+        ''' Drop every symbol declared in the given file '''
+        key = helpers.normalize_uri(file_uri)
+        self._pending.pop(key, None)
+        self._unlink(key)
+        self._files.pop(key, None)
+
+    def update(self, document: TextDocument):
+        ''' Queue a document to be (re-)indexed before the next lookup '''
+        self._pending[helpers.normalize_uri(document.uri)] = document
+
+    def refresh(self):
+        ''' Index any documents that have changed since the last lookup '''
+        if len(self._pending) > 64:
+            # cheaper to sort every name again than to insert them one at a time
+            self._names = None
+        while self._pending:
+            key, document = self._pending.popitem()
+            # only keep a hash of the text around to avoid holding the whole workspace in memory
+            digest = hash(document.text)
+            indexed = self._files.get(key, None)
+            if indexed is not None and indexed.digest == digest:
+                continue
+            self._unlink(key)
+            indexed = self._files[key] = IndexedFile(digest, document.uri, self._scan(document), self._scan_references(document))
+            for symbol in indexed.symbols:
+                if symbol.name not in self._rules and self._names is not None:
+                    insort(self._names, (symbol.name.lower(), symbol.name))
+                self._rules.setdefault(symbol.name, {}).setdefault(key, []).append(symbol)
+            for name, line, start, end in indexed.references:
+                self._references.setdefault(name, {}).setdefault(key, []).append((line, start, end))
+
+    def _unlink(self, key: str):
+        ''' Remove a file's symbols and references from the lookup tables '''
+        indexed = self._files.get(key, None)
+        if indexed is None:
+            return
+        for name in set(reference[0] for reference in indexed.references):
+            files = self._references.get(name, {})
+            files.pop(key, None)
+            if not files:
+                self._references.pop(name, None)
+        for symbol in indexed.symbols:
+            files = self._rules.get(symbol.name, {})
+            files.pop(key, None)
+            if not files and self._rules.pop(symbol.name, None) is not None and self._names is not None:
+                entry = (symbol.name.lower(), symbol.name)
+                index = bisect_left(self._names, entry)
+                if index < len(self._names) and self._names[index] == entry:
+                    del self._names[index]
+
+    def scan_document(self, document: TextDocument) -> DocumentSymbols:
+        '''Get the symbols of an overlaid document, only scanning it again once its version changes
+
+        :document: Open document, such as one of a client's unsaved buffers
+        '''
+        symbols = self._overlays.get(document, None)
+        if symbols is None or symbols.version != document.version:
+            symbols = self._overlays[document] = DocumentSymbols(document)
+        return symbols
+
+    def discard_document(self, document: TextDocument):
+        '''Drop the cached symbols of an overlaid document, for changes that don't come with a new version
+
+        :document: Open document that was just edited
+        '''
+        self._overlays.pop(document, None)
+
+    def _scan_overlay(self, overlay: dict) -> dict:
+        ''' Get the DocumentSymbols of each overlaid document, keyed by normalized path '''
+        results = {}
+        for document in overlay.values():
+            symbols = self.scan_document(document)
+            results[symbols.key] = symbols
+        return results
+
+    @staticmethod
+    def _symbol(rule: RuleNode, file_uri: str) -> RuleSymbol:
+        ''' Describe a parsed rule '''
+        return RuleSymbol(
+            name=rule.name,
+            location=lsp.Location(rule.name_range, file_uri),
+            private=rule.private,
+            is_global=rule.is_global,
+            tags=list(rule.tags)
+        )
+
+    @classmethod
+    def _scan(cls, document: TextDocument) -> List[RuleSymbol]:
+        ''' Find every rule declared in a document '''
+        return [cls._symbol(rule, document.uri) for rule in document.tree.rules if rule.name]
+
+    @classmethod
+    def _scan_references(cls, document: TextDocument) -> List[tuple]:
+        ''' Find every identifier used in the conditions of a document, other than string identifiers '''
+        references = []
+        for rule in document.tree.rules:
+            references.extend(cls._rule_references(rule))
+        return references
+
+    @staticmethod
+    def _rule_references(rule: RuleNode) -> List[tuple]:
+        ''' Find every identifier used in the condition of a rule, other than string identifiers '''
+        references = []
+        for reference in rule.references:
+            if reference.name[0] not in "$#@!":
+                locrange = reference.range
+                references.append((reference.name, locrange.start.line, locrange.start.char, locrange.end.char))
+        return references
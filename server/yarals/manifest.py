@@ -0,0 +1,150 @@
+''' Persist the results of compiling a workspace between runs '''
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+import sys
+
+from yarals import compiler
+
+# bump whenever the layout of the manifest file changes
+MANIFEST_VERSION = 1
+# environment variable that points the server's caches somewhere else, on every platform
+CACHE_DIR_ENV = "YARALS_CACHE_DIR"
+
+
+def get_cache_dir() -> Path:
+    ''' Find the per-user directory to store the server's caches in, unless YARALS_CACHE_DIR overrides it '''
+    override = os.environ.get(CACHE_DIR_ENV, None)
+    if override:
+        return Path(override)
+    if sys.platform == "win32":
+        base = os.environ.get("LOCALAPPDATA", None) or Path.home().joinpath("AppData", "Local")
+    elif sys.platform == "darwin":
+        base = Path.home().joinpath("Library", "Caches")
+    else:
+        base = os.environ.get("XDG_CACHE_HOME", None) or Path.home().joinpath(".cache")
+    return Path(base).joinpath("vscode-yara")
+
+def get_manifest_path(workspace: Path) -> Path:
+    '''Get the location of the build manifest for a given workspace
+
+    :workspace: Root directory of the workspace
+    '''
+    digest = hashlib.sha256(str(Path(workspace).resolve()).encode("utf-8", errors="surrogatepass")).hexdigest()
+    return get_cache_dir().joinpath("manifests", "{}.json".format(digest[:32]))
+
+class BuildManifest(object):
+    def __init__(self, path: Path):
+        '''Last known compilation results for every file in a workspace
+
+        Each entry records a file's size, modification time and content hash
+        along with the diagnostics it produced. Files whose size and
+        modification time are unchanged can have their diagnostics replayed
+        without being read or compiled again
+
+        :path: Location of the manifest file on disk
+        '''
+        self.path = Path(path)
+        self._logger = logging.getLogger("yara")
+        # file URI => {"mtime": int, "size": int, "hash": str, "diagnostics": [dict]}
+        self._files = {}
+        self._modified = False
+
+    def __contains__(self, file_uri: str) -> bool:
+        return file_uri in self._files
+
+    def __len__(self) -> int:
+        return len(self._files)
+
+    @staticmethod
+    def hash_text(text: str) -> str:
+        ''' Hash file contents the same way the manifest stores them '''
+        return hashlib.sha256(text.encode("utf-8", errors="surrogatepass")).hexdigest()
+
+    def load(self):
+        ''' Read the manifest from disk, starting fresh if it is missing or out of date '''
+        self._files = {}
+        self._modified = False
+        try:
+            with open(self.path, "r", encoding="utf-8") as manifest_file:
+                data = json.load(manifest_file)
+        except (OSError, ValueError) as err:
+            self._logger.debug("Could not load build manifest %s: %s", self.path, err)
+            return
+        # results from a different yara-python may no longer be accurate
+        if data.get("version") == MANIFEST_VERSION and data.get("yara") == compiler.get_yara_version():
+            self._files = data.get("files", {})
+
+    def save(self):
+        ''' Write the manifest to disk if anything changed since it was loaded '''
+        if not self._modified:
+            return
+        data = {
+            "version": MANIFEST_VERSION,
+            "yara": compiler.get_yara_version(),
+            "files": self._files
+        }
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # write to a temporary file first so an interrupted save never leaves a corrupt manifest behind
+        temp_path = self.path.with_suffix(".tmp")
+        with open(temp_path, "w", encoding="utf-8") as manifest_file:
+            json.dump(data, manifest_file, separators=(",", ":"))
+        os.replace(temp_path, self.path)
+        self._modified = False
+
+    def lookup(self, file_uri: str, stat: os.stat_result=None, digest: str=None) -> list:
+        '''Get the diagnostics last recorded for a file, or None if the file changed since
+
+        :file_uri: URI of the file to look up
+        :stat: (Optional) Current stat() results for the file
+        :digest: (Optional) Current content hash of the file
+        '''
+        entry = self._files.get(file_uri, None)
+        if entry is None:
+            return None
+        if digest is not None:
+            if entry["hash"] != digest:
+                return None
+            # the contents are unchanged, so refresh the stat info to avoid hashing this file again
+            if stat is not None and (entry["mtime"], entry["size"]) != (stat.st_mtime_ns, stat.st_size):
+                entry["mtime"], entry["size"] = stat.st_mtime_ns, stat.st_size
+                self._modified = True
+        elif stat is None or (entry["mtime"], entry["size"]) != (stat.st_mtime_ns, stat.st_size):
+            return None
+        return entry["diagnostics"]
+
+    def record(self, file_uri: str, stat: os.stat_result, digest: str, diagnostics: list):
+        '''Store the results of compiling a file
+
+        :file_uri: URI of the compiled file
+        :stat: stat() results for the file at the time it was read
+        :digest: Content hash of the compiled text
+        :diagnostics: Diagnostics produced by the compilation
+        '''
+        self._files[file_uri] = {
+            "mtime": stat.st_mtime_ns,
+            "size": stat.st_size,
+            "hash": digest,
+            # store the diagnostics exactly as they're sent to the client so they can be replayed as-is
+            "diagnostics": [diagnostic.to_dict() for diagnostic in diagnostics]
+        }
+        self._modified = True
+
+    def forget(self, file_uri: str):
+        '''Drop a single file, so it is compiled again on the next run
+
+        :file_uri: URI of the file that changed or was deleted
+        '''
+        if self._files.pop(file_uri, None) is not None:
+            self._modified = True
+
+    def prune(self, file_uris: set):
+        '''Forget every file not in the given set
+
+        :file_uris: URIs of every file that still exists in the workspace
+        '''
+        for file_uri in set(self._files).difference(file_uris):
+            del self._files[file_uri]
+            self._modified = True
@@ -0,0 +1,113 @@
+''' Record how often each language server method is called and how long it takes '''
+from bisect import bisect_left
+from contextlib import contextmanager
+import time
+
+# upper bounds (in seconds) of each latency bucket. Each bucket is 25% wider than the last,
+# so percentiles are accurate to within 25% from 50 microseconds up to a minute
+BUCKET_BOUNDS = tuple(0.00005 * 1.25 ** index for index in range(64))
+
+
+class LatencyHistogram(object):
+    def __init__(self):
+        ''' Fixed-size histogram of call latencies '''
+        # the last bucket catches everything slower than the largest bound
+        self.buckets = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def add(self, seconds: float):
+        ''' Record a single call's latency '''
+        self.buckets[bisect_left(BUCKET_BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.maximum = max(self.maximum, seconds)
+
+    def percentile(self, percent: float) -> float:
+        '''Estimate the latency (in seconds) that the given percentage of calls finished within
+
+        :percent: Percentile to estimate, between 0 and 100
+        '''
+        if self.count == 0:
+            return 0.0
+        rank = percent / 100 * self.count
+        seen = 0
+        for index, bucket in enumerate(self.buckets):
+            seen += bucket
+            if bucket and seen >= rank:
+                if index < len(BUCKET_BOUNDS):
+                    # no call took longer than the slowest one, even if it landed in a wide bucket
+                    return min(BUCKET_BOUNDS[index], self.maximum)
+                break
+        return self.maximum
+
+class MethodMetrics(object):
+    def __init__(self):
+        ''' Call count, error count and latencies for a single method '''
+        self.errors = 0
+        self.latency = LatencyHistogram()
+
+    @property
+    def count(self) -> int:
+        return self.latency.count
+
+    def summary(self) -> dict:
+        ''' Report this method's statistics, with latencies in milliseconds '''
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "mean": round(self.latency.total / self.count * 1000, 3) if self.count else 0.0,
+            "p50": round(self.latency.percentile(50) * 1000, 3),
+            "p95": round(self.latency.percentile(95) * 1000, 3),
+            "p99": round(self.latency.percentile(99) * 1000, 3),
+            "max": round(self.latency.maximum * 1000, 3)
+        }
+
+class Metrics(object):
+    def __init__(self):
+        ''' Per-method statistics for every message the server handles '''
+        self._methods = {}
+
+    def __contains__(self, method: str) -> bool:
+        return method in self._methods
+
+    def get(self, method: str) -> MethodMetrics:
+        ''' Get the statistics for a method, creating them if this is its first call '''
+        metrics = self._methods.get(method, None)
+        if metrics is None:
+            metrics = self._methods[method] = MethodMetrics()
+        return metrics
+
+    def record(self, method: str, seconds: float, error: bool=False):
+        '''Record a single call
+
+        :method: Name of the method that was called
+        :seconds: How long the call took
+        :error: (Optional) Whether the call failed
+        '''
+        metrics = self.get(method)
+        metrics.latency.add(seconds)
+        if error:
+            metrics.errors += 1
+
+    @contextmanager
+    def measure(self, method: str):
+        '''Time the enclosed block, counting it as an error if it raises
+
+        :method: Name of the method being called
+        '''
+        start = time.perf_counter()
+        error = False
+        try:
+            yield
+        except Exception:
+            error = True
+            raise
+        finally:
+            self.record(method, time.perf_counter() - start, error=error)
+
+    def summary(self) -> dict:
+        ''' Report every method's statistics, slowest (by p95) first '''
+        summaries = {method: metrics.summary() for method, metrics in self._methods.items()}
+        return dict(sorted(summaries.items(), key=lambda item: item[1]["p95"], reverse=True))
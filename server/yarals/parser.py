@@ -0,0 +1,508 @@
+''' Tokenize and parse YARA rules into a compact syntax tree
+
+The tree only models what the language server navigates: rule declarations,
+their sections, meta entries, string definitions and the identifiers
+referenced in conditions. Expressions themselves are left as tokens
+'''
+from collections import namedtuple
+from enum import IntEnum
+import re
+from typing import List, Tuple
+
+from yarals import protocol as lsp
+
+KEYWORDS = frozenset([
+    "all", "and", "any", "ascii", "at", "base64", "base64wide", "condition", "contains",
+    "defined", "endswith", "entrypoint", "false", "filesize", "for", "fullword", "global",
+    "icontains", "iendswith", "iequals", "import", "in", "include", "int16", "int16be",
+    "int32", "int32be", "int8", "int8be", "istartswith", "matches", "meta", "nocase",
+    "none", "not", "of", "or", "private", "rule", "startswith", "strings", "them", "true",
+    "uint16", "uint16be", "uint32", "uint32be", "uint8", "uint8be", "wide", "xor"
+])
+SECTION_KEYWORDS = frozenset(["condition", "meta", "strings"])
+
+_TOKEN_PATTERN = re.compile(r"""
+    (?P<space>\s+)
+  | (?P<comment>//[^\r\n]*)
+  | (?P<text>"(?:[^"\\\r\n]|\\.)*"?)
+  | (?P<operator>==|!=|<=|>=|<<|>>|\.\.)
+  | (?P<string_id>[$#@!][A-Za-z0-9_]*\*?)
+  | (?P<number>0x[0-9a-fA-F]+|0o[0-7]+|\d+(?:\.\d+)?(?:KB|MB)?)
+  | (?P<identifier>[A-Za-z_][A-Za-z0-9_]*)
+""", re.VERBOSE)
+_REGEX_PATTERN = re.compile(r"/(?:[^/\\\r\n]|\\.)*/[is]*")
+# regular expressions and hex strings can only follow these tokens
+_PATTERN_PREFIXES = frozenset(["=", "matches"])
+
+
+class TokenKind(IntEnum):
+    IDENTIFIER = 1
+    KEYWORD = 2
+    STRING_ID = 3
+    TEXT = 4
+    HEX = 5
+    REGEX = 6
+    NUMBER = 7
+    OPERATOR = 8
+    PUNCTUATION = 9
+
+# start and end are offsets into the tokenized text
+Token = namedtuple("Token", ["kind", "value", "start", "end"])
+
+def tokenize(text: str, start: int=0, end: int=None) -> Tuple[List[Token], bool]:
+    '''Split YARA source into tokens, skipping whitespace and comments
+
+    Returns the tokens and whether the text ended in the middle of a
+    block comment or hex string, in which case the text that follows
+    would be tokenized differently
+
+    :text: YARA source to tokenize
+    :start: (Optional) Offset to start tokenizing at
+    :end: (Optional) Offset to stop tokenizing at
+    '''
+    end = len(text) if end is None else end
+    tokens = []
+    pos = start
+    previous = None
+    while pos < end:
+        char = text[pos]
+        if char == "/" and text.startswith("/*", pos):
+            close = text.find("*/", pos + 2, end)
+            if close < 0:
+                return tokens, True
+            pos = close + 2
+            continue
+        elif char == "{" and previous in _PATTERN_PREFIXES:
+            close = text.find("}", pos, end)
+            if close < 0:
+                return tokens, True
+            token = Token(TokenKind.HEX, text[pos:close+1], pos, close + 1)
+        elif char == "/" and previous in _PATTERN_PREFIXES:
+            match = _REGEX_PATTERN.match(text, pos, end)
+            if match:
+                token = Token(TokenKind.REGEX, match.group(), pos, match.end())
+            else:
+                token = Token(TokenKind.PUNCTUATION, char, pos, pos + 1)
+        else:
+            match = _TOKEN_PATTERN.match(text, pos, end)
+            if match is None:
+                token = Token(TokenKind.PUNCTUATION, char, pos, pos + 1)
+            elif match.lastgroup in ("space", "comment"):
+                pos = match.end()
+                continue
+            elif match.lastgroup == "identifier":
+                kind = TokenKind.KEYWORD if match.group() in KEYWORDS else TokenKind.IDENTIFIER
+                token = Token(kind, match.group(), pos, match.end())
+            else:
+                token = Token(TokenKind[match.lastgroup.upper()], match.group(), pos, match.end())
+        tokens.append(token)
+        previous = token.value
+        pos = token.end
+    return tokens, False
+
+class SyntaxNode(object):
+    def __init__(self, rule, span: tuple):
+        '''Base for everything found inside a rule
+
+        Lines are stored relative to the start of the owning rule,
+        so rules can be moved around without touching their contents
+        '''
+        self.rule = rule
+        self._span = span
+
+    @property
+    def range(self) -> lsp.Range:
+        ''' Absolute range of this node in the document '''
+        return _absolute(self.rule.line, self._span)
+
+class MetaNode(SyntaxNode):
+    def __init__(self, rule, span: tuple, key: str, value: str):
+        ''' A single "key = value" entry in the meta section '''
+        super().__init__(rule, span)
+        self.key = key
+        self.value = value
+
+    def __repr__(self):
+        return "<MetaNode(key={}, value={})>".format(self.key, self.value)
+
+class ReferenceNode(SyntaxNode):
+    def __init__(self, rule, span: tuple, name: str):
+        ''' An identifier used in a rule's condition, such as "#a" or another rule's name '''
+        super().__init__(rule, span)
+        self.name = name
+
+    def __repr__(self):
+        return "<ReferenceNode(name={})>".format(self.name)
+
+class SectionNode(SyntaxNode):
+    def __init__(self, rule, span: tuple, name: str):
+        ''' The meta, strings or condition section of a rule '''
+        super().__init__(rule, span)
+        self.name = name
+
+    def __repr__(self):
+        return "<SectionNode(name={})>".format(self.name)
+
+class StringNode(SyntaxNode):
+    def __init__(self, rule, span: tuple, identifier: str, value: str, value_span: tuple):
+        ''' A string definition, such as '$a = "text" wide' '''
+        super().__init__(rule, span)
+        self.identifier = identifier
+        # value includes any modifiers that follow it
+        self.value = value
+        self._value_span = value_span
+
+    def __repr__(self):
+        return "<StringNode(identifier={})>".format(self.identifier)
+
+    @property
+    def value_range(self) -> lsp.Range:
+        ''' Absolute range of this string's value and modifiers '''
+        return _absolute(self.rule.line, self._value_span)
+
+class RuleNode(object):
+    def __init__(self, name: str, line: int):
+        ''' A single YARA rule and everything declared inside it '''
+        self.name = name
+        # absolute line the rule starts on. Every other position in the rule is relative to this
+        self.line = line
+        self.private = False
+        self.is_global = False
+        self.tags = []
+        self.meta = []
+        self.strings = []
+        self.references = []
+        # section name => SectionNode
+        self.sections = {}
+        # whether the rule's closing brace was found
+        self.terminated = False
+        self._span = (0, 0, 0, 0)
+        self._name_span = (0, 0, 0, 0)
+
+    def __repr__(self):
+        return "<RuleNode(name={}, line={:d})>".format(self.name, self.line)
+
+    @property
+    def end_line(self) -> int:
+        ''' Absolute line the rule ends on '''
+        return self.line + self._span[2]
+
+    @property
+    def range(self) -> lsp.Range:
+        ''' Absolute range from the rule's first modifier to its closing brace '''
+        return _absolute(self.line, self._span)
+
+    @property
+    def name_range(self) -> lsp.Range:
+        ''' Absolute range of the rule's name '''
+        return _absolute(self.line, self._name_span)
+
+    def contains(self, pos: lsp.Position) -> bool:
+        ''' Check if a position falls inside this rule '''
+        _, start_char, end_line, end_char = self._span
+        line = pos.line - self.line
+        if line < 0 or line > end_line:
+            return False
+        elif line == 0 and pos.char < start_char:
+            return False
+        elif line == end_line and pos.char > end_char:
+            return False
+        return True
+
+    def find_strings(self, identifier: str) -> List[StringNode]:
+        '''Find the string definitions matching an identifier
+
+        The identifier's first character is ignored, so "#a", "@a" and "!a"
+        all find "$a". Identifiers ending in "*" match every string with that prefix
+
+        :identifier: String identifier to search for
+        '''
+        name = identifier[1:]
+        if name.endswith("*"):
+            prefix = name[:-1]
+            return [string for string in self.strings if string.identifier[1:].startswith(prefix)]
+        return [string for string in self.strings if string.identifier[1:] == name]
+
+class SyntaxTree(object):
+    def __init__(self, rules: List[RuleNode]):
+        ''' Every rule in a document, ordered by position '''
+        self.rules = rules
+        # (first line, last line) intervals edited since the last parse
+        self._damaged = []
+
+    def __repr__(self):
+        return "<SyntaxTree(rules={:d})>".format(len(self.rules))
+
+    @property
+    def damaged(self) -> bool:
+        ''' Whether the document has been edited since it was last parsed '''
+        return len(self._damaged) > 0
+
+    def rule_at(self, pos: lsp.Position) -> RuleNode:
+        ''' Get the rule containing a position, if any '''
+        index = self._bisect(pos.line) - 1
+        # one-line rules can share a line, so look back over each rule starting on this line
+        while index >= 0 and self.rules[index].end_line >= pos.line:
+            if self.rules[index].contains(pos):
+                return self.rules[index]
+            index -= 1
+        return None
+
+    def edit(self, start_line: int, end_line: int, line_count: int):
+        '''Record that lines were replaced in the document
+
+        Rules touching the edited lines are dropped and re-parsed on the
+        next call to repair(). Rules after the edit are moved to their new lines
+
+        :start_line: First line touched by the edit
+        :end_line: Last line touched by the edit, before it was applied
+        :line_count: Number of lines the touched lines were replaced with
+        '''
+        delta = line_count - (end_line - start_line + 1)
+        new_end = start_line + line_count - 1
+        kept = []
+        for rule in self.rules:
+            if rule.end_line < start_line:
+                kept.append(rule)
+            elif rule.line > end_line:
+                rule.line += delta
+                kept.append(rule)
+        # an unterminated rule swallows everything up to the next rule, which may have just changed
+        before = [rule for rule in kept if rule.end_line < start_line]
+        if before and not before[-1].terminated:
+            kept.remove(before[-1])
+            start_line = before[-1].line
+        self.rules = kept
+        damaged = []
+        for first, last in self._damaged:
+            if last < start_line:
+                damaged.append((first, last))
+            elif first > end_line:
+                damaged.append((first + delta, last + delta))
+            else:
+                start_line = min(start_line, first)
+                new_end = max(new_end, last + delta if last > end_line else new_end)
+        damaged.append((start_line, new_end))
+        self._damaged = damaged
+
+    def repair(self, document):
+        '''Re-parse only the parts of the document that were edited
+
+        Falls back to a full parse if an edit leaves a comment or hex string open,
+        since that changes how everything after it is read
+
+        :document: TextDocument the tree belongs to, after the edits were applied
+        '''
+        text = document.text
+        # every damaged interval sits in the gap before the first rule that starts after it
+        gaps = sorted(set(self._bisect(last) for _, last in self._damaged), reverse=True)
+        self._damaged = []
+        for index in gaps:
+            start = document.offset_at(self.rules[index-1].range.end) if index > 0 else 0
+            while True:
+                end = document.offset_at(self.rules[index].range.start) if index < len(self.rules) else len(text)
+                tokens, unterminated = tokenize(text, start, end)
+                if unterminated:
+                    self.rules = parse(document).rules
+                    return
+                elif index < len(self.rules) and tokens and tokens[-1].value in ("global", "private"):
+                    # dangling modifiers belong to the next rule, so it needs to be re-parsed as well
+                    del self.rules[index]
+                else:
+                    break
+            self.rules[index:index] = _Parser(document, tokens).parse()
+
+    def _bisect(self, line: int) -> int:
+        ''' Index of the first rule starting after a line '''
+        low, high = 0, len(self.rules)
+        while low < high:
+            middle = (low + high) // 2
+            if self.rules[middle].line > line:
+                high = middle
+            else:
+                low = middle + 1
+        return low
+
+class _Parser(object):
+    def __init__(self, document, tokens: List[Token]):
+        ''' Build rule nodes out of a list of tokens '''
+        self._document = document
+        self._tokens = tokens
+        self._index = 0
+
+    def parse(self) -> List[RuleNode]:
+        ''' Parse every rule in the token stream '''
+        rules = []
+        while self._index < len(self._tokens):
+            if self._starts_rule():
+                rule = self._parse_rule()
+                if rule is not None:
+                    rules.append(rule)
+            else:
+                # imports, includes and anything else outside of a rule
+                self._index += 1
+        return rules
+
+    def _peek(self, offset: int=0) -> Token:
+        index = self._index + offset
+        if index < len(self._tokens):
+            return self._tokens[index]
+        return None
+
+    def _starts_rule(self) -> bool:
+        ''' Check if the current token starts a rule declaration '''
+        offset = 0
+        # "private" is also a string modifier, so only treat it as a rule modifier when "rule" follows
+        while self._peek(offset) is not None and self._peek(offset).kind == TokenKind.KEYWORD \
+        and self._peek(offset).value in ("global", "private"):
+            offset += 1
+        token = self._peek(offset)
+        return token is not None and token.kind == TokenKind.KEYWORD and token.value == "rule"
+
+    def _span(self, rule: RuleNode, start: int, end: int) -> tuple:
+        ''' Convert document offsets into a span relative to a rule '''
+        start_pos = self._document.position_at(start)
+        end_pos = self._document.position_at(end)
+        return (start_pos.line - rule.line, start_pos.char, end_pos.line - rule.line, end_pos.char)
+
+    def _parse_rule(self) -> RuleNode:
+        ''' Parse a rule starting at its first modifier '''
+        first = self._peek()
+        modifiers = []
+        while self._peek() is not None and self._peek().value in ("global", "private"):
+            modifiers.append(self._peek().value)
+            self._index += 1
+        if self._peek() is None or self._peek().value != "rule":
+            return None
+        self._index += 1
+        rule = RuleNode(name="", line=self._document.position_at(first.start).line)
+        rule.private = "private" in modifiers
+        rule.is_global = "global" in modifiers
+        last = self._tokens[self._index - 1]
+        name = self._peek()
+        if name is not None and name.kind == TokenKind.IDENTIFIER:
+            rule.name = name.value
+            rule._name_span = self._span(rule, name.start, name.end)
+            last = name
+            self._index += 1
+        # tags run from the colon to the opening brace
+        if self._peek() is not None and self._peek().value == ":":
+            self._index += 1
+            while self._peek() is not None and self._peek().kind == TokenKind.IDENTIFIER:
+                rule.tags.append(self._peek().value)
+                last = self._peek()
+                self._index += 1
+        if self._peek() is not None and self._peek().value == "{":
+            last = self._peek()
+            self._index += 1
+            last = self._parse_body(rule) or last
+        rule._span = self._span(rule, first.start, last.end)
+        return rule
+
+    def _parse_body(self, rule: RuleNode) -> Token:
+        ''' Parse rule sections up to the closing brace, returning the last token in the rule '''
+        section = None
+        section_start = None
+        last = None
+        while self._peek() is not None:
+            token = self._peek()
+            if self._starts_rule():
+                # missing closing brace. Leave the next rule for the caller
+                break
+            elif token.value == "}" and token.kind == TokenKind.PUNCTUATION:
+                rule.terminated = True
+                self._index += 1
+                self._close_section(rule, section, section_start, last)
+                return token
+            elif token.kind == TokenKind.KEYWORD and token.value in SECTION_KEYWORDS \
+            and self._peek(1) is not None and self._peek(1).value == ":":
+                self._close_section(rule, section, section_start, last)
+                section = token.value
+                section_start = token
+                last = self._peek(1)
+                self._index += 2
+                continue
+            elif section == "meta":
+                last = self._parse_meta(rule) or token
+            elif section == "strings":
+                last = self._parse_string(rule) or token
+            elif section == "condition":
+                previous = self._tokens[self._index - 1]
+                if token.kind == TokenKind.STRING_ID \
+                or (token.kind == TokenKind.IDENTIFIER and previous.value != "."):
+                    rule.references.append(ReferenceNode(rule, self._span(rule, token.start, token.end), token.value))
+                last = token
+                self._index += 1
+            else:
+                last = token
+                self._index += 1
+        self._close_section(rule, section, section_start, last)
+        return last
+
+    def _close_section(self, rule: RuleNode, section: str, start: Token, last: Token):
+        ''' Record a section once its last token is known '''
+        if section is not None and section not in rule.sections:
+            rule.sections[section] = SectionNode(rule, self._span(rule, start.start, last.end), section)
+
+    def _parse_meta(self, rule: RuleNode) -> Token:
+        ''' Parse a "key = value" meta entry, returning its last token '''
+        key, equals, value = self._peek(), self._peek(1), self._peek(2)
+        if key.kind in (TokenKind.IDENTIFIER, TokenKind.KEYWORD) and equals is not None and equals.value == "=" \
+        and value is not None and (value.kind in (TokenKind.TEXT, TokenKind.NUMBER) or value.value in ("-", "true", "false")):
+            last = value
+            self._index += 3
+            # negative numbers are split into two tokens
+            if value.value == "-" and self._peek() is not None and self._peek().kind == TokenKind.NUMBER:
+                last = self._peek()
+                self._index += 1
+            text = self._document.text[value.start:last.end]
+            rule.meta.append(MetaNode(rule, self._span(rule, key.start, last.end), key.value, text))
+            return last
+        self._index += 1
+        return None
+
+    def _parse_string(self, rule: RuleNode) -> Token:
+        ''' Parse a string definition and its modifiers, returning its last token '''
+        identifier, equals = self._peek(), self._peek(1)
+        if identifier.kind != TokenKind.STRING_ID or equals is None or equals.value != "=":
+            self._index += 1
+            return None
+        self._index += 2
+        value = self._peek()
+        if value is None or self._starts_rule():
+            return equals
+        last = value
+        self._index += 1
+        # modifiers continue until the next string, section or the end of the rule
+        while self._peek() is not None:
+            token = self._peek()
+            if token.kind == TokenKind.STRING_ID or (token.value == "}" and token.kind == TokenKind.PUNCTUATION) \
+            or (token.kind == TokenKind.KEYWORD and token.value in SECTION_KEYWORDS) or self._starts_rule():
+                break
+            last = token
+            self._index += 1
+        text = self._document.text[value.start:last.end]
+        rule.strings.append(StringNode(
+            rule,
+            self._span(rule, identifier.start, identifier.end),
+            identifier.value,
+            text,
+            self._span(rule, value.start, last.end)
+        ))
+        return last
+
+def _absolute(line: int, span: tuple) -> lsp.Range:
+    ''' Convert a span relative to a rule into an absolute range '''
+    start_line, start_char, end_line, end_char = span
+    return lsp.Range(
+        start=lsp.Position(line=line + start_line, char=start_char),
+        end=lsp.Position(line=line + end_line, char=end_char)
+    )
+
+def parse(document) -> SyntaxTree:
+    '''Parse every rule in a document
+
+    :document: TextDocument to parse
+    '''
+    tokens, _ = tokenize(document.text)
+    return SyntaxTree(_Parser(document, tokens).parse())
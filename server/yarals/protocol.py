@@ -6,7 +6,15 @@ from enum import Enum, IntEnum
 import json
 from typing import Union, List
 
+try:
+    import orjson
+    HAS_ORJSON = True
+except ModuleNotFoundError:
+    HAS_ORJSON = False
+
 EOL: list = ["\n", "\r\n", "\r"]
+# type-check protocol objects as they're created. Only worth the cost while debugging
+VALIDATE = False
 
 # Protocol Constants
 class CompletionTriggerKind(IntEnum):
@@ -34,9 +42,11 @@ class JsonRPCError(IntEnum):
 
 class CompletionItemKind(IntEnum):
     METHOD = 2
+    VARIABLE = 6
     CLASS = 7
     PROPERTY = 10
     ENUM = 13
+    REFERENCE = 18
 
 class DiagnosticSeverity(IntEnum):
     ERROR = 1
@@ -44,6 +54,11 @@ class DiagnosticSeverity(IntEnum):
     INFO = 3
     HINT = 4
 
+class FileChangeType(IntEnum):
+    CREATED = 1
+    CHANGED = 2
+    DELETED = 3
+
 class MarkupKind(Enum):
     Markdown = "markdown"
     Plaintext = "plaintext"
@@ -60,6 +75,8 @@ class TextSyncKind(IntEnum):
     INCREMENTAL = 2
 
 class Position(object):
+    __slots__ = ("line", "char")
+
     def __init__(self, line: int, char: int):
         ''' Line position in a document (zero-based)
 
@@ -70,110 +87,212 @@ class Position(object):
         If the character value is greater than the line length it defaults back to the
         line length.
         '''
-        # rely on Python's runtime type conversions to ensure valid values are used
+        # positions come straight from clients, so always rely on Python's runtime type conversions
+        # to ensure valid values are used. It's cheap compared to the checks behind VALIDATE
         self.line = int(line)
         self.char = int(char)
 
     def __repr__(self):
         return "<Position(line={:d}, char={:d})>".format(self.line, self.char)
 
+    def to_dict(self) -> dict:
+        ''' Convert to a JSON-serializable dictionary '''
+        return {"line": self.line, "character": self.char}
+
 class Range(object):
+    __slots__ = ("start", "end")
+
     def __init__(self, start: Position, end: Position):
         ''' A range in a text document expressed as (zero-based) start and end positions
 
         A range is comparable to a selection in an editor. Therefore the end position is exclusive
         '''
-        if not isinstance(start, Position):
-            raise TypeError("Start position cannot be {}. Must be Position".format(type(start)))
-        elif not isinstance(end, Position):
-            raise TypeError("End position cannot be {}. Must be Position".format(type(end)))
+        if VALIDATE:
+            if not isinstance(start, Position):
+                raise TypeError("Start position cannot be {}. Must be Position".format(type(start)))
+            elif not isinstance(end, Position):
+                raise TypeError("End position cannot be {}. Must be Position".format(type(end)))
         self.start = start
         self.end = end
 
     def __repr__(self):
         return "<Range(start={}, end={})>".format(self.start, self.end)
 
+    def to_dict(self) -> dict:
+        ''' Convert to a JSON-serializable dictionary '''
+        # positions are inlined since ranges make up the bulk of most responses
+        start, end = self.start, self.end
+        return {
+            "start": {"line": start.line, "character": start.char},
+            "end": {"line": end.line, "character": end.char}
+        }
+
 class CompletionItem(object):
-    def __init__(self, label: str, kind=CompletionItemKind.CLASS):
+    # "detail", "insertText" and "filterText" are optional, and only sent when set
+    __slots__ = ("label", "kind", "detail", "insertText", "filterText")
+
+    def __init__(self, label: str, kind=CompletionItemKind.CLASS, detail: str=None, insertText: str=None, filterText: str=None):
         ''' Suggested items for the programmer '''
         self.label = str(label)
         self.kind = int(kind)
+        self.detail = detail
+        self.insertText = insertText
+        self.filterText = filterText
 
     def __repr__(self):
         return "<CompletionItem(label={}, kind={:d})>".format(self.label, self.kind)
 
+    def to_dict(self) -> dict:
+        ''' Convert to a JSON-serializable dictionary '''
+        result = {"label": self.label, "kind": self.kind}
+        if self.detail is not None:
+            result["detail"] = self.detail
+        if self.insertText is not None:
+            result["insertText"] = self.insertText
+        if self.filterText is not None:
+            result["filterText"] = self.filterText
+        return result
+
+class CompletionList(object):
+    __slots__ = ("isIncomplete", "items")
+
+    def __init__(self, items: list, isIncomplete: bool=False):
+        ''' A page of completion items
+
+        Incomplete lists tell the client to ask again as the user keeps typing, rather than filtering this page itself
+        '''
+        if VALIDATE:
+            if not all(isinstance(item, CompletionItem) for item in items):
+                raise TypeError("Completion items must all be CompletionItem")
+        self.isIncomplete = bool(isIncomplete)
+        self.items = items
+
+    def __repr__(self):
+        return "<CompletionList(items={:d}, isIncomplete={})>".format(len(self.items), self.isIncomplete)
+
+    def to_dict(self) -> dict:
+        ''' Convert to a JSON-serializable dictionary '''
+        return {"isIncomplete": self.isIncomplete, "items": [item.to_dict() for item in self.items]}
+
 class Diagnostic(object):
-    def __init__(self, locrange: Range, severity: int, message: str, relatedInformation: list=[]):
+    __slots__ = ("message", "range", "relatedInformation", "severity")
+
+    def __init__(self, locrange: Range, severity: int, message: str, relatedInformation: list=None):
         ''' Represents a diagnostic, such as a compiler error or warning
 
         Diagnostic objects are only valid in the scope of a resource.
         '''
+        if relatedInformation is None:
+            relatedInformation = []
+        if VALIDATE:
+            if not isinstance(locrange, Range):
+                raise TypeError("Location range cannot be {}. Must be Range".format(type(locrange)))
+            if not isinstance(relatedInformation, list):
+                raise TypeError("Location range cannot be {}. Must be a list of strings".format(type(relatedInformation)))
         self.message = str(message)
-        if not isinstance(locrange, Range):
-            raise TypeError("Location range cannot be {}. Must be Range".format(type(locrange)))
         self.range = locrange
-        if not isinstance(relatedInformation, list):
-            raise TypeError("Location range cannot be {}. Must be a list of strings".format(type(relatedInformation)))
         self.relatedInformation = relatedInformation
         self.severity = int(severity)
 
     def __repr__(self):
         return "<Diagnostic(severity={:d}, message={})>".format(self.severity, self.message)
 
+    def to_dict(self) -> dict:
+        ''' Convert to a JSON-serializable dictionary '''
+        return {
+            "message": self.message,
+            "range": self.range.to_dict(),
+            "relatedInformation": self.relatedInformation,
+            "severity": self.severity
+        }
+
 class Location(object):
+    __slots__ = ("range", "uri")
+
     def __init__(self, locrange: Range, uri: str):
         ''' Represents a location inside a resource
         such as a line inside a text file
         '''
-        if not isinstance(locrange, Range):
-            raise TypeError("Location range cannot be {}. Must be Range".format(type(locrange)))
+        if VALIDATE:
+            if not isinstance(locrange, Range):
+                raise TypeError("Location range cannot be {}. Must be Range".format(type(locrange)))
         self.range = locrange
         self.uri = str(uri)
 
     def __repr__(self):
         return "<Location(range={}, uri={})>".format(self.range, self.uri)
 
+    def to_dict(self) -> dict:
+        ''' Convert to a JSON-serializable dictionary '''
+        return {"range": self.range.to_dict(), "uri": self.uri}
+
 class MarkupContent(object):
+    __slots__ = ("kind", "value")
+
     def __init__(self, kind: MarkupKind, content: str):
         ''' Represents a string value which content
         is interpreted base on its kind flag
         '''
-        if not isinstance(kind, MarkupKind):
-            raise TypeError("Markup kind cannot be {}. Must be MarkupKind".format(type(kind)))
+        if VALIDATE:
+            if not isinstance(kind, MarkupKind):
+                raise TypeError("Markup kind cannot be {}. Must be MarkupKind".format(type(kind)))
         self.kind = kind
         self.value = str(content)
 
     def __repr__(self):
-        return "<MarkupContent(value={}, kind={:d})>".format(self.value, self.kind)
+        return "<MarkupContent(value={}, kind={})>".format(self.value, self.kind.value)
+
+    def to_dict(self) -> dict:
+        ''' Convert to a JSON-serializable dictionary '''
+        return {"kind": self.kind.value, "value": self.value}
 
 class Hover(object):
+    # "range" is optional, and only set when a range is given
+    __slots__ = ("contents", "range")
+
     def __init__(self, contents: MarkupContent, locrange: Range=None):
         ''' Represents hover information at
         a given text document position
         '''
-        if locrange:
-            if not isinstance(locrange, Range):
+        if VALIDATE:
+            if locrange and not isinstance(locrange, Range):
                 raise TypeError("Location range cannot be {}. Must be Range".format(type(locrange)))
+            if not isinstance(contents, MarkupContent):
+                raise TypeError("Contents cannot be {}. Must be MarkupContent".format(type(contents)))
+        if locrange:
             self.range = locrange
-        if not isinstance(contents, MarkupContent):
-            raise TypeError("Contents cannot be {}. Must be MarkupContent".format(type(contents)))
         self.contents = contents
 
+    def to_dict(self) -> dict:
+        ''' Convert to a JSON-serializable dictionary '''
+        if hasattr(self, "range"):
+            return {"range": self.range.to_dict(), "contents": self.contents.to_dict()}
+        return {"contents": self.contents.to_dict()}
+
 class TextEdit(object):
     ''' A textual edit applicable to a text document. '''
+    __slots__ = ("range", "newText")
+
     def __init__(self, locrange: Range, newText: str):
-        if not isinstance(locrange, Range):
-            raise TypeError("Location range cannot be {}. Must be Range".format(type(locrange)))
+        if VALIDATE:
+            if not isinstance(locrange, Range):
+                raise TypeError("Location range cannot be {}. Must be Range".format(type(locrange)))
+            if not isinstance(newText, str):
+                raise TypeError("NewText cannot be {}. Must be a plaintext string".format(type(newText)))
         self.range = locrange
-        if not isinstance(newText, str):
-            raise TypeError("NewText cannot be {}. Must be a plaintext string".format(type(newText)))
         self.newText = newText
 
     def __repr__(self):
         return "<TextEdit(newText={})>".format(self.newText)
 
+    def to_dict(self) -> dict:
+        ''' Convert to a JSON-serializable dictionary '''
+        return {"range": self.range.to_dict(), "newText": self.newText}
+
 class WorkspaceEdit(object):
-    def __init__(self, file_uri, changes: List=[]):
+    __slots__ = ("changes", "uri")
+
+    def __init__(self, file_uri, changes: List=None):
         '''Represents changes to many resources
         managed in the workspace
 
@@ -181,76 +300,70 @@ class WorkspaceEdit(object):
         use the .append() and .remove() methods to
         modify the workspace changes
         '''
-        if not isinstance(changes, list):
-            raise TypeError("Changes cannot be {}. Must be a list of TextEdits".format(type(changes)))
+        if changes is None:
+            changes = []
+        if VALIDATE:
+            if not isinstance(changes, list):
+                raise TypeError("Changes cannot be {}. Must be a list of TextEdits".format(type(changes)))
         self.changes = changes
         self.uri = file_uri
 
     def append(self, change: TextEdit):
-        if not isinstance(change, TextEdit):
-            raise TypeError("Change cannot be {}. Must be TextEdit".format(type(change)))
+        if VALIDATE:
+            if not isinstance(change, TextEdit):
+                raise TypeError("Change cannot be {}. Must be TextEdit".format(type(change)))
         return self.changes.append(change)
 
     def __repr__(self):
         return "<WorkspaceEdit(changes={:d})>".format(len(self.changes))
 
+    def to_dict(self) -> dict:
+        ''' Convert to a JSON-serializable dictionary '''
+        return {"changes": {self.uri: [change.to_dict() for change in self.changes]}}
+
+def _to_serializable(obj):
+    ''' Convert a protocol object into built-in types that any JSON encoder understands '''
+    if isinstance(obj, Enum):
+        return obj.value
+    to_dict = getattr(obj, "to_dict", None)
+    if to_dict is None:
+        raise TypeError("Object of type {} is not JSON serializable".format(type(obj).__name__))
+    return to_dict()
+
 class JSONEncoder(json.JSONEncoder):
     def default(self, obj):
         ''' Custom JSON encoder '''
-        if isinstance(obj, CompletionItem):
-            return {
-                "label": obj.label,
-                "kind": obj.kind
-            }
-        elif isinstance(obj, Diagnostic):
-            return {
-                "message": obj.message,
-                "range": obj.range,
-                "relatedInformation": obj.relatedInformation,
-                "severity": obj.severity
-            }
-        elif isinstance(obj, Hover):
-            if hasattr(obj, "range"):
-                return {
-                    "range": obj.range,
-                    "contents": obj.contents
-                }
-            else:
-                return {
-                    "contents": obj.contents
-                }
-        elif isinstance(obj, Location):
-            return {
-                "range": obj.range,
-                "uri": obj.uri
-            }
-        elif isinstance(obj, MarkupContent):
-            return {
-                "kind": obj.kind,
-                "value": obj.value
-            }
-        elif isinstance(obj, MarkupKind):
-            return obj.value
-        elif isinstance(obj, Position):
-            return {
-                "line": obj.line,
-                "character": obj.char
-            }
-        elif isinstance(obj, Range):
-            return {
-                "start": obj.start,
-                "end": obj.end
-            }
-        elif isinstance(obj, TextEdit):
-            return {
-                "range": obj.range,
-                "newText": obj.newText
-            }
-        elif isinstance(obj, WorkspaceEdit):
-            return {
-                "changes": {
-                    obj.uri: obj.changes
-                }
-            }
-        else:
-            super().default(obj)
+        return _to_serializable(obj)
+
+def dumps(obj) -> bytes:
+    '''Serialize a message containing protocol objects to UTF-8 encoded JSON
+
+    Uses orjson when it's installed, falling back to the standard library otherwise
+
+    :obj: Message to serialize
+    '''
+    if HAS_ORJSON:
+        try:
+            return orjson.dumps(obj, default=_to_serializable)
+        except TypeError:
+            # orjson is stricter about things like integer sizes and surrogates
+            pass
+    try:
+        # non-ASCII characters are left as-is, since they take fewer bytes than escape sequences
+        return json.dumps(obj, cls=JSONEncoder, ensure_ascii=False).encode("utf-8")
+    except UnicodeEncodeError:
+        # lone surrogates can't be encoded as UTF-8, but they can be escaped
+        return json.dumps(obj, cls=JSONEncoder).encode("ascii")
+
+def loads(data: bytes):
+    '''Deserialize a JSON message straight from the bytes it was received as
+
+    :data: UTF-8 encoded JSON
+    '''
+    if HAS_ORJSON:
+        try:
+            return orjson.loads(data)
+        except ValueError:
+            # orjson rejects some input the standard library accepts, such as lone surrogates
+            pass
+    return json.loads(data)
@@ -0,0 +1,96 @@
+''' Record the JSON-RPC traffic between the server and its clients, so sessions can be replayed later '''
+from itertools import count
+import json
+from pathlib import Path
+import threading
+import time
+from typing import Union
+from weakref import WeakKeyDictionary
+
+
+class SessionRecorder(object):
+    def __init__(self, path: Path):
+        '''Append every message the server reads or writes to a file, one JSON object per line
+
+        Each line has the seconds since recording started, the client the message
+        belongs to, its direction ("recv" from the client or "send" to it) and the
+        message itself. "connect" and "disconnect" events mark where each client's
+        session starts and ends
+
+        :path: File to append the recording to
+        '''
+        self.path = Path(path)
+        self._file = open(str(self.path), "a", encoding="utf-8")
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+        self._client_ids = count(1)
+        # reader or writer => id of the client it belongs to
+        self._clients = WeakKeyDictionary()
+
+    def __repr__(self):
+        return "<SessionRecorder(path={})>".format(self.path)
+
+    def _client(self, stream) -> int:
+        client = self._clients.get(stream, None)
+        if client is None:
+            client = self._clients[stream] = next(self._client_ids)
+        return client
+
+    def _write(self, line: str):
+        with self._lock:
+            if not self._file.closed:
+                self._file.write(line)
+                # flush every line, so a recording survives the server crashing
+                self._file.flush()
+
+    def _event(self, stream, event: str):
+        self._write(json.dumps({"time": round(time.monotonic() - self._start, 6), "client": self._client(stream), "event": event}) + "\n")
+
+    def connect(self, reader, writer):
+        '''Start recording a new client's session
+
+        :reader: Stream the client's messages are read from
+        :writer: Stream the client's messages are written to
+        '''
+        self._clients[writer] = self._client(reader)
+        self._event(reader, "connect")
+
+    def disconnect(self, reader):
+        '''Mark the end of a client's session
+
+        :reader: Stream the client's messages were read from
+        '''
+        self._event(reader, "disconnect")
+
+    def record(self, stream, direction: str, message: Union[bytes, str]):
+        '''Record a single message
+
+        :stream: Reader or writer the message went through
+        :direction: "recv" for messages from the client, "send" for messages to it
+        :message: Encoded JSON-RPC message, which is embedded as-is rather than serialized again
+        '''
+        if isinstance(message, bytes):
+            message = message.decode("utf-8")
+        if "\n" in message:
+            # clients may pretty-print their messages, but each entry has to stay on one line
+            message = json.dumps(json.loads(message))
+        header = json.dumps({"time": round(time.monotonic() - self._start, 6), "client": self._client(stream), "direction": direction})
+        self._write('{}, "message": {}}}\n'.format(header[:-1], message))
+
+    def close(self):
+        ''' Stop recording '''
+        with self._lock:
+            self._file.close()
+
+def load_recording(path: Path) -> list:
+    '''Read back every entry of a recording, in the order they were recorded
+
+    :path: File written by a SessionRecorder
+    '''
+    entries = []
+    with open(str(path), encoding="utf-8") as recording:
+        for line in recording:
+            line = line.strip()
+            if line:
+                entries.append(json.loads(line))
+    return entries
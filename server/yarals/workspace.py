@@ -0,0 +1,122 @@
+''' Workspace state shared by every client that opens the same folder '''
+from itertools import chain
+import logging
+from pathlib import Path
+
+from yarals.index import SymbolIndex
+
+
+class Workspace(object):
+    def __init__(self, root: Path=None):
+        '''Rule files, symbols and build results under a single root folder
+
+        Only on-disk contents are tracked here. Each client keeps its own
+        unsaved buffers as an overlay on top, so one client's edits never
+        leak into what the others see
+
+        :root: (Optional) Root directory of the workspace. Workspaces without one only know about open files
+        '''
+        self.root = Path(root) if root else None
+        # rule name => declarations across the workspace
+        self.index = SymbolIndex()
+        # results of the last CompileAllRules run in the workspace. Loaded on first use
+        self.manifest = None
+        # background task indexing the workspace, started by the first client to open it
+        self.indexer = None
+        # background task polling for changes, for clients that can't watch files themselves
+        self.poller = None
+        # whether file changes are being reported, either by a client or by the poller
+        self.watched = False
+        # every rule file found while indexing, kept up to date while the workspace is watched
+        self.known_files = None
+        # number of connected clients using this workspace
+        self.clients = 0
+
+    def __repr__(self):
+        return "<Workspace(root={}, clients={:d})>".format(self.root, self.clients)
+
+    def files(self):
+        ''' Iterate over every YARA rule file in the workspace '''
+        if self.root:
+            yield from chain(self.root.glob("**/*.yara"), self.root.glob("**/*.yar"))
+
+    def stat_files(self) -> list:
+        '''Get the URI and stat() results of every YARA rule file in the workspace
+
+        Once the workspace is watched, the files found while indexing are used instead of searching the whole tree again
+        '''
+        results = []
+        files = self.known_files if self.watched and self.known_files is not None else self.files()
+        for file in list(files):
+            try:
+                results.append((file.as_uri(), file.stat()))
+            except OSError:
+                continue
+        return results
+
+    def snapshot(self, files: list=None) -> dict:
+        '''Get the modification time and size of every YARA rule file in the workspace, keyed by file URI
+
+        :files: (Optional) Paths of the files to check. Defaults to searching the whole workspace
+        '''
+        results = {}
+        for file in (self.files() if files is None else files):
+            try:
+                stat = file.stat()
+            except OSError:
+                continue
+            results[file.as_uri()] = (stat.st_mtime_ns, stat.st_size)
+        return results
+
+class WorkspacePool(object):
+    def __init__(self):
+        '''Reference-counted workspaces, keyed by their resolved root directory
+
+        Clients opening the same folder share a single Workspace, so the
+        folder is only indexed once no matter how many clients connect
+        '''
+        self._logger = logging.getLogger("yara")
+        # resolved root directory => Workspace
+        self._workspaces = {}
+
+    def __contains__(self, root: Path) -> bool:
+        return self._key(root) in self._workspaces
+
+    def __len__(self) -> int:
+        return len(self._workspaces)
+
+    @staticmethod
+    def _key(root: Path) -> Path:
+        return Path(root).resolve()
+
+    def acquire(self, root: Path=None) -> Workspace:
+        '''Get the workspace for a root directory, creating it for the first client to open it
+
+        :root: (Optional) Root directory of the workspace. Clients without one each get a private workspace
+        '''
+        if not root:
+            workspace = Workspace()
+        else:
+            key = self._key(root)
+            workspace = self._workspaces.get(key, None)
+            if workspace is None:
+                workspace = self._workspaces[key] = Workspace(root)
+            else:
+                self._logger.info("Sharing workspace %s with %d other client(s)", workspace.root, workspace.clients)
+        workspace.clients += 1
+        return workspace
+
+    def release(self, workspace: Workspace):
+        '''Stop using a workspace, dropping it once its last client is gone
+
+        :workspace: Workspace previously returned by acquire()
+        '''
+        workspace.clients -= 1
+        if workspace.clients > 0 or workspace.root is None:
+            return
+        if self._workspaces.get(self._key(workspace.root), None) is workspace:
+            del self._workspaces[self._key(workspace.root)]
+        for task in (workspace.indexer, workspace.poller):
+            if task is not None:
+                task.cancel()
+        self._logger.info("Closed workspace %s", workspace.root)
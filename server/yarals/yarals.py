@@ -1,21 +1,29 @@
 ''' Implements a VSCode language server for YARA '''
 import asyncio
-from copy import deepcopy
-from itertools import chain
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain, count
 import json
 import logging
-from pathlib import Path
+import os
 import re
+from pathlib import Path
+from typing import Union
+from weakref import WeakKeyDictionary
 
+from yarals import compiler
+from yarals.compiler import HAS_YARA
+from yarals.completion import ModuleTrie
 from yarals import custom_err as ce
 from yarals import helpers
+from yarals.documents import DocumentCache, DocumentSnapshot, TextDocument, get_document, restore_snapshot
+from yarals.manifest import BuildManifest, get_manifest_path
+from yarals.metrics import Metrics
+from yarals.parser import RuleNode
 from yarals import protocol as lsp
+from yarals.workspace import Workspace, WorkspacePool
 
-try:
-    import yara
-    HAS_YARA = True
-except ModuleNotFoundError:
-    HAS_YARA = False
+if not HAS_YARA:
     # cannot notify user at this point unfortunately - no clients have connected
     logging.warning("yara-python is not installed. Diagnostics and Compile commands are disabled")
 
@@ -29,8 +37,13 @@ class LanguageServer(object):
         ''' Handle the details of the VSCode language server protocol '''
         asyncio.get_event_loop().set_exception_handler(self._exc_handler)
         self._encoding = "utf-8"
-        self._eol=b"\r\n"
         self._logger = logging.getLogger(__name__)
+        # writer => lock serializing the messages sent to it
+        self._write_locks = WeakKeyDictionary()
+        # ids for requests the server sends to its clients
+        self._request_ids = count(1)
+        # records the traffic with every client when set, see yarals.recorder
+        self.recorder = None
         self.num_clients = 0
 
     def _exc_handler(self, loop, context: dict):
@@ -61,18 +74,27 @@ class LanguageServer(object):
         ''' Read data from the client '''
         # we don't want handle_client() to deal with anything other than dicts
         request = {}
-        data = await reader.readline()
-        if data:
-            # self._logger.debug("header <= %r", data)
-            key, value = tuple(data.decode(self._encoding).strip().split(" "))
-            # read the extra separator after the initial header
-            await reader.readuntil(separator=self._eol)
-            if key == "Content-Length:":
-                data = await reader.readexactly(int(value))
-            else:
-                data = await reader.readline()
+        headers = {}
+        # headers are terminated by an empty line, and may come in any order
+        while True:
+            line = await reader.readline()
+            if not line:
+                # the client disconnected
+                return request
+            line = line.rstrip(b"\r\n")
+            if not line:
+                break
+            key, _, value = line.decode("ascii").partition(":")
+            headers[key.strip().lower()] = value.strip()
+        if "content-length" in headers:
+            data = await reader.readexactly(int(headers["content-length"]))
+        else:
+            data = await reader.readline()
+        if self._logger.isEnabledFor(logging.DEBUG):
             self._logger.debug("input <= %r", data)
-            request = json.loads(data.decode(self._encoding))
+        request = lsp.loads(data)
+        if self.recorder is not None:
+            self.recorder.record(reader, "recv", data)
         return request
 
     async def remove_client(self, writer: asyncio.StreamWriter):
@@ -85,59 +107,428 @@ class LanguageServer(object):
 
     async def send_error(self, code: int, curr_id: int, msg: str, writer: asyncio.StreamWriter):
         ''' Write back a JSON-RPC error message to the client '''
-        message = json.dumps({
+        message = lsp.dumps({
             "jsonrpc": "2.0",
             "id": curr_id,
             "error": {
                 "code": code,
                 "message": msg
             }
-        }, cls=lsp.JSONEncoder)
+        })
         await self.write_data(message, writer)
 
     async def send_notification(self, method: str, params: dict, writer: asyncio.StreamWriter):
         ''' Write back a JSON-RPC notification to the client '''
-        message = json.dumps({
+        message = lsp.dumps({
             "jsonrpc": "2.0",
             "method": method,
             "params": params
-        }, cls=lsp.JSONEncoder)
+        })
+        await self.write_data(message, writer)
+
+    async def send_request(self, curr_id: int, method: str, params: dict, writer: asyncio.StreamWriter):
+        ''' Write a JSON-RPC request to the client '''
+        message = lsp.dumps({
+            "jsonrpc": "2.0",
+            "id": curr_id,
+            "method": method,
+            "params": params
+        })
         await self.write_data(message, writer)
 
     async def send_response(self, curr_id: int, response: dict, writer: asyncio.StreamWriter):
         ''' Write back a JSON-RPC response to the client '''
-        message = json.dumps({
+        message = lsp.dumps({
             "jsonrpc": "2.0",
             "id": curr_id,
             "result": response,
-        }, cls=lsp.JSONEncoder)
+        })
         await self.write_data(message, writer)
 
-    async def write_data(self, message: str, writer: asyncio.StreamWriter):
-        ''' Write a JSON-RPC message to the given stream with the proper encoding and formatting '''
-        self._logger.debug("output => %r", message.encode(self._encoding))
-        writer.write("Content-Length: {:d}\r\n\r\n{:s}".format(len(message), message).encode(self._encoding))
-        await writer.drain()
+    async def write_data(self, message: Union[bytes, str], writer: asyncio.StreamWriter):
+        '''Write a JSON-RPC message to the given stream with the proper encoding and formatting
+
+        :message: JSON-RPC message. Strings are encoded first, since Content-Length counts bytes
+        :writer: asyncio.StreamWriter to write the message to
+        '''
+        if isinstance(message, str):
+            message = message.encode(self._encoding)
+        header = b"Content-Length: %d\r\n\r\n" % len(message)
+        # requests are answered concurrently, so take turns writing to each client
+        lock = self._write_locks.get(writer, None)
+        if lock is None:
+            lock = self._write_locks[writer] = asyncio.Lock()
+        async with lock:
+            if self._logger.isEnabledFor(logging.DEBUG):
+                self._logger.debug("output => %r", message)
+            if self.recorder is not None:
+                self.recorder.record(writer, "send", message)
+            # write the header and body separately so large messages aren't copied into a new buffer
+            writer.write(header)
+            writer.write(message)
+            await writer.drain()
+
+# how the server reacts to a single JSON-RPC method
+#   capability: server capability that must have been announced to the client, if any
+#   requires_start: ignore (or reject) the message until the client sends "initialized"
+#   concurrent: answer the request in its own task instead of on the read loop. The callback
+#       is also given a snapshot of the document the request refers to, taken when it arrived
+Handler = namedtuple("Handler", ["callback", "capability", "requires_start", "concurrent"])
+
+class ClientSession(object):
+    def __init__(self, writer: asyncio.StreamWriter):
+        ''' Everything the server keeps track of for a single connected client '''
+        self.writer = writer
+        self.config = {}
+        self.capabilities = set()
+        self.has_started = False
+        # whether the client can watch files for the server
+        self.can_watch_files = False
+        # workspace the client opened, shared with any other client that opened the same folder
+        self.workspace = None
+        # file_uri => TextDocument. Documents the client has open, layered over the shared workspace
+        self.dirty_files = {}
+        # file_uri => debounced compile-as-you-type task
+        self.pending_compiles = {}
+        # request id => task answering it
+        self.requests = {}
+        # id of a request sent to the client => future resolved with its response
+        self.responses = {}
 
 class YaraLanguageServer(LanguageServer):
-    def __init__(self):
-        ''' Handle the particulars of the server's YARA implementation '''
+    def __init__(self, compile_workers: int=None, poll_interval: float=2.0, rescan_interval: float=60.0):
+        '''Handle the particulars of the server's YARA implementation
+
+        :compile_workers: (Optional) Number of threads to compile rules with. Defaults to the number of CPUs
+        :poll_interval: (Optional) Seconds between checking workspaces for changed files,
+            for clients that can't watch files themselves. 0 disables polling
+        :rescan_interval: (Optional) Seconds between searching the whole workspace for new files while polling.
+            In between, only the files already known are checked
+        '''
         super().__init__()
         self._logger = logging.getLogger("yara")
         # variable symbols have a few possible first characters
         self._varchar = ["$", "#", "@", "!"]
         self.diagnostics_warned = False
         self.hover_langs = [lsp.MarkupKind.Markdown, lsp.MarkupKind.Plaintext]
-        schema = Path(__file__).parent.joinpath("data", "modules.json").resolve()
-        self.modules = json.loads(schema.read_text())
+        # resolved root directory => Workspace shared by every client that opened it
+        self.workspaces = WorkspacePool()
+        # used when no workspace is given, e.g. when providers are called directly
+        self.workspace = Workspace()
+        # documents read from disk, so requests on saved files don't re-read them every time
+        self.document_cache = DocumentCache()
+        # compilation results keyed by rule text, so unchanged files are not compiled again
+        self.compile_cache = compiler.CompileCache()
+        self.keep_compiled_rules = False
+        # yara-python releases the GIL while compiling, so threads keep the event loop free without any pickling
+        self.compile_workers = compile_workers or os.cpu_count() or 1
+        self.executor = ThreadPoolExecutor(max_workers=self.compile_workers, thread_name_prefix="yara-compile")
+        self.poll_interval = max(float(poll_interval), 0)
+        self.rescan_interval = max(float(rescan_interval), 0)
+        # module name => completion schema. Loaded on the first completion request
+        self._modules = None
+        # completion items for every module member, built from the schema on first use
+        self._module_trie = None
+        # method => per-method call counts, errors and latencies
+        self.metrics = Metrics()
+        self.handlers = {
+            "initialize": Handler(self._on_initialize, None, requires_start=False, concurrent=False),
+            "initialized": Handler(self._on_initialized, None, requires_start=False, concurrent=False),
+            "shutdown": Handler(self._on_shutdown, None, requires_start=True, concurrent=False),
+            "exit": Handler(self._on_exit, None, requires_start=True, concurrent=False),
+            "$/cancelRequest": Handler(self._on_cancel_request, None, requires_start=False, concurrent=False),
+            "workspace/didChangeConfiguration": Handler(self._on_change_configuration, None, requires_start=True, concurrent=False),
+            "workspace/didChangeWatchedFiles": Handler(self._on_change_watched_files, None, requires_start=True, concurrent=False),
+            "textDocument/didOpen": Handler(self._on_open, None, requires_start=True, concurrent=False),
+            "textDocument/didChange": Handler(self._on_change, None, requires_start=True, concurrent=False),
+            "textDocument/didClose": Handler(self._on_close, None, requires_start=True, concurrent=False),
+            "textDocument/didSave": Handler(self._on_save, None, requires_start=True, concurrent=False),
+            "textDocument/completion": Handler(self._on_completion, "completionProvider", requires_start=True, concurrent=True),
+            "textDocument/definition": Handler(self._on_definition, "definitionProvider", requires_start=True, concurrent=True),
+            "textDocument/hover": Handler(self._on_hover, "hoverProvider", requires_start=True, concurrent=True),
+            "textDocument/references": Handler(self._on_references, "referencesProvider", requires_start=True, concurrent=True),
+            "textDocument/rename": Handler(self._on_rename, "renameProvider", requires_start=True, concurrent=True),
+            "workspace/executeCommand": Handler(self._on_execute_command, "executeCommandProvider", requires_start=True, concurrent=True)
+        }
+
+    @property
+    def modules(self) -> dict:
+        ''' Schema of every module's members, used to complete module symbols '''
+        if self._modules is None:
+            self._modules = helpers.load_module_schema()
+        return self._modules
+
+    @property
+    def module_trie(self) -> ModuleTrie:
+        ''' Completion items for every module member, indexed by dotted path '''
+        if self._module_trie is None:
+            self._module_trie = ModuleTrie(self.modules)
+        return self._module_trie
 
     def _get_document(self, file_uri: str, dirty_files: dict) -> str:
         ''' Return the document text for a given file URI either from disk or memory '''
+        return self._get_text_document(file_uri, dirty_files).text
+
+    def _get_text_document(self, file_uri: str, dirty_files: dict) -> TextDocument:
+        ''' Return the TextDocument for a given file URI either from disk or memory '''
         if file_uri in dirty_files:
-            return dirty_files[file_uri]
+            return get_document(dirty_files[file_uri], file_uri)
+        file_path = helpers.parse_uri(file_uri, encoding=self._encoding)
+        return self.document_cache.read(file_path, file_uri)
+
+    @staticmethod
+    def _snapshot_document(message: dict, session: ClientSession) -> DocumentSnapshot:
+        ''' Capture the open document a request refers to, before any changes that arrive after it are applied '''
+        file_uri = message.get("params", {}).get("textDocument", {}).get("uri", None)
+        document = session.dirty_files.get(file_uri, None)
+        return document.snapshot() if document is not None else None
+
+    def _request_document(self, file_uri: str, snapshot: DocumentSnapshot) -> TextDocument:
+        '''Get the document a request should be answered against
+
+        :file_uri: URI of the document the request refers to
+        :snapshot: Snapshot of the document when the request arrived, or None if it wasn't open
+        '''
+        if snapshot is not None:
+            return restore_snapshot(snapshot)
+        return self._get_text_document(file_uri, {})
+
+    @staticmethod
+    def _overlay(document: TextDocument, dirty_files: dict=None) -> dict:
+        ''' Layer the document being worked on and a client's unsaved buffers over the shared workspace '''
+        overlay = {file_uri: get_document(text, file_uri) for file_uri, text in (dirty_files or {}).items()}
+        overlay[document.uri] = document
+        return overlay
+
+    def _schedule_diagnostic(self, pending: dict, document: TextDocument, delay: float, writer: asyncio.StreamWriter):
+        '''(Re-)start the countdown to compile a document that is being edited
+
+        :pending: Debounced compile tasks for this client, keyed by file URI
+        :document: TextDocument that just changed
+        :delay: Seconds to wait for more changes before compiling
+        :writer: asyncio.StreamWriter to publish diagnostics to
+        '''
+        self._cancel_diagnostic(pending, document.uri)
+        pending[document.uri] = asyncio.ensure_future(self._debounced_diagnostic(pending, document, delay, writer))
+
+    def _cancel_diagnostic(self, pending: dict, file_uri: str):
+        ''' Stop any debounced or in-flight compile for a document '''
+        task = pending.pop(file_uri, None)
+        if task is not None:
+            task.cancel()
+
+    async def _debounced_diagnostic(self, pending: dict, document: TextDocument, delay: float, writer: asyncio.StreamWriter):
+        ''' Compile a document once edits settle down, dropping the results if it changed in the meantime '''
+        try:
+            await asyncio.sleep(delay)
+            version = document.version
+            diagnostics = await self.provide_diagnostic(document.text)
+            # the compile itself can't be interrupted, so anything that finishes after a newer edit is stale
+            if document.version != version:
+                return
+            params = {
+                "uri": document.uri,
+                "version": version,
+                "diagnostics": diagnostics
+            }
+            await self.send_notification("textDocument/publishDiagnostics", params, writer)
+        except (ce.NoYaraPython, ce.DiagnosticError) as err:
+            await self._show_error(err, writer)
+        finally:
+            if pending.get(document.uri, None) is asyncio.current_task():
+                del pending[document.uri]
+
+    async def _on_initialize(self, message: dict, session: ClientSession) -> dict:
+        ''' Announce the server's capabilities and start indexing the client's workspace '''
+        rootdir = helpers.parse_uri(message["params"]["rootUri"], encoding=self._encoding)
+        if rootdir:
+            self._logger.info("Client workspace folder: %s", rootdir)
+        else:
+            self._logger.info("No client workspace specified")
+        # a client re-initializing may be switching to a different folder
+        if session.workspace is not None:
+            self.workspaces.release(session.workspace)
+        session.workspace = self.workspaces.acquire(rootdir)
+        client_options = message.get("params", {}).get("capabilities", {})
+        announcement = self.initialize(client_options)
+        session.capabilities = set(announcement["capabilities"])
+        watch_options = client_options.get("workspace", {}).get("didChangeWatchedFiles", {})
+        session.can_watch_files = bool(watch_options.get("dynamicRegistration", False))
+        # only the first client to open a folder has to index it
+        if session.workspace.root and session.workspace.indexer is None:
+            session.workspace.indexer = asyncio.ensure_future(self.index_workspace(session.workspace))
+        return announcement
+
+    async def _on_initialized(self, message: dict, session: ClientSession):
+        self._logger.info("Client has been successfully initialized")
+        session.has_started = True
+        params = {"type": lsp.MessageType.INFO, "message": "Successfully connected"}
+        await self.send_notification("window/showMessageRequest", params, session.writer)
+        if session.workspace is not None and session.workspace.root and session.workspace.root.is_dir():
+            asyncio.ensure_future(self._watch_workspace(session))
+
+    async def _on_shutdown(self, message: dict, session: ClientSession) -> dict:
+        self._logger.info("Client requested shutdown")
+        self._logger.info("Request metrics: %s", json.dumps(self.metrics.summary()))
+        # explicitly clear the dirty files on shutdown
+        session.dirty_files.clear()
+        return {}
+
+    async def _on_exit(self, message: dict, session: ClientSession):
+        # first remove the client associated with this handler
+        await self.remove_client(session.writer)
+        raise ce.ServerExit("Server exiting process per client request")
+
+    async def _on_cancel_request(self, message: dict, session: ClientSession):
+        request_id = message.get("params", {}).get("id", None)
+        if request_id in session.requests:
+            self._logger.debug("Client cancelled request %s", request_id)
+            session.requests[request_id].cancel()
+
+    async def _on_change_configuration(self, message: dict, session: ClientSession):
+        session.config = message.get("params", {}).get("settings", {}).get("yara", {})
+        self._logger.debug("Changed workspace config to %s", json.dumps(session.config))
+
+    async def _on_change_watched_files(self, message: dict, session: ClientSession):
+        changes = [(change.get("uri", ""), change.get("type", None)) for change in message.get("params", {}).get("changes", [])]
+        await self.apply_file_changes(session.workspace, changes)
+
+    async def _on_open(self, message: dict, session: ClientSession):
+        text_document = message.get("params", {}).get("textDocument", {})
+        file_uri = text_document.get("uri", None)
+        if file_uri:
+            self._logger.debug("Adding %s to dirty files list", file_uri)
+            # the client's buffer is the source of truth from now on, whether or not it was ever saved
+            session.dirty_files[file_uri] = TextDocument(file_uri, text_document.get("text", ""), int(text_document.get("version", 0)))
+
+    async def _on_change(self, message: dict, session: ClientSession):
+        text_document = message.get("params", {}).get("textDocument", {})
+        file_uri = text_document.get("uri", None)
+        if file_uri:
+            document = session.dirty_files.get(file_uri, None)
+            if document is None:
+                # incremental changes are relative to the text sent with didOpen, which can't be recovered from disk
+                self._logger.warning("Ignoring changes to %s, which was never opened", file_uri)
+                return
+            for change in message.get("params", {}).get("contentChanges", []):
+                document.apply_change(change, version=text_document.get("version", None))
+            if session.workspace is not None:
+                # clients don't have to send versions, so the old symbols can't be told apart by version alone
+                session.workspace.index.discard_document(document)
+            if session.config.get("compile_on_change", False):
+                delay = max(float(session.config.get("compile_on_change_delay", 300)), 0) / 1000
+                self._schedule_diagnostic(session.pending_compiles, document, delay, session.writer)
+
+    async def _on_close(self, message: dict, session: ClientSession):
+        file_uri = message.get("params", {}).get("textDocument", {}).get("uri", "")
+        self._cancel_diagnostic(session.pending_compiles, file_uri)
+        # file is no longer dirty after closing. Unsaved changes only ever lived in this client's overlay
+        if file_uri in session.dirty_files:
+            del session.dirty_files[file_uri]
+            self._logger.debug("Removed %s from dirty files list", file_uri)
+
+    async def _on_save(self, message: dict, session: ClientSession):
+        file_uri = message.get("params", {}).get("textDocument", {}).get("uri", "")
+        # the saved file is about to be compiled (or cleared), so drop any live compiles
+        self._cancel_diagnostic(session.pending_compiles, file_uri)
+        # the document stays open until didClose, so later edits still apply on top of the client's buffer.
+        # Saved changes are on disk, so every client sharing the workspace should see them
         file_path = helpers.parse_uri(file_uri, encoding=self._encoding)
-        with open(file_path, "r") as rule_file:
-            return rule_file.read()
+        if file_path:
+            self.document_cache.invalidate(file_path)
+        self._reindex(session.workspace, file_uri)
+        if session.config.get("compile_on_save", False):
+            file_path = helpers.parse_uri(file_uri)
+            with open(file_path, "rb") as ifile:
+                document = ifile.read().decode(self._encoding)
+            diagnostics = await self.provide_diagnostic(document)
+        else:
+            diagnostics = []
+        params = {
+            "uri": file_uri,
+            "diagnostics": diagnostics
+        }
+        await self.send_notification("textDocument/publishDiagnostics", params, session.writer)
+
+    async def _on_completion(self, message: dict, session: ClientSession, snapshot: DocumentSnapshot=None) -> lsp.CompletionList:
+        file_uri = message.get("params", {}).get("textDocument", {}).get("uri", None)
+        if file_uri:
+            document = self._request_document(file_uri, snapshot)
+            max_items = int(session.config.get("completion_max_items", 100))
+            return await self.provide_code_completion(message["params"], document, max_items, session.workspace, session.dirty_files)
+
+    async def _on_definition(self, message: dict, session: ClientSession, snapshot: DocumentSnapshot=None) -> list:
+        file_uri = message.get("params", {}).get("textDocument", {}).get("uri", None)
+        if file_uri:
+            document = self._request_document(file_uri, snapshot)
+            return await self.provide_definition(message["params"], document, session.workspace, session.dirty_files)
+
+    async def _on_hover(self, message: dict, session: ClientSession, snapshot: DocumentSnapshot=None) -> lsp.Hover:
+        file_uri = message.get("params", {}).get("textDocument", {}).get("uri", None)
+        if file_uri:
+            document = self._request_document(file_uri, snapshot)
+            return await self.provide_hover(message["params"], document, session.workspace, session.dirty_files)
+
+    async def _on_references(self, message: dict, session: ClientSession, snapshot: DocumentSnapshot=None) -> list:
+        file_uri = message.get("params", {}).get("textDocument", {}).get("uri", None)
+        if file_uri:
+            document = self._request_document(file_uri, snapshot)
+            return await self.provide_reference(message["params"], document, session.workspace, session.dirty_files)
+
+    async def _on_rename(self, message: dict, session: ClientSession, snapshot: DocumentSnapshot=None) -> lsp.WorkspaceEdit:
+        file_uri = message.get("params", {}).get("textDocument", {}).get("uri", None)
+        if file_uri:
+            document = self._request_document(file_uri, snapshot)
+            return await self.provide_rename(message["params"], document, file_uri)
+
+    async def _on_execute_command(self, message: dict, session: ClientSession, snapshot: DocumentSnapshot=None):
+        await self.execute_command(message["params"], session.dirty_files, session.writer, session.config, session.workspace)
+
+    async def _dispatch(self, method: str, message: dict, session: ClientSession, *args):
+        ''' Call the handler registered for a message, recording how long it took '''
+        with self.metrics.measure(method):
+            return await self.handlers[method].callback(message, session, *args)
+
+    async def _run_request(self, message: dict, session: ClientSession, snapshot: DocumentSnapshot=None):
+        '''Answer a request, unless the client cancels it first
+
+        :message: Request sent by the client
+        :session: State of the client that sent the request
+        :snapshot: (Optional) Document the request refers to, as it was when the request arrived
+        '''
+        try:
+            result = await self._dispatch(message["method"], message, session, snapshot)
+            # once the result is ready the request can no longer be cancelled
+            session.requests.pop(message["id"], None)
+            await self.send_response(message["id"], result, session.writer)
+        except asyncio.CancelledError:
+            self._logger.debug("Cancelled request %s", message["id"])
+            if not session.writer.is_closing():
+                await self.send_error(lsp.JsonRPCError.REQUEST_CANCELLED, message["id"], "Request cancelled", session.writer)
+        except (ce.NoYaraPython, ce.CodeCompletionError, ce.DefinitionError, ce.DiagnosticError, ce.HighlightError, \
+                ce.HoverError, ce.RenameError, ce.SymbolReferenceError) as err:
+            await self._show_error(err, session.writer)
+        except Exception as err:
+            # nothing else is waiting on this task, so answer the request rather than leave the client hanging
+            self._logger.exception(err)
+            if not session.writer.is_closing():
+                await self.send_error(lsp.JsonRPCError.INTERNAL_ERROR, message["id"], str(err), session.writer)
+        finally:
+            session.requests.pop(message["id"], None)
+
+    async def _show_error(self, err: Exception, writer: asyncio.StreamWriter):
+        ''' Let the user know a provider failed '''
+        if isinstance(err, ce.NoYaraPython):
+            self._logger.warning(err)
+            msg_type = lsp.MessageType.WARNING
+        else:
+            self._logger.error(err)
+            msg_type = lsp.MessageType.ERROR
+        params = {
+            "type": msg_type,
+            "message": str(err)
+        }
+        await self.send_notification("window/showMessage", params, writer)
 
     async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
         '''React and respond to client messages
@@ -145,21 +536,29 @@ class YaraLanguageServer(LanguageServer):
         :reader: asyncio StreamReader. The connected client will write to this stream
         :writer: asyncio.StreamWriter. The connected client will read from this stream
         '''
-        config = {}
-        # file_uri => contents
-        dirty_files = {}
-        has_started = False
+        session = ClientSession(writer)
         self._logger.info("Client connected")
+        if self.recorder is not None:
+            self.recorder.connect(reader, writer)
         self.num_clients += 1
         while True:
+            message = {}
             try:
                 if reader.at_eof():
                     self._logger.warning("Client has closed")
                     self.num_clients -= 1
+                    for file_uri in list(session.pending_compiles):
+                        self._cancel_diagnostic(session.pending_compiles, file_uri)
+                    for task in chain(session.requests.values(), session.responses.values()):
+                        task.cancel()
+                    if session.workspace is not None:
+                        self.workspaces.release(session.workspace)
+                    if self.recorder is not None:
+                        self.recorder.disconnect(reader)
                     break
                 elif self.num_clients <= 0:
                     # clear out memory
-                    dirty_files.clear()
+                    session.dirty_files.clear()
                     # remove connected clients
                     await self.remove_client(writer)
                 message = await self.read_request(reader)
@@ -167,121 +566,42 @@ class YaraLanguageServer(LanguageServer):
                 if "jsonrpc" in message:
                     method = message.get("method", "")
                     self._logger.debug("Client sent a '%s' message", method)
+                    handler = self.handlers.get(method, None)
+                    # if there is no method, this is a response to a request the server sent
+                    if "method" not in message:
+                        future = session.responses.pop(message.get("id", None), None)
+                        if future is not None and not future.done():
+                            future.set_result(message)
                     # if an id is present, this is a JSON-RPC request
-                    if "id" in message:
-                        if not has_started and method == "initialize":
-                            rootdir = helpers.parse_uri(message["params"]["rootUri"], encoding=self._encoding)
-                            if rootdir:
-                                self.workspace = Path(rootdir)
-                                self._logger.info("Client workspace folder: %s", self.workspace)
-                            else:
-                                self._logger.info("No client workspace specified")
-                                self.workspace = False
-                            client_options = message.get("params", {}).get("capabilities", {})
-                            announcement = self.initialize(client_options)
-                            await self.send_response(message["id"], announcement, writer)
-                        elif has_started and method == "shutdown":
-                            self._logger.info("Client requested shutdown")
-                            await self.send_response(message["id"], {}, writer)
-                            # explicitly clear the dirty files on shutdown
-                            dirty_files.clear()
-                        elif has_started and method == "textDocument/completion":
-                            file_uri = message.get("params", {}).get("textDocument", {}).get("uri", None)
-                            if file_uri:
-                                document = self._get_document(file_uri, dirty_files)
-                                completions = await self.provide_code_completion(message["params"], document)
-                                await self.send_response(message["id"], completions, writer)
-                        elif has_started and method == "textDocument/definition":
-                            file_uri = message.get("params", {}).get("textDocument", {}).get("uri", None)
-                            if file_uri:
-                                document = self._get_document(file_uri, dirty_files)
-                                definition = await self.provide_definition(message["params"], document)
-                                await self.send_response(message["id"], definition, writer)
-                        # elif has_started and method == "textDocument/documentHighlight":
-                        #     highlights = await self.provide_highlight(message["params"])
-                        #     await self.send_response(message["id"], highlights, writer)
-                        elif has_started and method == "textDocument/hover":
-                            file_uri = message.get("params", {}).get("textDocument", {}).get("uri", None)
-                            if file_uri:
-                                document = self._get_document(file_uri, dirty_files)
-                                hovers = await self.provide_hover(message["params"], document)
-                                await self.send_response(message["id"], hovers, writer)
-                        elif has_started and method == "textDocument/references":
-                            file_uri = message.get("params", {}).get("textDocument", {}).get("uri", None)
-                            if file_uri:
-                                document = self._get_document(file_uri, dirty_files)
-                                references = await self.provide_reference(message["params"], document)
-                                await self.send_response(message["id"], references, writer)
-                        elif has_started and method == "textDocument/rename":
-                            file_uri = message.get("params", {}).get("textDocument", {}).get("uri", None)
-                            if file_uri:
-                                document = self._get_document(file_uri, dirty_files)
-                                renames = await self.provide_rename(message["params"], document, file_uri)
-                                await self.send_response(message["id"], renames, writer)
-                        elif has_started and method == "workspace/executeCommand":
-                            await self.execute_command(message["params"], dirty_files, writer)
+                    elif "id" in message:
+                        if handler is None:
+                            await self.send_error(lsp.JsonRPCError.METHOD_NOT_FOUND, message["id"], "Unsupported method: {}".format(method), writer)
+                        elif handler.requires_start and not session.has_started:
+                            await self.send_error(lsp.JsonRPCError.SERVER_NOT_INITIALIZED, message["id"], "Server has not been initialized", writer)
+                        elif handler.capability and handler.capability not in session.capabilities:
+                            await self.send_error(lsp.JsonRPCError.METHOD_NOT_FOUND, message["id"], "Capability not announced: {}".format(handler.capability), writer)
+                        elif handler.concurrent:
+                            # answer in the background so slow requests don't hold up the rest. Changes that
+                            # arrive in the meantime are applied right away, so hold on to the text as it is now
+                            snapshot = self._snapshot_document(message, session)
+                            session.requests[message["id"]] = asyncio.ensure_future(self._run_request(message, session, snapshot))
+                        else:
+                            result = await self._dispatch(method, message, session)
+                            await self.send_response(message["id"], result, writer)
                     # if no id is present, this is a JSON-RPC notification
-                    else:
-                        if method == "initialized":
-                            self._logger.info("Client has been successfully initialized")
-                            has_started = True
-                            params = {"type": lsp.MessageType.INFO, "message": "Successfully connected"}
-                            await self.send_notification("window/showMessageRequest", params, writer)
-                        elif has_started and method == "exit":
-                            # first remove the client associated with this handler
-                            await self.remove_client(writer)
-                            raise ce.ServerExit("Server exiting process per client request")
-                        elif has_started and method == "workspace/didChangeConfiguration":
-                            config = message.get("params", {}).get("settings", {}).get("yara", {})
-                            self._logger.debug("Changed workspace config to %s", json.dumps(config))
-                        elif has_started and method == "textDocument/didChange":
-                            file_uri = message.get("params", {}).get("textDocument", {}).get("uri", None)
-                            if file_uri:
-                                self._logger.debug("Adding %s to dirty files list", file_uri)
-                                for changes in message.get("params", {}).get("contentChanges", []):
-                                    # full text is submitted with each change
-                                    change = changes.get("text", None)
-                                    if change:
-                                        dirty_files[file_uri] = change
-                        elif has_started and method == "textDocument/didClose":
-                            file_uri = message.get("params", {}).get("textDocument", {}).get("uri", "")
-                            # file is no longer dirty after closing
-                            if file_uri in dirty_files:
-                                del dirty_files[file_uri]
-                                self._logger.debug("Removed %s from dirty files list", file_uri)
-                        elif has_started and method == "textDocument/didSave":
-                            file_uri = message.get("params", {}).get("textDocument", {}).get("uri", "")
-                            # file is no longer dirty after saving
-                            if file_uri in dirty_files:
-                                del dirty_files[file_uri]
-                                self._logger.debug("Removed %s from dirty files list", file_uri)
-                            if config.get("compile_on_save", False):
-                                file_path = helpers.parse_uri(file_uri)
-                                with open(file_path, "rb") as ifile:
-                                    document = ifile.read().decode(self._encoding)
-                                diagnostics = await self.provide_diagnostic(document)
-                            else:
-                                diagnostics = []
-                            params = {
-                                "uri": file_uri,
-                                "diagnostics": diagnostics
-                            }
-                            await self.send_notification("textDocument/publishDiagnostics", params, writer)
-            except ce.NoYaraPython as warn:
-                self._logger.warning(warn)
-                params = {
-                    "type": lsp.MessageType.WARNING,
-                    "message": warn
-                }
-                await self.send_notification("window/showMessage", params, writer)
-            except (ce.CodeCompletionError, ce.DefinitionError, ce.DiagnosticError, ce.HighlightError, \
+                    elif handler is not None and (session.has_started or not handler.requires_start):
+                        await self._dispatch(method, message, session)
+            except (ce.NoYaraPython, ce.CodeCompletionError, ce.DefinitionError, ce.DiagnosticError, ce.HighlightError, \
                     ce.HoverError, ce.RenameError, ce.SymbolReferenceError) as err:
-                self._logger.error(err)
-                params = {
-                    "type": lsp.MessageType.ERROR,
-                    "message": str(err)
-                }
-                await self.send_notification("window/showMessage", params, writer)
+                await self._show_error(err, writer)
+            except (ce.ServerExit, ConnectionError, asyncio.CancelledError):
+                raise
+            except Exception as err:
+                # a single bad message shouldn't end the whole session
+                self._logger.error("Could not handle client message: %s", err)
+                self._logger.exception(err)
+                if message.get("method", None) and "id" in message and not writer.is_closing():
+                    await self.send_error(lsp.JsonRPCError.INTERNAL_ERROR, message["id"], str(err), writer)
 
     def initialize(self, client_options: dict) -> dict:
         '''Announce language support methods
@@ -295,7 +615,7 @@ class YaraLanguageServer(LanguageServer):
             server_options["completionProvider"] = {
                 # The server does not provide support to resolve additional information for a completion item
                 "resolveProvider": False,
-                "triggerCharacters": ["."]
+                "triggerCharacters": [".", "$", "#", "@", "!"]
             }
         if doc_options.get("definition", {}).get("dynamicRegistration", False):
             server_options["definitionProvider"] = True
@@ -318,82 +638,330 @@ class YaraLanguageServer(LanguageServer):
         if doc_options.get("rename", {}).get("dynamicRegistration", False):
             server_options["renameProvider"] = True
         if doc_options.get("synchronization", {}).get("dynamicRegistration", False):
-            # Documents are synced by always sending the full content of the document
-            server_options["textDocumentSync"] = lsp.TextSyncKind.FULL
+            # Documents are synced by sending only the ranges that changed
+            server_options["textDocumentSync"] = lsp.TextSyncKind.INCREMENTAL
         return {"capabilities": server_options}
 
-    async def execute_command(self, params: dict, dirty_files: dict, writer: asyncio.StreamWriter):
+    async def index_workspace(self, workspace: Workspace=None):
+        '''Index the rules declared in every file of the workspace in the background
+
+        :workspace: (Optional) Workspace to index. Defaults to the server's own workspace
+        '''
+        workspace = workspace or self.workspace
+        loop = asyncio.get_event_loop()
+        self._logger.info("Indexing rules in %s", workspace.root)
+        files = await loop.run_in_executor(None, lambda: set(workspace.files()))
+        workspace.known_files = files
+        for file in list(files):
+            try:
+                text = await loop.run_in_executor(None, file.read_text)
+            except (OSError, UnicodeDecodeError) as err:
+                self._logger.warning("Could not index %s: %s", file, err)
+                continue
+            workspace.index.update(TextDocument(file.as_uri(), text))
+            # scan each file as it's read so lookups never have to wait on the whole workspace
+            workspace.index.refresh()
+        self._logger.info("Indexed %d rules in %s", len(workspace.index), workspace.root)
+
+    async def _request_client(self, method: str, params: dict, session: ClientSession, timeout: float=10) -> dict:
+        '''Send the client a request and wait for its response
+
+        :method: Method to call on the client
+        :params: Parameters of the request
+        :session: Client to send the request to
+        :timeout: (Optional) Seconds to wait for the response
+        '''
+        request_id = next(self._request_ids)
+        future = session.responses[request_id] = asyncio.get_event_loop().create_future()
+        try:
+            await self.send_request(request_id, method, params, session.writer)
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            session.responses.pop(request_id, None)
+
+    async def _watch_workspace(self, session: ClientSession):
+        ''' Have the client report changes to rule files, polling for them ourselves if it can't '''
+        workspace = session.workspace
+        if session.can_watch_files:
+            registration = {
+                "id": "yara-watched-files",
+                "method": "workspace/didChangeWatchedFiles",
+                "registerOptions": {
+                    "watchers": [{"globPattern": "**/*.yara"}, {"globPattern": "**/*.yar"}]
+                }
+            }
+            try:
+                response = await self._request_client("client/registerCapability", {"registrations": [registration]}, session)
+            except asyncio.TimeoutError:
+                response = {"error": "timed out"}
+            if "error" not in response:
+                self._logger.info("Client is watching %s for changes", workspace.root)
+                workspace.watched = True
+                return
+            self._logger.warning("Could not register file watchers: %s", response["error"])
+        if self.poll_interval and workspace.poller is None:
+            self._logger.info("Polling %s for changes every %.1f seconds", workspace.root, self.poll_interval)
+            workspace.poller = asyncio.ensure_future(self._poll_workspace(workspace))
+
+    async def _poll_workspace(self, workspace: Workspace):
+        '''Compare the size and modification time of every rule file until the workspace is closed
+
+        Each check only stat()s the files found so far. The whole tree is only searched for new files every rescan_interval seconds
+        '''
+        loop = asyncio.get_event_loop()
+
+        def _rescan() -> tuple:
+            files = list(workspace.files())
+            return files, workspace.snapshot(files)
+
+        files, previous = await loop.run_in_executor(None, _rescan)
+        workspace.watched = True
+        last_rescan = loop.time()
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            if loop.time() - last_rescan >= self.rescan_interval:
+                files, current = await loop.run_in_executor(None, _rescan)
+                last_rescan = loop.time()
+            else:
+                # deleted files simply drop out of the snapshot, and stay in the list until the next search
+                current = await loop.run_in_executor(None, workspace.snapshot, files)
+            changes = []
+            for file_uri, stamp in current.items():
+                if file_uri not in previous:
+                    changes.append((file_uri, lsp.FileChangeType.CREATED))
+                elif previous[file_uri] != stamp:
+                    changes.append((file_uri, lsp.FileChangeType.CHANGED))
+            changes.extend((file_uri, lsp.FileChangeType.DELETED) for file_uri in previous.keys() - current.keys())
+            previous = current
+            if changes:
+                await self.apply_file_changes(workspace, changes)
+
+    async def apply_file_changes(self, workspace: Workspace, changes: list):
+        '''Invalidate everything the server knows about files that changed on disk
+
+        :workspace: Workspace the files belong to
+        :changes: (file URI, FileChangeType) pairs
+        '''
+        loop = asyncio.get_event_loop()
+        for file_uri, change_type in changes:
+            file_path = helpers.parse_uri(file_uri, encoding=self._encoding)
+            if not file_path:
+                continue
+            self._logger.debug("File %s changed on disk (%s)", file_uri, change_type)
+            self.document_cache.invalidate(file_path)
+            if workspace.manifest is not None:
+                workspace.manifest.forget(file_uri)
+            if change_type == lsp.FileChangeType.DELETED:
+                workspace.index.remove(file_uri)
+                if workspace.known_files is not None:
+                    workspace.known_files.discard(Path(file_path))
+                continue
+            if workspace.known_files is not None:
+                workspace.known_files.add(Path(file_path))
+            try:
+                text = await loop.run_in_executor(None, Path(file_path).read_text)
+            except (OSError, UnicodeDecodeError):
+                workspace.index.remove(file_uri)
+                continue
+            workspace.index.update(TextDocument(file_uri, text))
+
+    def _reindex(self, workspace: Workspace, file_uri: str):
+        ''' Index the on-disk contents of a file, dropping it if it no longer exists '''
+        try:
+            workspace.index.update(self._get_text_document(file_uri, {}))
+        except (OSError, UnicodeDecodeError):
+            workspace.index.remove(file_uri)
+
+    async def compile_all_rules(self, dirty_files: dict, writer: asyncio.StreamWriter, config: dict, workspace: Workspace=None):
+        '''Compile every open file and every rule file in the workspace
+
+        Files are compiled in parallel and their diagnostics are published as soon as each one finishes.
+        Workspace files that have not changed since the last run replay their diagnostics from the build manifest
+
+        :dirty_files: Unsaved documents, keyed by file URI
+        :writer: asyncio.StreamWriter to publish diagnostics to
+        :config: Client configuration settings
+        :workspace: (Optional) Workspace to compile. Defaults to the server's own workspace
+        '''
+        workspace = workspace or self.workspace
+        manifest = workspace.manifest
+        loop = asyncio.get_event_loop()
+
+        async def _publish(file_uri: str, diagnostics: list):
+            if diagnostics:
+                result = {
+                    "uri": file_uri,
+                    "diagnostics": diagnostics
+                }
+                await self.send_notification("textDocument/publishDiagnostics", result, writer)
+
+        # snapshot the text in order to not mess with dirty file contents
+        documents = {file_uri: self._get_document(file_uri, dirty_files) for file_uri in dirty_files}
+        file_uris = list(documents)
+        # file URI => stat() results for workspace files that need to be recompiled
+        stats = {}
+        if workspace.root:
+            self._logger.info("Compiling all rules in %s per user's request", workspace.root)
+            if manifest is None:
+                # every client sharing the workspace also shares its manifest
+                manifest = workspace.manifest = BuildManifest(get_manifest_path(workspace.root))
+                await loop.run_in_executor(None, manifest.load)
+            workspace_files = await loop.run_in_executor(None, workspace.stat_files)
+            for file_uri, stat in workspace_files:
+                if file_uri in documents:
+                    continue
+                diagnostics = manifest.lookup(file_uri, stat=stat)
+                if diagnostics is None:
+                    file_uris.append(file_uri)
+                    stats[file_uri] = stat
+                else:
+                    await _publish(file_uri, diagnostics)
+            manifest.prune(set(file_uri for file_uri, _ in workspace_files))
+        else:
+            self._logger.warning("No workspace specified in initialization. CompileAllRules will only work on open docs")
+            self._logger.info("Compiling all unsaved files per user's request")
+        # keep every compile thread busy, but only read as many files as can be compiled at once
+        semaphore = asyncio.Semaphore(max(int(config.get("compile_all_concurrency", 0)), 0) or self.compile_workers)
+        batch_size = max(int(config.get("compile_all_batch_size", 256)), 1)
+
+        async def _compile(file_uri: str) -> tuple:
+            async with semaphore:
+                if file_uri in documents:
+                    return file_uri, await self.provide_diagnostic(documents[file_uri])
+                document = await loop.run_in_executor(None, self._get_document, file_uri, {})
+                # files that were touched but not actually changed don't need to be compiled again
+                digest = BuildManifest.hash_text(document)
+                diagnostics = manifest.lookup(file_uri, stat=stats[file_uri], digest=digest)
+                if diagnostics is None:
+                    diagnostics = await self.provide_diagnostic(document)
+                    manifest.record(file_uri, stats[file_uri], digest, diagnostics)
+                return file_uri, diagnostics
+
+        for batch in range(0, len(file_uris), batch_size):
+            tasks = [_compile(file_uri) for file_uri in file_uris[batch:batch+batch_size]]
+            # publish each file's diagnostics as soon as it's done, rather than waiting on the whole batch
+            for task in asyncio.as_completed(tasks):
+                try:
+                    file_uri, diagnostics = await task
+                except (OSError, UnicodeDecodeError, ce.DiagnosticError) as err:
+                    self._logger.warning("Could not compile file: %s", err)
+                    continue
+                await _publish(file_uri, diagnostics)
+        if manifest is not None:
+            try:
+                await loop.run_in_executor(None, manifest.save)
+            except OSError as err:
+                self._logger.warning("Could not save build manifest: %s", err)
+        self._logger.info("Compile cache: %s", self.compile_cache.info())
+
+    async def execute_command(self, params: dict, dirty_files: dict, writer: asyncio.StreamWriter, config: dict=None, workspace: Workspace=None):
+        '''Run one of the commands the server advertises
+
+        :params: Command name and arguments sent by the client
+        :dirty_files: Unsaved documents, keyed by file URI
+        :writer: asyncio.StreamWriter to send any results to
+        :config: (Optional) Client configuration settings
+        :workspace: (Optional) Workspace the client opened. Defaults to the server's own workspace
+        '''
         cmd = params.get("command", "")
         args = params.get("arguments", [])
         if cmd == "yara.CompileRule":
             self._logger.info("Compiling rule per user's request")
         elif cmd == "yara.CompileAllRules":
-            # temp copy of filenames => contents
-            # do a deep copy in order to not mess with dirty file contents
-            documents = deepcopy(dirty_files)
-            if self.workspace:
-                self._logger.info("Compiling all rules in %s per user's request", self.workspace)
-                for file in chain(self.workspace.glob("**/*.yara"), self.workspace.glob("**/*.yar")):
-                    file_uri = file.as_uri()
-                    documents[file_uri] = self._get_document(file_uri, dirty_files)
-            else:
-                self._logger.warning("No workspace specified in initialization. CompileAllRules will only work on open docs")
-                self._logger.info("Compiling all unsaved files per user's request")
-                documents = dirty_files
-            # documents should be a list of file contents
-            for file_uri, document in documents.items():
-                diagnostics = await self.provide_diagnostic(document)
-                if diagnostics:
-                    result = {
-                        "uri": file_uri,
-                        "diagnostics": diagnostics
-                    }
-                    await self.send_notification("textDocument/publishDiagnostics", result, writer)
+            await self.compile_all_rules(dirty_files, writer, config or {}, workspace)
         else:
             self._logger.warning("Unknown command: %s [%s]", cmd, ",".join(args))
 
-    async def provide_code_completion(self, params: dict, document: str) -> list:
-        '''Respond to the completionItem/resolve request
+    async def provide_code_completion(self, params: dict, document: Union[str, TextDocument], max_items: int=0,
+                                      workspace: Workspace=None, dirty_files: dict=None) -> lsp.CompletionList:
+        '''Respond to the textDocument/completion request
 
-        Returns a (possibly empty) list of completion items
+        Completes module members after a ".", string identifiers of the current rule after "$", "#", "@" or "!",
+        and module and rule names anywhere else in a condition, filtered by whatever part of the name has been typed so far
+
+        :params: Completion request parameters sent by the client
+        :document: Text or TextDocument being edited
+        :max_items: (Optional) Maximum number of items to return. Longer results are marked incomplete. 0 returns everything
+        :workspace: (Optional) Workspace to complete rule names from. Defaults to the server's own workspace
+        :dirty_files: (Optional) Unsaved documents that take precedence over the workspace's copies
         '''
         try:
-            results = []
-            trigger = params.get("context", {}).get("triggerCharacter", ".")
+            document = get_document(document, params.get("textDocument", {}).get("uri", ""))
             # typically the trigger is at the end of a line, so subtract one to avoid an IndexError
             pos = lsp.Position(line=params["position"]["line"], char=params["position"]["character"]-1)
-            symbol = helpers.resolve_symbol(document, pos)
-            if not symbol:
-                return []
-            # split up the symbols into component parts, leaving off the last trigger character
-            symbols = symbol.split(trigger)
-            schema = self.modules
-            for depth, symbol in enumerate(symbols):
-                if symbol in schema:
-                    # if we're at the last symbol, return completion items
-                    if depth == len(symbols) - 1:
-                        completion_items = schema.get(symbol, {})
-                        if isinstance(completion_items, dict):
-                            for label, kind_str in completion_items.items():
-                                kind = lsp.CompletionItemKind.CLASS
-                                if str(kind_str).lower() == "enum":
-                                    kind = lsp.CompletionItemKind.ENUM
-                                elif str(kind_str).lower() == "property":
-                                    kind = lsp.CompletionItemKind.PROPERTY
-                                elif str(kind_str).lower() == "method":
-                                    kind = lsp.CompletionItemKind.METHOD
-                                results.append(lsp.CompletionItem(label, kind))
-                    else:
-                        schema = schema[symbol]
-            return results
+            line = document.line(pos.line) if 0 <= pos.line < document.line_count else ""
+            if pos.char < 0 or pos.char > len(line):
+                return lsp.CompletionList([])
+            elif pos.char == len(line):
+                # just past the end of the line, as if the trigger had been typed there
+                before = helpers.resolve_symbol(document, pos) + "."
+            else:
+                before = line[:pos.char + 1]
+            # only the part of the name before the cursor matters, not anything in front of it such as an opening parenthesis
+            token = re.search(r"[$#@!]?[\w.]*$", before).group()
+            if "." in token:
+                # the last part is a partial member name, empty just after the trigger
+                path = token.split(".")
+                prefix = path.pop()
+                return self.module_trie.complete(path, prefix, max_items)
+            rule = document.tree.rule_at(pos)
+            if not token or not self._in_condition(rule, pos):
+                return lsp.CompletionList([])
+            elif token[0] in self._varchar:
+                return self._complete_strings(rule, token, max_items)
+            modules = self.module_trie.complete([], token, max_items)
+            index = (workspace or self.workspace).index
+            symbols, incomplete = index.complete(token, self._overlay(document, dirty_files), max_items)
+            items = modules.items + [
+                lsp.CompletionItem(symbol.name, lsp.CompletionItemKind.REFERENCE, detail=symbol.declaration())
+                # rules can't refer to themselves
+                for symbol in symbols if symbol.name != rule.name
+            ]
+            if max_items > 0 and len(items) > max_items:
+                return lsp.CompletionList(items[:max_items], isIncomplete=True)
+            return lsp.CompletionList(items, isIncomplete=modules.isIncomplete or incomplete)
         except Exception as err:
             self._logger.error(err)
             raise ce.CodeCompletionError("Could not offer completion items: {}".format(err))
 
-    async def provide_definition(self, params: dict, document: str) -> list:
+    @staticmethod
+    def _in_condition(rule: RuleNode, pos: lsp.Position) -> bool:
+        ''' Check if a position falls in the condition of a rule '''
+        section = rule.sections.get("condition", None) if rule else None
+        if section is None:
+            return False
+        start = section.range.start
+        return (pos.line, pos.char) > (start.line, start.char)
+
+    @staticmethod
+    def _complete_strings(rule: RuleNode, token: str, max_items: int) -> lsp.CompletionList:
+        '''Complete the identifiers of the strings declared in a rule
+
+        :rule: Rule being edited
+        :token: Partial identifier, starting with its variable character
+        :max_items: Maximum number of items to return. Longer results are marked incomplete. 0 returns everything
+        '''
+        prefix = token[1:].lower()
+        items = []
+        seen = set()
+        for string in rule.strings:
+            name = string.identifier[1:]
+            # anonymous strings can't be referred to by name
+            if name and name not in seen and name.lower().startswith(prefix):
+                seen.add(name)
+                # editors don't treat the variable character as part of the word, so only the name is replaced
+                items.append(lsp.CompletionItem(token[0] + name, lsp.CompletionItemKind.VARIABLE, detail=string.value, insertText=name, filterText=name))
+        if max_items > 0 and len(items) > max_items:
+            return lsp.CompletionList(items[:max_items], isIncomplete=True)
+        return lsp.CompletionList(items)
+
+    async def provide_definition(self, params: dict, document: Union[str, TextDocument], workspace: Workspace=None, dirty_files: dict=None) -> list:
         '''Respond to the textDocument/definition request
 
         Returns a (possibly empty) list of symbol Locations
+
+        :workspace: (Optional) Workspace to search for rules in. Defaults to the server's own workspace
+        :dirty_files: (Optional) Unsaved documents that take precedence over the workspace's copies
         '''
         results = []
         try:
@@ -401,6 +969,7 @@ class YaraLanguageServer(LanguageServer):
             # so we need to separate the code before 'symbol' is instantiated from the code after
             # there's probably a better way to do this
             file_uri = params.get("textDocument", {}).get("uri", None)
+            document = get_document(document, file_uri)
             line = params.get("position", {}).get("line", None)
             char = params.get("position", {}).get("character", None)
             pos = lsp.Position(line=line, char=char)
@@ -413,80 +982,44 @@ class YaraLanguageServer(LanguageServer):
         try:
             # check to see if the symbol is a variable or a rule name (currently the only valid symbols)
             if symbol[0] in self._varchar:
-                pattern = "\\${} =\\s".format("".join(symbol[1:]))
-                rule_range = helpers.get_rule_range(document, pos)
-                match_lines = document.split("\n")[rule_range.start.line:rule_range.end.line+1]
-                rel_offset = rule_range.start.line
-                # ignore the "$" variable identifier at the beginning of the match
-                char_start_offset = 1
-            # else assume this is a rule symbol
+                rule = document.tree.rule_at(pos)
+                strings = rule.find_strings(symbol) if rule else []
+                for string in strings:
+                    # ignore the "$" variable identifier and stop at the beginning of the string's value
+                    start = string.range.start
+                    locrange = lsp.Range(
+                        start=lsp.Position(line=start.line, char=start.char + 1),
+                        end=string.value_range.start
+                    )
+                    results.append(lsp.Location(locrange, file_uri))
+                return results
+            # else assume this is a rule symbol, which may be declared anywhere in the workspace
             else:
-                pattern = "\\brule {}\\b".format(symbol)
-                match_lines = document.split("\n")
-                rel_offset = 0
-                # ignore the "rule " string at the beginning of the match
-                char_start_offset = 5
-
-            for index, line in enumerate(match_lines):
-                for match in re.finditer(pattern, line):
-                    if match:
-                        offset = rel_offset + index
-                        locrange = lsp.Range(
-                            start=lsp.Position(line=offset, char=match.start() + char_start_offset),
-                            end=lsp.Position(line=offset, char=match.end())
-                        )
-                        results.append(lsp.Location(locrange, file_uri))
-            return results
-        except re.error:
-            self._logger.debug("Error building regex pattern: %s", pattern)
-            return []
+                index = (workspace or self.workspace).index
+                return [rule.location for rule in index.lookup(symbol, self._overlay(document, dirty_files))]
         except Exception as err:
             self._logger.error(err)
             raise ce.DefinitionError("Could not offer definition for symbol '{}': {}".format(symbol, err))
 
-    async def provide_diagnostic(self, document: str) -> list:
+    async def provide_diagnostic(self, document: Union[str, TextDocument], externals: dict=None) -> list:
         ''' Respond to the textDocument/publishDiagnostics request
 
         :document: Contents of YARA rule file
+        :externals: (Optional) External variables to compile the rules with
         '''
         try:
             if HAS_YARA:
-                diagnostics = []
-                try:
-                    yara.compile(source=document)
-                except yara.SyntaxError as error:
-                    line_no, msg = helpers.parse_result(str(error))
-                    # VSCode is zero-indexed
-                    line_no -= 1
-                    first_char = helpers.get_first_non_whitespace_index(document.split("\n")[line_no])
-                    symbol_range = lsp.Range(
-                        start=lsp.Position(line_no, first_char),
-                        end=lsp.Position(line_no, 10000)
-                    )
-                    diagnostics.append(
-                        lsp.Diagnostic(
-                            locrange=symbol_range,
-                            severity=lsp.DiagnosticSeverity.ERROR,
-                            message=msg
-                        )
-                    )
-                except yara.WarningError as warning:
-                    line_no, msg = helpers.parse_result(str(warning))
-                    # VSCode is zero-indexed
-                    line_no -= 1
-                    first_char = helpers.get_first_non_whitespace_index(document.split("\n")[line_no])
-                    symbol_range = lsp.Range(
-                        start=lsp.Position(line_no, first_char),
-                        end=lsp.Position(line_no, 10000)
-                    )
-                    diagnostics.append(
-                        lsp.Diagnostic(
-                            locrange=symbol_range,
-                            severity=lsp.DiagnosticSeverity.WARNING,
-                            message=msg
-                        )
+                document = get_document(document)
+                key = self.compile_cache.key(document.text, externals)
+                result = self.compile_cache.get(key)
+                if result is None:
+                    # compile a snapshot of the text, since the document may be edited while the worker runs
+                    result = await asyncio.get_event_loop().run_in_executor(
+                        self.executor, compiler.compile_document, document.text, externals, self.keep_compiled_rules
                     )
-                return diagnostics
+                    self.compile_cache.put(key, result)
+                # cached diagnostics are shared, so hand out a copy of the list
+                return list(result.diagnostics)
             else:
                 if self.diagnostics_warned:
                     pass
@@ -507,90 +1040,88 @@ class YaraLanguageServer(LanguageServer):
             self._logger.error(err)
             raise ce.HighlightError("Could not offer code highlighting: {}".format(err))
 
-    async def provide_hover(self, params: dict, document: str) -> list:
-        ''' Respond to the textDocument/hover request '''
+    async def provide_hover(self, params: dict, document: Union[str, TextDocument], workspace: Workspace=None, dirty_files: dict=None) -> list:
+        '''Respond to the textDocument/hover request
+
+        :workspace: (Optional) Workspace to search for rules in. Defaults to the server's own workspace
+        :dirty_files: (Optional) Unsaved documents that take precedence over the workspace's copies
+        '''
         try:
-            definitions = await self.provide_definition(params, document)
-            if len(definitions) > 0:
-                # only care about the first definition; although there shouldn't be more
-                definition = definitions[0]
-                line = document.split("\n")[definition.range.start.line]
-                try:
-                    words = line.split(" = ")
-                    if len(words) > 1:
-                        contents = lsp.MarkupContent(lsp.MarkupKind.Plaintext, content=words[1])
-                        return lsp.Hover(contents)
-                except IndexError as err:
-                    self._logger.warning(words)
-                    self._logger.warning("IndexError at line %d: '%s'", definition.range.start.line, line)
+            document = get_document(document, params.get("textDocument", {}).get("uri", ""))
+            pos = lsp.Position(line=params["position"]["line"], char=params["position"]["character"])
+            symbol = helpers.resolve_symbol(document, pos)
+            if symbol and symbol[0] not in self._varchar:
+                # rule hovers come straight from the workspace index
+                index = (workspace or self.workspace).index
+                rules = index.lookup(symbol, self._overlay(document, dirty_files))
+                if rules:
+                    contents = lsp.MarkupContent(lsp.MarkupKind.Plaintext, content=rules[0].declaration())
+                    return lsp.Hover(contents)
+                return None
+            elif symbol:
+                rule = document.tree.rule_at(pos)
+                strings = rule.find_strings(symbol) if rule else []
+                if strings:
+                    # only care about the first definition; although there shouldn't be more
+                    contents = lsp.MarkupContent(lsp.MarkupKind.Plaintext, content=strings[0].value)
+                    return lsp.Hover(contents)
             return None
         except Exception as err:
             self._logger.error(err)
             raise ce.HoverError("Could not offer definition hover: {}".format(err))
 
-    async def provide_reference(self, params: dict, document: str) -> list:
+    async def provide_reference(self, params: dict, document: Union[str, TextDocument], workspace: Workspace=None, dirty_files: dict=None) -> list:
         '''The references request is sent from the client to the server to resolve
         project-wide references for the symbol denoted by the given text document position
 
+        String references are limited to the rule they are declared in. Rule references
+        are looked up across the whole workspace in its index
+
         Returns a (possibly empty) list of symbol Locations
+
+        :workspace: (Optional) Workspace to search for rule references in. Defaults to the server's own workspace
+        :dirty_files: (Optional) Unsaved documents that take precedence over the workspace's copies
         '''
         results = []
         file_uri = params.get("textDocument", {}).get("uri", None)
+        document = get_document(document, file_uri)
         pos = lsp.Position(line=params["position"]["line"], char=params["position"]["character"])
         symbol = helpers.resolve_symbol(document, pos)
         if not symbol:
             return []
         try:
-            # gotta match the wildcard variables first to build the correct regex pattern
             # I don't think wildcards are technially supposed to work for rules, but a diagnostic
             # will appear to the user if YARA can't compile it, so I won't worry too much
-            WILDCARD = ("*" in symbol)
-            if WILDCARD:
-                # remove parentheses and replace the YARA wildcard with a Python re equivalent
-                symbol = symbol.replace("*", ".*?").strip("()")
+            symbol = symbol.strip("()")
             # check to see if the symbol is a variable or a rule name (currently the only valid symbols)
             if symbol[0] in self._varchar:
-                # any possible first character matching self._varchar must be treated as a reference
-                pattern = "[{}]{}\\b".format("".join(self._varchar), "".join(symbol[1:]))
-                rule_range = helpers.get_rule_range(document, pos)
-                rule_lines = document.split("\n")[rule_range.start.line:rule_range.end.line+1]
-                rel_offset = rule_range.start.line
-                char_start_offset = 1
-                if WILDCARD:
-                    # only search strings section if this is a wildcard variable
-                    # figure out the bounds of the strings section
-                    strings_start = [idx for idx, line in enumerate(rule_lines) if "strings:" in line][0]
-                    strings_end = [idx for idx, line in enumerate(rule_lines) if "condition:" in line][0]
-                    rule_lines = rule_lines[strings_start:strings_end]
-                    rel_offset += strings_start
+                rule = document.tree.rule_at(pos)
+                if rule is None:
+                    return []
+                # wildcards only refer to the strings they match in the strings section
+                nodes = rule.find_strings(symbol)
+                if "*" not in symbol:
+                    # any possible first character matching self._varchar must be treated as a reference
+                    nodes.extend(ref for ref in rule.references if ref.name[0] in self._varchar and ref.name[1:] == symbol[1:])
+                for node in nodes:
+                    locrange = node.range
+                    # ignore the variable identifier at the beginning of each match
+                    locrange.start.char += 1
+                    results.append(lsp.Location(locrange, file_uri))
             else:
-                rel_offset = 0
-                pattern = "{}\\b".format(symbol)
-                rule_lines = document.split("\n")
-                char_start_offset = 0
-
-            for index, line in enumerate(rule_lines):
-                for match in re.finditer(pattern, line):
-                    if match:
-                        # index corresponds to line no. within each rule, not within file
-                        offset = rel_offset + index
-                        locrange = lsp.Range(
-                            start=lsp.Position(line=offset, char=match.start() + char_start_offset),
-                            end=lsp.Position(line=offset, char=match.end())
-                        )
-                        results.append(lsp.Location(locrange, file_uri))
+                index = (workspace or self.workspace).index
+                results = index.references(symbol, self._overlay(document, dirty_files))
+            results.sort(key=lambda location: (location.uri != file_uri, location.uri, location.range.start.line, location.range.start.char))
             return results
-        except re.error:
-            self._logger.debug("Error building regex pattern: %s", pattern)
-            return []
         except Exception as err:
             self._logger.error(err)
             raise ce.SymbolReferenceError("Could not find references for '{}': {}".format(symbol, err))
 
-    async def provide_rename(self, params: dict, document: str, file_uri: str) -> list:
+    async def provide_rename(self, params: dict, document: Union[str, TextDocument], file_uri: str) -> list:
         ''' Respond to the textDocument/rename request '''
         results = lsp.WorkspaceEdit(file_uri=file_uri, changes=[])
         try:
+            document = get_document(document, file_uri)
             pos = lsp.Position(line=params["position"]["line"], char=params["position"]["character"])
             old_text = helpers.resolve_symbol(document, pos)
             new_text = params.get("newName", None)
@@ -603,11 +1134,14 @@ class YaraLanguageServer(LanguageServer):
             # let provide_reference() determine symbol or rule
             # and therefore what scope to look into
             refs = await self.provide_reference(params, document)
-            for ref in refs:
+            # rule references already cover the whole name
+            offset = 1 if old_text[:1] in self._varchar else 0
+            # the edit only covers the document being renamed in
+            for ref in (ref for ref in refs if ref.uri == file_uri):
                 # need to add one character to the position so the variable
                 # type is not overwritten
                 new_range = lsp.Range(
-                    lsp.Position(ref.range.start.line, ref.range.start.char+1),
+                    lsp.Position(ref.range.start.line, ref.range.start.char+offset),
                     lsp.Position(ref.range.end.line, ref.range.end.char)
                 )
                 results.append(lsp.TextEdit(new_range, new_text))
@@ -8,7 +8,7 @@ import * as os from "os";
 import * as path from "path";
 import * as vscode from "vscode";
 import * as lcp from "vscode-languageclient";
-import { install_server, start_server, server_installed } from "../client/server";
+import { install_server, start_server, server_installed, ServerAddress } from "../client/server";
 
 const ext_id: string = "infosec-intern.yara";
 const workspace: string = path.join(__dirname, "..", "..", "test/rules/");
@@ -82,13 +82,20 @@ suite("YARA: Setup", function () {
         see: https://github.com/mochajs/mocha/issues/2407
     */
     test("server binding", async function () {
-        // ensure the server binds to a port so the client can connect
+        // ensure the server binds to a free port and announces it so the client can connect
         const host: string = "127.0.0.1";
-        const port: number = 8471;
-        server_proc = await start_server(targetDir, host, port);
-        let socket: net.Socket = net.createConnection(port, host);
-        assert(socket.remotePort == port);
+        const address: ServerAddress = await start_server(targetDir, host);
+        server_proc = address.process;
+        assert(address.host == host);
+        assert(address.port > 0);
+        let socket: net.Socket = net.createConnection(address.port, address.host);
+        await new Promise((resolve, reject) => {
+            socket.once("connect", resolve);
+            socket.once("error", reject);
+        });
+        assert(socket.remotePort == address.port);
         assert(socket.remoteAddress == host);
+        socket.destroy();
     });
     test("server installed", async function () {
         const installed: boolean = server_installed(targetDir);